@@ -3,22 +3,58 @@ import os
 import time
 import random
 import socket, logging
+import asyncio
 import pickle
 from logging.handlers import RotatingFileHandler
-from common import protocol
+from common import protocol, transport
 import client.encryption.encryption_scheme as encryption
 from itertools import islice
 import traceback
-from skip_list import skipList
+from client.skip_list import skipList, MAX_ENTRIES
+
+RETRY = object() # 插入被服务器拒绝，需要重新规划
+
+
+def tighten_bounds(bounds, message, plaintext, ciphertext):
+    """message 与树中节点比较后收紧其两侧的界 bounds = [下界, 上界]，界为 (明文, 密文)，None 表示该侧无界"""
+    if plaintext < message:
+        if bounds[0] is None or bounds[0][0] < plaintext:
+            bounds[0] = (plaintext, ciphertext)
+    elif bounds[1] is None or plaintext < bounds[1][0]:
+        bounds[1] = (plaintext, ciphertext)
+
+
+def bound_ciphertexts(bounds):
+    """insert 消息中的 bounds：两侧界的密文"""
+    return [bound[1] if bound is not None else None for bound in bounds]
 
 
 class Client:
-    def __init__(self, client_socket, logger):
+    RESPONSE_HANDLERS = {} # {消息类型code: 响应处理函数}，由 @protocol.handler 注册
+
+    def __init__(self, client_socket, logger, codec='binary', cache_entries=MAX_ENTRIES, cache_bytes=None, cache_file=None):
         self.encryption_scheme = encryption.BasicEncryptionScheme()
         self.client_socket = client_socket
+        self.reader = protocol.FrameReader(client_socket) # 按帧读取服务器消息
+        self.codec = protocol.get_codec(codec) # 'binary'为紧凑二进制编码，'pickle'为完整对象序列化
+        protocol.send_handshake(client_socket, self.codec)
         self.logger = logger
-        self.cache = skipList(logger)
+        self.cache = skipList(logger, cache_entries, cache_bytes) # 缓存表预算：值个数/近似字节数，超出时淘汰，None 表示不限
+        self.cache_file = cache_file # 缓存表文件：启动时载入，关闭及每插入 cache_save_interval 个值时写出，None 表示不持久化
+        self.cache_save_interval = 1000
+        self.inserted_since_save = 0
+        if cache_file and self.cache.load(cache_file):
+            logger.info(f'cache loaded from {cache_file}: {len(self.cache.skip_list)} entries')
         self.lookup_cache_time = 0
+        self.subtree_depth = 5 # get_subtree 每次取回的层数，<=1 时逐层 move_left/move_right
+        self.round_trips = 0 # 与服务器的交互次数
+        self.round_trips_saved = 0 # 相比逐层遍历节省的交互次数
+        self.batch_size = 500 # /batch_insert file: 每条 batch_insert 消息包含的行数
+        self.plan_epoch = None # 当前插入规划所依据的树 epoch
+        self.plan_bounds = [None, None] # 当前插入的值两侧最近的已比较节点，跨重试保留（见 tighten_bounds）
+        self.epoch = None # 最近一个响应的 epoch，缓存表中的 path 在该 epoch 下有效
+        self.last_response = None
+        self.retries = 0 # 因树结构变化而重试的插入次数
 
 
     # ================================================================
@@ -108,6 +144,43 @@ class Client:
                 break
 
 
+    def warm_up(self, depth):
+        """
+        预热缓存表：depth > 0 时一次 get_subtree 取回树的前 depth 层（带 path）；再用一次 find_node_path 取回载入的缓存值当前的 path
+        （文件中不保存 path，重启期间树可能已被重排），之后的插入直接从缓存定位起点。返回取得 path 的值个数
+        """
+        ciphertexts, relative_paths = self._get_subtree(None, depth) if depth > 0 else ([], [])
+        for ciphertext, path in zip(ciphertexts, relative_paths):
+            self.cache.insert(self.encryption_scheme.decrypt(ciphertext), path)
+
+        values = [value for value in self.cache.skip_list if self.cache.path_of(value) is None]
+        if values:
+            paths = self.find_node_path_message(values)
+            for value, path in zip(values, paths):
+                if path is None: # 不在服务器的树中：缓存表文件属于其他（已清空的）表
+                    self.cache.discard(value)
+                else:
+                    self.cache.insert(value, path)
+        return len(ciphertexts) + len(values)
+
+
+    def save_cache(self):
+        if self.cache_file:
+            self.cache.save(self.cache_file)
+        self.inserted_since_save = 0
+
+
+    def _count_inserted(self, count):
+        self.inserted_since_save += count
+        if self.cache_file and self.inserted_since_save >= self.cache_save_interval:
+            self.save_cache()
+
+
+    def close(self):
+        self.save_cache()
+        self.client_socket.close()
+
+
     def find_node_path_message(self, message):
         ciphertext = []
         for msg in message:
@@ -122,13 +195,29 @@ class Client:
         low_bound, upper_bound = self.cache.search(message)
         self.cache.insert(message)
         if low_bound is None or upper_bound is None:
+            root = self.cache.value_at('')
+            if root is not None: # 根节点未被重排过时直接从缓存取得
+                self.round_trips_saved += 1
+                return root, '', 'root'
             return self._get_root(), '', 'root'
 
-        elif low_bound == upper_bound:
-            path = self.find_node_path_message([low_bound]) # return []
-            return low_bound, path[0], 'insert'
+        elif low_bound == upper_bound: # 重复值：服务器由密文定位节点，无需查询其path
+            self.round_trips_saved += 1
+            return low_bound, self.cache.path_of(low_bound) or '', 'insert'
         else:
+            # 缓存中相邻的两个值即新值两侧的界，遍历时再逐步收紧
+            tighten_bounds(self.plan_bounds, message, low_bound, self.encryption_scheme.encrypt(low_bound))
+            tighten_bounds(self.plan_bounds, message, upper_bound, self.encryption_scheme.encrypt(upper_bound))
+            # 两端的path均已缓存时，公共祖先即二者path的最长公共前缀，其值通常也在缓存中
+            low_path, upper_path = self.cache.path_of(low_bound), self.cache.path_of(upper_bound)
+            if low_path is not None and upper_path is not None:
+                path = os.path.commonprefix([low_path, upper_path])
+                current_ciphertext = self.cache.value_at(path)
+                if current_ciphertext is not None:
+                    self.round_trips_saved += 1
+                    return current_ciphertext, path, 'root'
             current_ciphertext, path = self.get_common_node([low_bound, upper_bound])
+            self.cache.insert(current_ciphertext, path)
             return current_ciphertext, path, 'root'
 
 
@@ -142,17 +231,44 @@ class Client:
 
 
     def insert_message(self, message):
+        # 规划所依据的间隙被其他插入占用时服务器拒绝插入，从其提示的起点重新遍历后重试
+        self.plan_bounds = [None, None]
+        start = None
+        while True:
+            self.plan_epoch = self.epoch # 规划可能直接使用缓存的path，以其有效的 epoch 为准
+            result = self._plan_and_insert(message, start)
+            if result is not RETRY:
+                path = self.last_response.find_node_path # 插入后该值的path
+                if path is not None:
+                    self.cache.insert(message, path)
+                self._count_inserted(1)
+                return result
+            self.retries += 1
+            self.cache.discard(message) # 规划时已放入缓存，但并未插入
+            if self.last_response.ciphertext is not None:
+                start = self.last_response.ciphertext, self.last_response.find_node_path or ''
+            self.logger.debug(f'insert retry: {message}')
+
+
+    def _plan_and_insert(self, message, start=None):
+        """start 为服务器在重试响应中提示的起点 (密文, path)，为 None 时由缓存表确定起点"""
         original_ciphertext = self.encryption_scheme.encrypt(message)
         previous_ciphertext = None # 元组--（current_ciphertext, 下一步移动方向）
 
         start_time = time.perf_counter()
-        current_ciphertext, path, prompt = self._find_interaction_start_node(message) # ！！！假阳性结果:current_ciphertext为初始交互节点
+        if start is not None:
+            current_ciphertext, path, prompt = self.encryption_scheme.decrypt(start[0]), start[1], 'root'
+        else:
+            current_ciphertext, path, prompt = self._find_interaction_start_node(message) # ！！！假阳性结果:current_ciphertext为初始交互节点
         end_time = time.perf_counter()
         self.lookup_cache_time += end_time - start_time
 
         if prompt == 'insert': # 数据库中已存在节点
             return self._insert(original_ciphertext, original_ciphertext, self._random_insert_direction(), path)
 
+        if self.subtree_depth > 1:
+            return self._insert_by_subtree(message, original_ciphertext, current_ciphertext, path)
+
         while True:
             if current_ciphertext == None: # 空节点
                 if path == '':
@@ -168,24 +284,158 @@ class Client:
                 path += "0"
                 previous_ciphertext = (current_ciphertext, "left")
                 enc_current = self.encryption_scheme.encrypt(current_ciphertext)
+                tighten_bounds(self.plan_bounds, message, current_ciphertext, enc_current)
                 current_ciphertext = self._move_left(enc_current)
                 if current_ciphertext is not None:
-                    self.cache.insert(current_ciphertext)
+                    self.cache.insert(current_ciphertext, path)
 
             elif message > current_ciphertext:
                 # Move right
                 path += "1"
                 previous_ciphertext = (current_ciphertext, "right")
                 enc_current = self.encryption_scheme.encrypt(current_ciphertext)
+                tighten_bounds(self.plan_bounds, message, current_ciphertext, enc_current)
                 current_ciphertext = self._move_right(enc_current)
 
                 if current_ciphertext is not None:
-                    self.cache.insert(current_ciphertext)
+                    self.cache.insert(current_ciphertext, path)
 
             else: # 已存在节点
                 return self._insert(original_ciphertext, original_ciphertext, self._random_insert_direction(), path)
 
 
+    def _insert_by_subtree(self, message, original_ciphertext, current_ciphertext, path):
+        """每次取回 current 以下 subtree_depth 层，在本地比较找到插入位置；走到已取回部分的边缘时再从边缘节点请求"""
+        if current_ciphertext == None: # 空树
+            return self._insert(None, original_ciphertext, None, path)
+
+        enc_current = self.encryption_scheme.encrypt(current_ciphertext)
+        depth = min(self.subtree_depth, protocol.MAX_SUBTREE_DEPTH) # 服务器截断的层不在响应中，不能当作空位
+        levels = 0 # 本次插入下降的层数，逐层遍历时每层一次交互
+        fetches = 0
+        while True:
+            ciphertexts, relative_paths = self._get_subtree(enc_current, depth)
+            fetches += 1
+            subtree = dict(zip(relative_paths, ciphertexts)) # {相对path: 密文}
+
+            relative_path = ''
+            node, enc_node = current_ciphertext, enc_current
+            while True:
+                if message == node: # 已存在节点
+                    self.round_trips_saved += levels - fetches
+                    return self._insert(original_ciphertext, original_ciphertext, self._random_insert_direction(), path + relative_path)
+
+                tighten_bounds(self.plan_bounds, message, node, enc_node)
+                bit, direction = ('0', "left") if message < node else ('1', "right")
+                enc_child = subtree.get(relative_path + bit)
+                if enc_child is None:
+                    if len(relative_path) + 1 < depth: # 已取回的层内没有该孩子，即为插入位
+                        self.round_trips_saved += levels + 1 - fetches # 逐层遍历还需一次交互才能确认孩子为空
+                        return self._insert(enc_node, original_ciphertext, direction, path + relative_path + bit)
+                    break # 到达边缘，从当前节点继续请求
+
+                relative_path += bit
+                levels += 1
+                node, enc_node = self.encryption_scheme.decrypt(enc_child), enc_child
+                self.cache.insert(node, path + relative_path)
+
+            path += relative_path
+            current_ciphertext, enc_current = node, enc_node
+
+
+    def batch_insert_message(self, messages):
+        while True:
+            self.plan_epoch = None
+            result = self._plan_and_batch_insert(messages)
+            if result is not RETRY:
+                self._count_inserted(len(messages))
+                return result
+            self.retries += 1
+            for message in messages:
+                self.cache.discard(message)
+            self.logger.debug(f'batch insert retry: {len(messages)} items')
+
+
+    def _plan_and_batch_insert(self, messages):
+        """
+        批量插入：本地按明文排序后逐个确定插入位置，全部 (锚点密文, 新密文, 方向) 在一条 batch_insert 消息中发送。
+        落在同一空位上的多个值依次以前一个值为锚点、作为其中序后继插入；位置查找在本批次共享的本地视图上进行，
+        视图缺失的部分通过 get_subtree 补齐，相邻的值基本不再产生交互
+        """
+        view = {} # {绝对path: 密文}：本批次已取回的树节点
+        plaintexts = {} # {绝对path: 明文}：按需解密
+        expanded = set() # 孩子已全部取回的节点path（取回的子树中未出现的孩子即为空）
+
+        items = []
+        bounds = [] # 与 items 对应：以已有节点为锚点时为该空位两侧节点的密文，用于服务器校验间隙
+        previous = None # (明文, 密文, 插入位)
+        for message in sorted(messages):
+            ciphertext = self.encryption_scheme.encrypt(message)
+            if previous is not None and message == previous[0]: # 批次内的重复值
+                items.append((ciphertext, ciphertext, self._random_insert_direction()))
+                bounds.append(None)
+                continue
+
+            gap = [None, None]
+            slot = self._locate_in_view(message, view, plaintexts, expanded, gap)
+            anchor, direction = slot
+            if anchor == ciphertext: # 树中已有的值
+                items.append((ciphertext, ciphertext, self._random_insert_direction()))
+                bounds.append(None)
+            elif previous is not None and previous[2] == slot: # 与上一个值落在同一空位
+                items.append((previous[1], ciphertext, "right"))
+                bounds.append(None)
+            else:
+                items.append((anchor, ciphertext, direction))
+                bounds.append(bound_ciphertexts(gap))
+            previous = (message, ciphertext, slot)
+            self.cache.insert(message)
+
+        client_message = protocol.ClientMessage()
+        client_message.batch_insert(items)
+        client_message.epoch = self.plan_epoch
+        client_message.bounds = bounds
+        return self._send_client_message(client_message)
+
+
+    def _locate_in_view(self, message, view, plaintexts, expanded, bounds):
+        """
+        在本地视图中查找 message 的插入位：返回 (父节点密文, 方向)；值已存在时返回 (该值密文, None)；空树返回 (None, None)。
+        经过的节点收紧 bounds（见 tighten_bounds）
+        """
+        depth = max(min(self.subtree_depth, protocol.MAX_SUBTREE_DEPTH), 2)
+        path = ''
+        if path not in expanded:
+            self._expand_view(None, path, depth, view, expanded)
+        if path not in view: # 空树
+            return None, None
+
+        while True:
+            plaintext = plaintexts.get(path)
+            if plaintext is None:
+                plaintext = plaintexts[path] = self.encryption_scheme.decrypt(view[path])
+            if message == plaintext:
+                return view[path], None
+
+            tighten_bounds(bounds, message, plaintext, view[path])
+            bit, direction = ('0', "left") if message < plaintext else ('1', "right")
+            if path + bit in view:
+                path += bit
+            elif path in expanded:
+                return view[path], direction
+            else: # 到达已取回部分的边缘
+                self._expand_view(view[path], path, depth, view, expanded)
+
+
+    def _expand_view(self, ciphertext, path, depth, view, expanded):
+        ciphertexts, relative_paths = self._get_subtree(ciphertext, depth)
+        for child_ciphertext, relative_path in zip(ciphertexts, relative_paths):
+            view[path + relative_path] = child_ciphertext
+            if len(relative_path) + 1 < depth:
+                expanded.add(path + relative_path)
+        expanded.add(path) # 空树时根节点同样视为已取回
+
+
     def _random_insert_direction(self):
         if random.random() > .5:
             return "left"
@@ -199,6 +449,12 @@ class Client:
         return self._send_client_message(client_message)
 
 
+    def _get_subtree(self, ciphertext, depth):
+        client_message = protocol.ClientMessage()
+        client_message.get_subtree(ciphertext, depth)
+        return self._send_client_message(client_message)
+
+
     def _move_left(self, ciphertext):
         client_message = protocol.ClientMessage()
         client_message.move_left(ciphertext)
@@ -210,82 +466,310 @@ class Client:
         return self._send_client_message(client_message)
 
     def _insert(self, current_ciphertext, new_ciphertext, direction, path):
-        logger.debug("Client insert, current_ciphertext=" + str(current_ciphertext) + ", new_ciphertext:" +
+        self.logger.debug("Client insert, current_ciphertext=" + str(current_ciphertext) + ", new_ciphertext:" +
             str(new_ciphertext) + ", direction:" + str(direction) + ", path:" + str(path))
         client_message = protocol.ClientMessage()
         client_message.insert(current_ciphertext, new_ciphertext, direction, path)
+        client_message.epoch = self.plan_epoch
+        if new_ciphertext != current_ciphertext:
+            client_message.bounds = bound_ciphertexts(self.plan_bounds)
         return self._send_client_message(client_message)
 
 
+    @protocol.handler(RESPONSE_HANDLERS, "insert")
+    def _on_node_response(self, recv_data):
+        # move_left/move_right/get_root/get_node/insert 的响应均为单个节点密文
+        if getattr(recv_data, 'retry', False):
+            return RETRY
+        root_ciphertext = recv_data.ciphertext
+        if root_ciphertext == None:
+            return None
+        else:
+            decrypted_text = self.encryption_scheme.decrypt(root_ciphertext)
+            return decrypted_text
+
+
+    @protocol.handler(RESPONSE_HANDLERS, "find_node_path")
+    def _on_find_node_path_response(self, recv_data):
+        path = recv_data.find_node_path # []
+        return path
+
+
+    @protocol.handler(RESPONSE_HANDLERS, "get_subtree")
+    def _on_subtree_response(self, recv_data):
+        # 密文不在此处解密，只解密遍历实际经过的节点
+        return recv_data.ciphertext, recv_data.find_node_path
+
+
+    @protocol.handler(RESPONSE_HANDLERS, "batch_insert")
+    def _on_batch_insert_response(self, recv_data):
+        if recv_data.retry:
+            return RETRY
+        return None
+
+
+    @protocol.handler(RESPONSE_HANDLERS, "get_common_node")
+    def _on_common_node_response(self, recv_data):
+        path = recv_data.find_node_path # path
+        decrypted_text = self.encryption_scheme.decrypt(recv_data.ciphertext)
+        return decrypted_text, path
+
+
+    @protocol.handler(RESPONSE_HANDLERS, "query")
+    @protocol.handler(RESPONSE_HANDLERS, "range_query")
+    def _on_query_response(self, recv_data):
+        if not recv_data.query_results:
+            self.logger.debug("Query results is empty.")
+            return None
+
+        # 解密查询结果
+        decrypted_results = []
+        for result in recv_data.query_results:
+            decrypted_record = {} # 字段名为明文，字段值为密文
+            for key, value in result.items():
+                # field_name = self.encryption_scheme.decrypt(self.key, key) if key else None
+                field_name = key
+                # 跳过字段名包含'ope_encoding'的字段的解密
+                if 'OPC' not in key and isinstance(value, bytes):
+                    field_value = self.encryption_scheme.decrypt(value) # if value else None
+                else:
+                    field_value = value
+                decrypted_record[field_name] = field_value
+            decrypted_results.append(decrypted_record)
+        print(decrypted_results)
+        return decrypted_results
+
+
     def _send_client_message(self, client_message):
         try:
-            logger.debug(f'Sending to Server: {client_message}')
-            server_message = pickle.dumps(client_message)
-            self.client_socket.sendall(server_message)
-
-            recv_message = self.client_socket.recv(4096)
-            recv_data = pickle.loads(recv_message)
-            logger.debug(f'Receiving from Server: {recv_data}')
-
-            if recv_data.message_type.__repr__() == protocol.MessageType("insert").__repr__():
-                root_ciphertext = recv_data.ciphertext
-                if root_ciphertext == None:
-                    return None
-                else:
-                    decrypted_text = self.encryption_scheme.decrypt(root_ciphertext)
-                    return decrypted_text
-
-            elif recv_data.message_type.__repr__() == protocol.MessageType("find_node_path").__repr__():
-                path = recv_data.find_node_path # []
-                return path
-
-            elif recv_data.message_type.__repr__() == protocol.MessageType("get_common_node").__repr__():
-                path = recv_data.find_node_path # path
-                decrypted_text = self.encryption_scheme.decrypt(recv_data.ciphertext)
-                return decrypted_text, path
-
-            elif recv_data.message_type.__repr__() == protocol.MessageType("query").__repr__() or recv_data.message_type.__repr__() == protocol.MessageType("range_query").__repr__():
-                if not recv_data.query_results:
-                    logger.debug("Query results is empty.")
-                    return None
-
-                # 解密查询结果
-                decrypted_results = []
-                for result in recv_data.query_results:
-                    decrypted_record = {} # 字段名为明文，字段值为密文
-                    for key, value in result.items():
-                        # field_name = self.encryption_scheme.decrypt(self.key, key) if key else None
-                        field_name = key
-                        # 跳过字段名包含'ope_encoding'的字段的解密
-                        if 'OPC' not in key and isinstance(value, bytes):
-                            field_value = self.encryption_scheme.decrypt(value) # if value else None
-                        else:
-                            field_value = value
-                        decrypted_record[field_name] = field_value
-                    decrypted_results.append(decrypted_record)
-                print(decrypted_results)
-                return decrypted_results
-            else:
-                logger.error(f'Unexpected message type: {recv_data.message_type}')
+            self.logger.debug(f'Sending to Server: {client_message}')
+            protocol.send_message(self.client_socket, client_message, self.codec)
+            self.round_trips += 1
+
+            recv_data = self.reader.recv_message(self.codec)
+            if recv_data is None:
+                raise EOFError('server closed the connection')
+            self.logger.debug(f'Receiving from Server: {recv_data}')
+            self.last_response = recv_data
+            invalidated = getattr(recv_data, 'invalidated', None)
+            if invalidated: # 其他插入引起的重排改变了这些子树中节点的path
+                self.cache.invalidate(invalidated)
+            self.epoch = getattr(recv_data, 'epoch', None)
+            if self.plan_epoch is None: # 本次规划中第一个响应的 epoch
+                self.plan_epoch = self.epoch
+
+            handler = self.RESPONSE_HANDLERS.get(recv_data.message_type.code)
+            if handler is None:
+                self.logger.error(f'Unexpected message type: {recv_data.message_type}')
                 return None
+            return handler(self, recv_data)
 
         except EOFError as eof_err:
-            logger.error(f'EOFError: {eof_err}. Connection closed unexpectedly by server')
+            self.logger.error(f'EOFError: {eof_err}. Connection closed unexpectedly by server')
             sys.exit(1)  # 1 表示程序错误退出，0 表示正常退出
         except pickle.UnpicklingError as unpickle_err:
-            logger.error(f'Pickle deserialization error: {unpickle_err}. Invalid data received')
+            self.logger.error(f'Pickle deserialization error: {unpickle_err}. Invalid data received')
             sys.exit(1)
         except socket.timeout as timeout_err:
-            logger.error(f'Socket timeout error: {timeout_err}. Server may be unresponsive')
+            self.logger.error(f'Socket timeout error: {timeout_err}. Server may be unresponsive')
             sys.exit(1)
         except socket.error as socket_err:
-            logger.error(f'Socket error: {socket_err}. Check network or server status')
+            self.logger.error(f'Socket error: {socket_err}. Check network or server status')
             sys.exit(1)
         except Exception as general_err:
-            logger.error(f'Unexpected error in _send_client_message: {general_err}')
+            self.logger.error(f'Unexpected error in _send_client_message: {general_err}')
             sys.exit(1)
 
 
+class AsyncClient:
+    """
+    基于 asyncio 的流水线客户端：每个请求带 request_id，同一连接上可同时有多个请求在途，
+    响应由接收任务按 request_id 交付给对应的等待者，允许乱序到达（需配合 python -m server.Server --async）。
+    相互独立的请求（不同值的遍历、多次 find_node_path/get_common_node）可并发发出，往返延迟相互重叠；
+    并发的插入各自携带规划时比较过的两侧节点，由服务器校验间隙，冲突时从服务器提示的起点重新规划（见 Client.insert_message）
+    """
+    def __init__(self, reader, writer, logger, codec='binary', max_in_flight=64):
+        self.encryption_scheme = encryption.BasicEncryptionScheme()
+        self.reader = reader
+        self.writer = writer
+        self.logger = logger
+        self.codec = protocol.get_codec(codec)
+        self.subtree_depth = 5 # 插入时 get_subtree 每次取回的层数
+        self.max_concurrent_inserts = 8 # insert_messages 同时规划、插入的值个数：同时在途的值越多，落入同一间隙而重试的越多
+        self.round_trips = 0
+        self.retries = 0
+        self.max_in_flight = max_in_flight # 同时在途的请求数上限
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.pending = {} # {request_id: Future}
+        self.next_request_id = 0
+        self.writer.writelines(protocol.frames(protocol.handshake(self.codec)))
+        self.receiver = asyncio.create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, address, logger, codec='binary', max_in_flight=64):
+        """address 为 tcp:<host>:<port> 或 unix:<path>"""
+        scheme, target = transport.parse_address(address)
+        if scheme == 'tcp':
+            reader, writer = await asyncio.open_connection(*target)
+        elif scheme == 'unix':
+            reader, writer = await asyncio.open_unix_connection(target)
+        else:
+            raise ValueError("AsyncClient does not support the shm transport, use tcp or unix")
+        return cls(reader, writer, logger, codec, max_in_flight)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.receiver.cancel()
+        try:
+            await self.receiver
+        except asyncio.CancelledError:
+            pass
+
+
+    async def _receive(self):
+        try:
+            while True:
+                payload = await protocol.read_frame_async(self.reader)
+                if payload is None:
+                    raise EOFError('server closed the connection')
+                recv_data = self.codec.decode(payload)
+                future = self.pending.pop(recv_data.request_id, None)
+                if future is None:
+                    self.logger.error(f'Unexpected response for request {recv_data.request_id}: {recv_data.message_type}')
+                elif not future.done():
+                    future.set_result(recv_data)
+        except Exception as err:
+            for future in self.pending.values(): # 连接断开时所有在途请求均失败
+                if not future.done():
+                    future.set_exception(ConnectionError(f'connection lost: {err!r}'))
+            self.pending.clear()
+            if not isinstance(err, EOFError):
+                raise
+
+
+    async def _send(self, client_message):
+        """发送请求并等待对应的响应，返回原始响应消息"""
+        async with self.in_flight:
+            if self.receiver.done():
+                raise ConnectionError('connection closed')
+            self.next_request_id += 1
+            client_message.request_id = self.next_request_id
+            future = asyncio.get_running_loop().create_future()
+            self.pending[client_message.request_id] = future
+            self.writer.writelines(protocol.frames(self.codec.encode(client_message)))
+            await self.writer.drain()
+            self.round_trips += 1
+            return await future
+
+
+    async def request(self, client_message):
+        """发送请求，返回经 Client 响应处理函数解析（解密）后的结果"""
+        recv_data = await self._send(client_message)
+        return Client.RESPONSE_HANDLERS[recv_data.message_type.code](self, recv_data)
+
+
+    async def find_node_path_message(self, messages):
+        client_message = protocol.ClientMessage()
+        client_message.find_node_path([self.encryption_scheme.encrypt(message) for message in messages])
+        return await self.request(client_message)
+
+
+    async def get_common_node(self, bound):
+        client_message = protocol.ClientMessage()
+        client_message.get_common_node([self.encryption_scheme.encrypt(message) for message in bound])
+        return await self.request(client_message)
+
+
+    async def query_message(self, message):
+        client_message = protocol.ClientMessage()
+        client_message.query(self.encryption_scheme.encrypt(message))
+        return await self.request(client_message)
+
+
+    async def insert_message(self, message):
+        start, bounds = None, [None, None] # 重试时从服务器提示的起点开始，已比较得到的两侧界保留
+        while True:
+            recv_data = await self._plan_and_insert(message, start, bounds)
+            if not recv_data.retry:
+                return None
+            self.retries += 1
+            start = recv_data.ciphertext
+            self.logger.debug(f'insert retry: {message}')
+
+
+    async def insert_messages(self, messages):
+        """并发插入多个值：max_concurrent_inserts 个插入任务按顺序依次取值，各自的遍历与插入同时在途，插入由服务器逐个校验"""
+        messages = iter(messages)
+
+        async def insert_worker():
+            for message in messages: # 共享同一迭代器，每个值只被一个任务取走
+                await self.insert_message(message)
+
+        await asyncio.gather(*(insert_worker() for _ in range(self.max_concurrent_inserts)))
+
+
+    async def _plan_and_insert(self, message, start, bounds):
+        ciphertext = self.encryption_scheme.encrypt(message)
+        anchor, direction, epoch = await self._locate(message, start, bounds)
+
+        client_message = protocol.ClientMessage()
+        if anchor is None: # 空树
+            client_message.insert(None, ciphertext, None, '')
+        elif direction is None: # 已存在节点
+            client_message.insert(ciphertext, ciphertext, random.choice(("left", "right")), '')
+        else:
+            client_message.insert(anchor, ciphertext, direction, '')
+        if direction is not None or anchor is None:
+            client_message.bounds = bound_ciphertexts(bounds)
+        client_message.epoch = epoch
+        return await self._send(client_message)
+
+
+    async def _locate(self, message, start, bounds):
+        """
+        与 Client._locate_in_view 相同的本地视图查找，从 start 节点（None 为根）开始，返回 (父节点密文, 方向, 规划 epoch)，
+        经过的节点收紧 bounds；epoch 取第一次取回时的 epoch，即规划所依据的最早的树版本
+        """
+        depth = max(min(self.subtree_depth, protocol.MAX_SUBTREE_DEPTH), 2)
+        view, plaintexts, expanded = {}, {}, set()
+        epoch = await self._expand_view(start, '', depth, view, expanded)
+        if '' not in view and start is not None: # 起点已不在树中，从根开始
+            view, expanded = {}, set()
+            epoch = await self._expand_view(None, '', depth, view, expanded)
+        if '' not in view: # 空树
+            return None, None, epoch
+
+        path = ''
+        while True:
+            plaintext = plaintexts.get(path)
+            if plaintext is None:
+                plaintext = plaintexts[path] = self.encryption_scheme.decrypt(view[path])
+            if message == plaintext:
+                return view[path], None, epoch
+
+            tighten_bounds(bounds, message, plaintext, view[path])
+            bit, direction = ('0', "left") if message < plaintext else ('1', "right")
+            if path + bit in view:
+                path += bit
+            elif path in expanded:
+                return view[path], direction, epoch
+            else:
+                await self._expand_view(view[path], path, depth, view, expanded)
+
+
+    async def _expand_view(self, ciphertext, path, depth, view, expanded):
+        client_message = protocol.ClientMessage()
+        client_message.get_subtree(ciphertext, depth)
+        recv_data = await self._send(client_message)
+        for child_ciphertext, relative_path in zip(recv_data.ciphertext, recv_data.find_node_path):
+            view[path + relative_path] = child_ciphertext
+            if len(relative_path) + 1 < depth:
+                expanded.add(path + relative_path)
+        expanded.add(path)
+        return recv_data.epoch
+
+
 def setup_logger():
     logger = logging.getLogger('client_logger')
     logger.setLevel(logging.INFO)
@@ -301,22 +785,25 @@ def setup_logger():
     return logger
 
 
-def socket_client(logger):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ip = '127.0.0.1'
-    port = 65432  # 必须与服务器端口号一致
-    client_socket.connect((ip, port))
-    logger.info('Client connected')
-
-    client = Client(client_socket, logger)
+def socket_client(logger, address="tcp:127.0.0.1:65432", cache_file=None, warm_up_depth=0):
+    # address 必须与服务器一致；同机部署时 unix:/shm: 传输可显著降低每次往返的延迟
+    client_socket = transport.connect(address)
+    logger.info(f'Client connected to {address}')
 
-    while True:
-        msg = input('>>').strip()
-        if not msg:
-            continue
-        handler_message(msg, logger, client)
+    client = Client(client_socket, logger, cache_file=cache_file)
+    if warm_up_depth > 0 or client.cache.skip_list:
+        logger.info(f'cache warmed up with {client.warm_up(warm_up_depth)} nodes')
 
-    client_socket.close()
+    try:
+        while True:
+            msg = input('>>').strip()
+            if not msg:
+                continue
+            handler_message(msg, logger, client)
+    except (KeyboardInterrupt, EOFError):
+        logger.info('Client closed')
+    finally:
+        client.close() # 写出缓存表，下次启动直接载入
 
 
 def handler_message(msg, logger, client):
@@ -331,6 +818,14 @@ def handler_message(msg, logger, client):
         else:
             client.insert_message(content)
 
+    elif msg.startswith("/batch_insert"): # /batch_insert file: dataset.txt
+        command = "/batch_insert"
+        content = msg[len(command):].strip()
+        if content.startswith("file:"):
+            handler_file_message(content, logger, client, batch_size=client.batch_size)
+        else:
+            client.batch_insert_message([item.strip() for item in content.split(',') if item.strip()])
+
     elif msg.startswith("/query"):
         command = "/query"
         content = msg[len(command):].strip()
@@ -356,7 +851,20 @@ def handler_message(msg, logger, client):
         client.insert_message(msg)
 
 
-def handler_file_message(content, logger, client):
+def read_batches(lines, batch_size):
+    batch = []
+    for data in lines:
+        if data:
+            batch.append(data)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def handler_file_message(content, logger, client, batch_size=None):
+    # batch_size 非空时每 batch_size 行通过一条 batch_insert 消息插入
     file_name = content[5:].strip()
     logger.info(f'insert file:{file_name}')
     file_path = os.path.join(os.getcwd(), "dataset", file_name)  # 正常运行时目录
@@ -366,15 +874,21 @@ def handler_file_message(content, logger, client):
         total_lines = 0  # 插入量统计
         with open(file_path, "r") as f:
             # for line in islice(f, 5000):
-            for line in islice(f, 1000):
-                data = line.strip()  # 行数据，以空格分割：data_items = line.strip().split(), for data in data_items
+            lines = (line.strip() for line in islice(f, 1000))  # 行数据，以空格分割：data_items = line.strip().split(), for data in data_items
+            if batch_size:
+                lines = read_batches(lines, batch_size)
+            for data in lines:
                 if data:
                     try:
                         logger.debug(f'The {total_lines}th insertion: data: {data}')
                         # logger.handlers[0].flush()  # 强制刷新日志
-                        client.insert_message(data)
+                        if batch_size:
+                            client.batch_insert_message(data)
+                            total_lines += len(data)
+                        else:
+                            client.insert_message(data)
+                            total_lines += 1
                         logger.debug(f'Inserted data: {data}')
-                        total_lines += 1
                         # if total_lines in [500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000]:
                         if total_lines in [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]:
                             cur_time = time.time()
@@ -383,8 +897,11 @@ def handler_file_message(content, logger, client):
                             # 性能统计打印
                             logger.info(f'Total lines inserted: {total_lines}')
                             logger.info(f'Time taken: {elapsed_time:.2f} seconds')
-                            logger.info(f'lookup_cache_taken: {client.lookup_cache_time} seconds')
+                            logger.info(f'lookup_cache_taken: {client.lookup_cache_time} seconds, cache: {client.cache.stats()}')
+                            logger.info(f'encryption cache: {client.encryption_scheme.cache_stats()}')
                             logger.info(f"Insertion rate: {total_lines / elapsed_time:.2f} /second")
+                            logger.info(f'round_trips per insert: {client.round_trips / total_lines:.2f}, '
+                                        f'saved by get_subtree(depth={client.subtree_depth}): {client.round_trips_saved / total_lines:.2f}')
 
                     except Exception as e:
                         # 捕获异常并记录完整的堆栈信息
@@ -397,5 +914,13 @@ def handler_file_message(content, logger, client):
         logger.error(f'Error reading file {file_path}: {e}')
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", default="tcp:127.0.0.1:65432", help="tcp:<host>:<port>、unix:<path> 或 shm:<path>")
+    parser.add_argument("--cache-file", default=os.path.join(os.path.dirname(__file__), "client.cache"),
+                        help="缓存表文件，空字符串表示不持久化；切换/清空数据表后需删除")
+    parser.add_argument("--warm-up", type=int, default=0, help="启动时取回树的前 N 层放入缓存表（N<=12），0 表示只刷新载入的缓存值的 path")
+    args = parser.parse_args()
+
     logger = setup_logger()
-    socket_client(logger)
\ No newline at end of file
+    socket_client(logger, args.address, args.cache_file or None, args.warm_up)
\ No newline at end of file
@@ -0,0 +1,130 @@
+import argparse
+import os
+import time
+from array import array
+from multiprocessing import Pool
+from server.db.db_manager import DatabaseManager
+from server.snapshot import write_snapshot, snapshot_path
+from server.encoding_transformer_utils import path_to_binary_data, ROOT_PATH, get_table_name
+
+"""
+离线批量导入：不经过逐条交互插入，直接按排序后的明文构建完全平衡的树。
+读取数据集 -> 多进程并行加密 -> 按明文排序去重 -> 按隐式平衡布局（区间中点为根）分配 path/OPC
+-> 分块批量写入空表 -> 写出服务器可直接加载的树快照。
+python -m client.bulk_load dataset.txt --workers 8
+"""
+
+_encryption_scheme = None # 每个工作进程各自的加密实例
+
+
+def _init_worker():
+    global _encryption_scheme
+    import client.encryption.encryption_scheme as encryption # 只在工作进程中加载加密依赖
+    _encryption_scheme = encryption.BasicEncryptionScheme(cache_enabled=False) # 每个值只加密一次，缓存无益
+
+
+def _encrypt_chunk(messages):
+    return [_encryption_scheme.encrypt(message) for message in messages]
+
+
+def read_dataset(file_path):
+    with open(file_path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def encrypt_all(messages, workers, chunk_size):
+    """并行加密，返回与 messages 一一对应的密文"""
+    chunks = [messages[start:start + chunk_size] for start in range(0, len(messages), chunk_size)]
+    with Pool(workers, initializer=_init_worker) as pool:
+        ciphertexts = []
+        for chunk in pool.imap(_encrypt_chunk, chunks):
+            ciphertexts.extend(chunk)
+    return ciphertexts
+
+
+def balanced_layout(n):
+    """
+    n 个有序值的完全平衡布局：区间 [lo, hi] 的中点为子树根。
+    先序返回 (下标, path, 高度, 规模)；规模为 m 的子树左右规模为 (m-1)//2 与 m//2，高度即 m.bit_length()
+    """
+    stack = [(0, n - 1, ROOT_PATH)] if n else []
+    while stack:
+        lo, hi, path = stack.pop()
+        mid = (lo + hi) // 2
+        size = hi - lo + 1
+        yield mid, path, size.bit_length(), size
+        if mid < hi:
+            stack.append((mid + 1, hi, (path << 1) | 1))
+        if lo < mid:
+            stack.append((lo, mid - 1, path << 1))
+
+
+def bulk_load(db_manager, table_name, messages, workers, chunk_size, snapshot_file):
+    results = db_manager.execute_query(f"SELECT MAX(id) FROM {table_name}")
+    if results and results[0][0] is not None:
+        raise ValueError(f"table '{table_name}' is not empty, bulk load only supports an empty table")
+
+    start_time = time.time()
+    ciphertexts = encrypt_all(messages, workers, chunk_size)
+    print(f'加密 {len(messages)} 条：{time.time() - start_time:.2f} seconds')
+
+    # 按明文排序去重，得到每个不同值在平衡树中的位置
+    start_time = time.time()
+    values = sorted(set(messages))
+    index = {message: i for i, message in enumerate(values)}
+    node_ciphertexts = [None] * len(values)
+    for message, ciphertext in zip(messages, ciphertexts):
+        node_ciphertexts[index[message]] = ciphertext
+
+    layout = list(balanced_layout(len(values))) # 先序
+    OPCs = [None] * len(values)
+    for i, path, _, _ in layout:
+        OPCs[i] = path_to_binary_data(path)
+    print(f'排序并分配 {len(values)} 个编码，树高 {len(values).bit_length()}：{time.time() - start_time:.2f} seconds')
+
+    # 按数据集顺序写入，显式指定 id（1..n），与快照中记录的 id 一致
+    start_time = time.time()
+    query = f"INSERT INTO {table_name}(id, insert_num, OPC) VALUES(%s, %s, %s)"
+    first_id = array('Q', bytes(8 * len(values))) # 每个值的第一个 id
+    duplicate_ids = {} # {下标: [其余 id]}
+    for start in range(0, len(messages), chunk_size):
+        params = []
+        for row_id in range(start + 1, min(start + chunk_size, len(messages)) + 1):
+            i = index[messages[row_id - 1]]
+            if first_id[i]:
+                duplicate_ids.setdefault(i, []).append(row_id)
+            else:
+                first_id[i] = row_id
+            params.append((row_id, ciphertexts[row_id - 1], OPCs[i]))
+        db_manager.execute_transaction([(query, params)])
+    print(f'写入 {len(messages)} 行：{time.time() - start_time:.2f} seconds')
+
+    start_time = time.time()
+    records = ((path, node_ciphertexts[i], [first_id[i]] + duplicate_ids.get(i, []), height, size)
+               for i, path, height, size in layout)
+    write_snapshot(snapshot_file, table_name, records, len(values), len(messages), len(messages))
+    print(f'写出快照 {snapshot_file}：{time.time() - start_time:.2f} seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量导入数据集并构建平衡树")
+    parser.add_argument("file", help="数据集文件，相对路径时依次在当前目录与 client/dataset 下查找")
+    parser.add_argument("--table", default=get_table_name())
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=10000, help="每个加密任务/每次写入的行数")
+    args = parser.parse_args()
+
+    file_path = args.file
+    if not os.path.exists(file_path):
+        file_path = os.path.join(os.path.dirname(__file__), "dataset", args.file)
+
+    messages = read_dataset(file_path)
+    db_manager = DatabaseManager()
+    try:
+        bulk_load(db_manager, args.table, messages, args.workers, args.chunk_size, snapshot_path(args.table))
+    finally:
+        db_manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
+from collections import OrderedDict
 from client.encryption.aes_encryption import AESEncryption
 from client.encryption.fpe import FPE
 from client.encryption.sm4_encryption import SM4Encryption
 
 
+CACHE_SIZE = 65536 # 每个方向最多缓存的条目数
+
+
 # Super basic encryption scheme.
 class BasicEncryptionScheme:
-    def __init__(self, key=None):
+    """
+    所用算法均为确定性加密，明文与密文一一对应：加解密结果缓存在双向的有界 LRU 表中，
+    一次插入遍历中反复出现的上层节点只需真正加/解密一次。cache_enabled=False 时每次都调用底层算法（用于测量算法本身的开销）
+    """
+    def __init__(self, key=None, cache_size=CACHE_SIZE, cache_enabled=True):
         self.key = key if key else AESEncryption.generate_key()
         # 确定性加密算法——AES
         # self.cipher = AESEncryption(self.key)
@@ -14,14 +22,57 @@ class BasicEncryptionScheme:
         # 确定性加密算法——FPE(SM4)
         self.cipher = FPE(self.key)
 
+        self.cache_enabled = cache_enabled
+        self.cache_size = cache_size
+        self.encrypt_cache = OrderedDict() # {明文: 密文}
+        self.decrypt_cache = OrderedDict() # {密文: 明文}
+        self.hits = 0
+        self.misses = 0
+
 
     def encrypt(self, message):
         # return message
-        return self.cipher.encrypt(message)
+        if not self.cache_enabled:
+            return self.cipher.encrypt(message)
+        ciphertext = self.encrypt_cache.get(message)
+        if ciphertext is not None:
+            self.hits += 1
+            self.encrypt_cache.move_to_end(message)
+            return ciphertext
+        self.misses += 1
+        ciphertext = self.cipher.encrypt(message)
+        self._remember(message, ciphertext)
+        return ciphertext
 
     def decrypt(self, ciphertext):
         # return ciphertext
-        return self.cipher.decrypt(ciphertext)
+        if not self.cache_enabled:
+            return self.cipher.decrypt(ciphertext)
+        message = self.decrypt_cache.get(ciphertext)
+        if message is not None:
+            self.hits += 1
+            self.decrypt_cache.move_to_end(ciphertext)
+            return message
+        self.misses += 1
+        message = self.cipher.decrypt(ciphertext)
+        self._remember(message, ciphertext)
+        return message
+
+    def _remember(self, message, ciphertext):
+        # 一个方向的结果同时记入另一方向：解密得到的节点明文随后再次加密时直接命中
+        self.encrypt_cache[message] = ciphertext
+        self.encrypt_cache.move_to_end(message)
+        self.decrypt_cache[ciphertext] = message
+        self.decrypt_cache.move_to_end(ciphertext)
+        if len(self.encrypt_cache) > self.cache_size:
+            self.encrypt_cache.popitem(last=False)
+        if len(self.decrypt_cache) > self.cache_size:
+            self.decrypt_cache.popitem(last=False)
+
+    def cache_stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self.encrypt_cache)}
 
     def generate_key(self):
         return self.key
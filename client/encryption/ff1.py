@@ -2,7 +2,6 @@ from Crypto.Cipher import AES
 import math
 import string
 import logging
-from Crypto.Util.number import bytes_to_long
 
 
 logger = logging.getLogger(__name__)
@@ -35,6 +34,8 @@ class FF1:
 
         if not (tweak == None or 2 <= len(tweak) <= self.max_tweak_len):
             raise ValueError(f"tweak length must be between 2 and {self.max_tweak_len}, but got {len(tweak)}")
+        self.tweak_bytes = b'' if tweak is None else bytes.fromhex(tweak) # 十六进制 tweak 只解码一次
+        self.length_params = {} # {消息长度 n: 与 n 相关的常量}，见 get_length_params
 
         # Alphabet depending on radix
         self.radix = radix
@@ -59,6 +60,16 @@ class FF1:
         if(self.minLen < 2) or (self.maxLen < self.minLen):
             raise ValueError(f"minLen or maxLen invalid, adjust your radix")
 
+    @property
+    def alphabet(self):
+        return self._alphabet
+
+    @alphabet.setter
+    def alphabet(self, alphabet):
+        # 字符到数值的映射随字母表一起更新，num() 不必每次重建
+        self._alphabet = alphabet
+        self.char_to_value = {char: i for i, char in enumerate(alphabet)}
+
     # 工厂方法：创建一个带有自定义字母表的FF1_AES对象
     @staticmethod
     def withCustomAlphabet(key, tweak, alphabet):
@@ -117,43 +128,32 @@ class FF1:
         input: message--数值型字符串、tweak--字节字符串
         output: ciphertext--数值型字符串
         """
-        if self.tweak is None:
-            tweak = b''
-        else:
-            tweak = bytes.fromhex(self.tweak) # 将十六进制字符串转为字节序列
-
         n = len(message)
         if n < self.minLen or n > self.maxLen:
             raise ValueError(f"message length {n} is not within min {self.minLen} and"
                              f"max {self.maxLen} bounds")
 
-        logger.debug(f"radix = {self.radix}")
-        logger.debug(f"encrypt...")
+        logger.debug("radix = %s", self.radix)
+        logger.debug("encrypt...")
 
         # 将明文分为左右两部分
         left, right, len_left, len_right = self.split_string(message)
 
         # 可加入对tweak的处理：长度、分割Tl和Tr
 
-        # 计算编码后的左侧部分长度--b
-        right_after_encoded_length = self.calculate_right_length(len_right, self.radix)
-
-        # 计算d
-        d = 4 * math.ceil(right_after_encoded_length / 4) + 4
+        # b、d、P 及 Q 的前缀只与长度有关，按长度缓存
+        right_after_encoded_length, d, padding, q_prefix, moduli = self.get_length_params(n)
 
-        # 生成初始填充--P(字节字符串)
-        padding = self.generate_initial_padding(self.radix, len(message), len(tweak) if tweak else 0, len_left)
-
-        logger.debug(f"b={right_after_encoded_length}, d={d}, padding: {padding}")
+        logger.debug("b=%s, d=%s, padding: %s", right_after_encoded_length, d, padding)
 
         # Feistel网络
         for round in range(self.NUM_ROUNDS):
-            logger.debug(f"round {round}")
+            logger.debug("round %s", round)
 
             # 计算--y(数值型字符串)
             round_numeral = self.round_numeral(
                 right,
-                tweak,
+                q_prefix,
                 padding,
                 right_after_encoded_length, # b
                 d,
@@ -162,7 +162,7 @@ class FF1:
 
             # 计算m、c，如果需要对tweak处理，应该包含在m的处理中
             partial_length = len_left if round % 2 == 0 else len_right
-            partial_numeral = (self.num(left, self.radix) + round_numeral) % (self.radix ** partial_length)
+            partial_numeral = (self.num(left, self.radix) + round_numeral) % moduli[round % 2]
 
             # 计算C
             partial_block = self.str_m_radix(partial_length, self.radix, partial_numeral)
@@ -171,7 +171,7 @@ class FF1:
             left = right
             right = partial_block
 
-            logger.debug(f"left: {left}, right: {right}")
+            logger.debug("left: %s, right: %s", left, right)
 
         # 返回加密后的结果（左右部分拼接）
         return ''.join(left + right)
@@ -184,11 +184,6 @@ class FF1:
         input: ciphertext--数值型字符串、tweak--字节字符串
         output: message--数值型字符串
         """
-        if self.tweak is None:
-            tweak = b''
-        else:
-            tweak = bytes.fromhex(self.tweak) # 将十六进制字符串转为字节序列
-
         n = len(ciphertext)
         if n < self.minLen or n > self.maxLen:
             raise ValueError(f"ciphertext length {n} is not within min {self.minLen} and"
@@ -198,32 +193,26 @@ class FF1:
         """ 此处忽略对tweak的长度范围检查"""
 
 
-        logger.debug(f"Decrypt...")
+        logger.debug("Decrypt...")
 
         # 将密文分为左右两部分
         left, right, len_left, len_right = self.split_string(ciphertext)
 
         # 可加入对tweak的处理：长度、分割Tl和Tr
 
-        # 计算编码后的左侧部分长度--b
-        right_after_encoded_length = self.calculate_right_length(len_right, self.radix)
-
-        # 计算d
-        d = 4 * math.ceil(right_after_encoded_length / 4) + 4
-
-        # 生成初始填充--P(字节字符串)
-        padding = self.generate_initial_padding(self.radix, len(ciphertext), len(tweak) if tweak else 0, len_left)
+        # b、d、P 及 Q 的前缀只与长度有关，按长度缓存
+        right_after_encoded_length, d, padding, q_prefix, moduli = self.get_length_params(n)
 
-        logger.debug(f"b={right_after_encoded_length}, d={d}, padding: {padding}")
+        logger.debug("b=%s, d=%s, padding: %s", right_after_encoded_length, d, padding)
 
         # Feistel网络
         for round in range(self.NUM_ROUNDS - 1, -1, -1):
-            logger.debug(f"round {round}")
+            logger.debug("round %s", round)
 
             # 计算--y(数值型字符串)
             round_numeral = self.round_numeral(
                 left,
-                tweak,
+                q_prefix,
                 padding,
                 right_after_encoded_length, # b
                 d,
@@ -232,7 +221,7 @@ class FF1:
 
             # 计算m、c，如果需要对tweak处理，应该包含在m的处理中
             partial_length = len_left if round % 2 == 0 else len_right
-            partial_numeral = (self.num(right, self.radix) - round_numeral) % (self.radix ** partial_length)
+            partial_numeral = (self.num(right, self.radix) - round_numeral) % moduli[round % 2]
 
             # 计算C
             partial_block = self.str_m_radix(partial_length, self.radix, partial_numeral)
@@ -241,7 +230,7 @@ class FF1:
             right = left
             left = partial_block
 
-            logger.debug(f"left: {left}, right: {right}")
+            logger.debug("left: %s, right: %s", left, right)
 
         # 返回加密后的结果（左右部分拼接）
         return ''.join(left + right)
@@ -255,9 +244,36 @@ class FF1:
 
         A = message[:u]
         B = message[u:]
-        logger.debug(f"A: {A}, B: {B}, len_A={u}, len_B={v}")
+        logger.debug("A: %s, B: %s, len_A=%s, len_B=%s", A, B, u, v)
         return A, B, u, v
 
+    def get_length_params(self, n):
+        """
+        长度为 n 的消息在各轮中不变的常量：b、d、P、Q 中 round 之前的部分（T || 0 填充）、
+        偶数轮与奇数轮的模数 radix^u 和 radix^v；密钥、tweak、radix 固定，按 n 缓存
+        """
+        params = self.length_params.get(n)
+        if params is None:
+            len_left = n // 2
+            len_right = n - len_left
+
+            # 计算编码后的右侧部分长度--b
+            b = self.calculate_right_length(len_right, self.radix)
+
+            # 计算d
+            d = 4 * math.ceil(b / 4) + 4
+
+            # 生成初始填充--P(字节字符串)
+            padding = self.generate_initial_padding(self.radix, n, len(self.tweak_bytes), len_left)
+
+            # Q = T || [0]^(−t−b−1 mod 16) || [i]^1 || [NUM(B)]^b
+            zero_padding_length = self.mod(-len(self.tweak_bytes) - b - 1, 16)
+            q_prefix = self.tweak_bytes + bytes(zero_padding_length)
+
+            params = self.length_params[n] = (b, d, padding, q_prefix,
+                                              (self.radix ** len_left, self.radix ** len_right))
+        return params
+
     def calculate_right_length(self, len_right, radix):
         # 计算编码后左侧部分的长度--b
         return math.ceil(len_right * math.ceil(math.log2(radix)) / 8.0)
@@ -286,30 +302,26 @@ class FF1:
 
         return value.to_bytes(length, byteorder='big') # byteorder='big' 表示使用大端字节序（即高位字节在前）
 
-    def round_numeral(self, target_block_numeral, tweak, padding, right_after_encoded_length, d, round):
+    def round_numeral(self, target_block_numeral, q_prefix, padding, right_after_encoded_length, d, round):
         """ 计算--y """
         # 计算--Q（字节字符串）
-        q = self.generate_q(tweak, target_block_numeral, right_after_encoded_length, round)
-        logger.debug(f"Q={q}")
+        q = self.generate_q(q_prefix, target_block_numeral, right_after_encoded_length, round)
+        logger.debug("Q=%s", q)
 
         # 通过轮函数计算当前轮的加密块（bytes）--计算R、S
         round_block = self.round_function(padding, q, d)
 
         # 返回长度为d的round_block并转换为整数
         s = round_block[:d]
-        y = bytes_to_long(s) # 字节序列转换为整数
-        logger.debug(f"S={s}, y={y}")
+        y = int.from_bytes(s, 'big') # 字节序列转换为整数
+        logger.debug("S=%s, y=%s", s, y)
 
         return y
 
-    def generate_q(self, tweak, target_block_numeral, right_after_encoded_length, round):
-        """ 计算--Q(字节字符串) """
-        # 计算 mod(- len(tweak) - length_of_left_after_encoded - 1, 16)
-        len_tweak = len(tweak)
-        zero_padding_length = self.mod(-len_tweak - right_after_encoded_length - 1, 16)
-
+    def generate_q(self, q_prefix, target_block_numeral, right_after_encoded_length, round):
+        """ 计算--Q(字节字符串)，q_prefix 为 T || [0]^(−t−b−1 mod 16)，见 get_length_params """
         # 构建 Q
-        q = tweak + self.number_to_array_of_bytes(0, zero_padding_length) \
+        q = q_prefix \
             + self.number_to_array_of_bytes(round, 1) \
             + self.number_to_array_of_bytes(self.num(target_block_numeral, self.radix), right_after_encoded_length)
 
@@ -332,7 +344,7 @@ class FF1:
             xor_result = self.xor(r, self.number_to_array_of_bytes(j, 16))
             s += self.aes.encrypt(xor_result)
 
-        logger.debug(f"R={r}, s={s}")
+        logger.debug("R=%s, s=%s", r, s)
         return s # 返回加密后的字节序列
 
     def str_m_radix(self, m, radix, x):
@@ -341,9 +353,10 @@ class FF1:
             raise ValueError(f"x={x} is out of range [0, {radix ** m}].")
 
         result = [0] * m
+        alphabet = self.alphabet
 
         for i in range(m):
-            result[m - 1 - i] = self.alphabet[x % radix]
+            result[m - 1 - i] = alphabet[x % radix]
             x = x // radix
 
         return ''.join(result)
@@ -357,9 +370,7 @@ class FF1:
 
     def num(self, value, radix):
         """ 把 value 转换为以 radix 为基数的整数 """
-        char_to_value = {}
-        if self.alphabet:
-            char_to_value = {char : i for i, char in enumerate(self.alphabet)}
+        char_to_value = self.char_to_value
         # if radix <= 10:
         #     return int(value, radix)
         #
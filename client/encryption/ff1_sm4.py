@@ -25,7 +25,7 @@ class FF1_SM4(FF1):
             xor_result = self.xor(r, self.number_to_array_of_bytes(j, 16))
             s += self.sm4.encrypt(xor_result)
 
-        logger.debug(f"R={r}, s={s}")
+        logger.debug("R=%s, s=%s", r, s)
         return s # 返回加密后的字节序列
 
 
@@ -11,28 +11,29 @@ class FPE:
         self.algorithm = algorithm.upper()
         if self.algorithm not in ["AES", "SM4"]:
             raise ValueError("Unsupported algorithm. Use 'AES' or 'SM4'.")
+        # {(key, tweak, 字母表): FF1 对象}：字母表只有三种，每种只构造一次分组密码对象；
+        # FF1 对象内部再按消息长度缓存 b、d、P 等常量
+        self.ciphers = {}
 
 
     def encrypt(self, message):
-        alphabet = self.get_alphabet(message)
-
-        if self.algorithm == "AES":
-            cipher = FF1_AES.withCustomAlphabet(self.key, self.tweak, alphabet)
-        else:
-            cipher = FF1_SM4.withCustomAlphabet(self.key, self.tweak, alphabet)
-
-        return cipher.encrypt(message)
+        return self.get_cipher(self.get_alphabet(message)).encrypt(message)
 
 
     def decrypt(self, ciphertext):
-        alphabet = self.get_alphabet(ciphertext)
+        return self.get_cipher(self.get_alphabet(ciphertext)).decrypt(ciphertext)
 
-        if self.algorithm == "AES":
-            cipher = FF1_AES.withCustomAlphabet(self.key, self.tweak, alphabet)
-        else:
-            cipher = FF1_SM4.withCustomAlphabet(self.key, self.tweak, alphabet)
 
-        return cipher.decrypt(ciphertext)
+    def get_cipher(self, alphabet):
+        cache_key = (self.key, self.tweak, alphabet)
+        cipher = self.ciphers.get(cache_key)
+        if cipher is None:
+            if self.algorithm == "AES":
+                cipher = FF1_AES.withCustomAlphabet(self.key, self.tweak, alphabet)
+            else:
+                cipher = FF1_SM4.withCustomAlphabet(self.key, self.tweak, alphabet)
+            self.ciphers[cache_key] = cipher
+        return cipher
 
 
     def get_alphabet(self, message):
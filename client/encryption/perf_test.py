@@ -3,6 +3,8 @@ import time
 from client.encryption.aes_encryption import AESEncryption
 from client.encryption.sm4_encryption import SM4Encryption
 from client.encryption.fpe import FPE
+from client.encryption.ff1_sm4 import FF1_SM4
+from client.encryption.encryption_scheme import BasicEncryptionScheme
 import os
 
 
@@ -75,6 +77,57 @@ class TestEncryptionPerformance(unittest.TestCase):
             cipher.encrypt(message)
 
 
+    def per_message(self, name, new_cipher):
+        """ 每条消息的加密耗时：复用同一密码对象（缓存的分组密码、按长度缓存的 b、d、P） vs 每条消息新建（重建全部状态） """
+        cached = new_cipher()
+        start = time.perf_counter()
+        for message in self.messages:
+            cached.encrypt(message)
+        cached_time = (time.perf_counter() - start) / max(len(self.messages), 1)
+
+        start = time.perf_counter()
+        for message in self.messages:
+            new_cipher().encrypt(message)
+        uncached_time = (time.perf_counter() - start) / max(len(self.messages), 1)
+
+        print(f'{name}: cached {cached_time * 1e6:.1f} us/message, '
+              f'rebuilt {uncached_time * 1e6:.1f} us/message, speedup {uncached_time / max(cached_time, 1e-9):.2f}x')
+
+
+    def test_ff1_aes_cached(self):
+        self.per_message('FPE-AES', lambda: FPE(self.key, "AES"))
+
+
+    def test_ff1_sm4_cached(self):
+        self.per_message('FPE-SM4', lambda: FPE(self.key, "SM4"))
+
+
+    def test_ff1_sm4_direct_cached(self):
+        """ 直接构造 FF1_SM4（轮函数为 SM4，轮密钥只生成一次）：withCustomAlphabet 返回的是基类 FF1 """
+        self.per_message('FF1_SM4', lambda: FF1_SM4(self.key, None, FF1_SM4.BASE62_LEN))
+
+
+    def traversal(self, scheme):
+        """ 模拟插入遍历：每个值插入前都要加/解密经过的上层节点 """
+        upper = self.messages[:15]
+        for message in self.messages:
+            for node in upper:
+                scheme.decrypt(scheme.encrypt(node))
+            scheme.encrypt(message)
+
+
+    @timeit
+    def test_basic_scheme_cached(self):
+        scheme = BasicEncryptionScheme(self.key)
+        self.traversal(scheme)
+        print(scheme.cache_stats())
+
+
+    @timeit
+    def test_basic_scheme_uncached(self):
+        self.traversal(BasicEncryptionScheme(self.key, cache_enabled=False))
+
+
     @unittest.skip
     def test_print_message(self):
         """ 测试并打印消息内容 """
@@ -6,15 +6,18 @@ class SM4Encryption:
         if len(key) != 16:
             raise ValueError("Key must be 16 bytes long")
         self.key = key
-        self.cipher = CryptSM4()
+        # 加密、解密各用一个 CryptSM4，轮密钥只在构造时生成一次，不必每次调用 set_key
+        self.encryptor = CryptSM4()
+        self.encryptor.set_key(key, SM4_ENCRYPT)
+        self.decryptor = CryptSM4()
+        self.decryptor.set_key(key, SM4_DECRYPT)
         # self.iv = b'\xc9?\x7fHc\xa5\x00\x7f\x15gQ\xe5\xb2\xa3\xd3\x8f'  # 16 字节固定 IV
 
     def encrypt(self, message):
         # try:
-        self.cipher.set_key(self.key, SM4_ENCRYPT)
         if isinstance(message, str):
             message = message.encode('utf-8')
-        ciphertext = self.cipher.crypt_ecb(message)
+        ciphertext = self.encryptor.crypt_ecb(message)
         return ciphertext
         # except Exception as e:
         #     raise RuntimeError(f"Encrypt error: {e}")
@@ -22,8 +25,7 @@ class SM4Encryption:
 
     def decrypt(self, ciphertext):
         # try:
-        self.cipher.set_key(self.key, SM4_DECRYPT)
-        plaintext = self.cipher.crypt_ecb(ciphertext)
+        plaintext = self.decryptor.crypt_ecb(ciphertext)
         return plaintext.decode('utf-8', errors='ignore')
         # except Exception as e:
         #     raise RuntimeError(f"Decrypt error: {e}")
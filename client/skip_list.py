@@ -1,29 +1,83 @@
-from sortedcontainers import SortedList
+import os
+import sys
+import mmap
+import heapq
+import struct
+from sortedcontainers import SortedList, SortedDict
+
+MAX_ENTRIES = 100_000 # 缓存表默认最多保存的值个数
+ENTRY_OVERHEAD = 120 # 每个缓存值在 SortedList、元数据字典中的近似额外开销（字节）
+EVICT_FRACTION = 8 # 超出预算时一次淘汰 1/8，摊销淘汰时的排序开销
+PROTECTED_DEPTH = 6 # 树的上层节点（深度小于该值，至多 63 个）不被淘汰：几乎每次遍历都会经过
+UNKNOWN_DEPTH = 64 # 深度未知的值（客户端自己插入的值）按叶子处理
+
+"""
+缓存表文件（小端）：头部 魔数 b'OPEC' | 版本 H | 值个数 Q；记录按值升序：值类型 B | 值长度 I | 值 | 深度 B。
+path 不写入文件：重启期间树可能已被其他客户端重排，载入后 path 一律视为未知，由之后的遍历或预热重新取得
+"""
+CACHE_MAGIC = b'OPEC'
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<4sHQ')
+CACHE_RECORD = struct.Struct('<BI')
+CACHE_DEPTH = struct.Struct('<B')
+VALUE_STR = 0
+VALUE_BYTES = 1
 
 
 class skipList:
-    def __init__(self, logger):
+    def __init__(self, logger, max_entries=MAX_ENTRIES, max_bytes=None):
         self.skip_list = SortedList()
         self.lower = None
         self.upper = None
         self.logger = logger
-        self.N = 2000
+        self.N = max_entries # 值个数预算，None 表示不限
+        self.max_bytes = max_bytes # 近似内存预算（字节），None 表示不限
+        self.entries = {} # {值: [深度, 最近一次命中的时刻, path]}，path 为 None 表示未知或已失效
+        self.paths = SortedDict() # {path: 值}：只含有效的 path，同一前缀下的 path 在其中连续
+        self.bytes = 0
+        self.tick = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def insert(self, value, path=None):
+        # path 为该值在树中的 path 字符串（根为 ''），其长度即深度，用于定位交互起点及淘汰时保留上层节点
+        self.tick += 1
+        entry = self.entries.get(value)
+        if entry is not None:
+            entry[1] = self.tick
+            if path is not None:
+                self._set_path(value, entry, path)
+            return
+
+        self.skip_list.add(value)
+        entry = self.entries[value] = [UNKNOWN_DEPTH, self.tick, None]
+        if path is not None:
+            self._set_path(value, entry, path)
+        self.bytes += sys.getsizeof(value) + ENTRY_OVERHEAD
+        if self._over_budget():
+            self._evict()
+        self._update_bounds()
 
-    def insert(self, value):
-        if value not in self.skip_list:
-            self.skip_list.add(value)
-            # 更新边界值
-            self.lower = self.skip_list[0]
-            self.upper = self.skip_list[-1]
+    def discard(self, value):
+        if value in self.entries:
+            self._remove(value)
+            self._update_bounds()
 
     def search(self, value):
+        self.tick += 1
         if len(self.skip_list) < 2:
+            self.misses += 1
             return None, None
 
         if value < self.lower or value > self.upper:
+            self.misses += 1
             return None, None
 
+        self.hits += 1
         if value == self.lower or value == self.upper:
+            self._touch(value)
             return value, value
 
         idx = self.skip_list.bisect_left(value)
@@ -32,6 +86,138 @@ class skipList:
         right = self.skip_list[idx] if idx < len(self.skip_list) else None
 
         if left == value or right == value:
+            self._touch(value)
             return value, value
 
-        return left, right
\ No newline at end of file
+        # 命中的区间两端均刷新最近命中时刻
+        self._touch(left)
+        self._touch(right)
+        return left, right
+
+    def path_of(self, value):
+        entry = self.entries.get(value)
+        return entry[2] if entry is not None else None
+
+    def value_at(self, path):
+        return self.paths.get(path)
+
+    def invalidate(self, prefixes):
+        """服务器告知的被重排子树根 path：以其为前缀的缓存 path 均已改变，值仍保留在缓存中"""
+        for prefix in prefixes:
+            for path in list(self.paths.irange(prefix, prefix + '2', inclusive=(True, False))): # '2' 大于 '0'/'1'
+                self.entries[self.paths.pop(path)][2] = None
+
+    def clear(self):
+        self.skip_list.clear()
+        self.entries.clear()
+        self.paths.clear()
+        self.bytes = 0
+        self._update_bounds()
+
+    def save(self, file_path):
+        '''写出缓存表：先写临时文件再原子替换'''
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(self.skip_list)))
+            for value in self.skip_list:
+                depth = self.entries[value][0]
+                if isinstance(value, str):
+                    value_type, data = VALUE_STR, value.encode('utf-8')
+                else:
+                    value_type, data = VALUE_BYTES, bytes(value)
+                f.write(CACHE_RECORD.pack(value_type, len(data)))
+                f.write(data)
+                f.write(CACHE_DEPTH.pack(min(depth, 255)))
+        os.replace(tmp_path, file_path)
+
+    def load(self, file_path):
+        '''mmap 读取缓存表文件替换当前内容，文件不存在或格式不符时返回 False'''
+        if not os.path.exists(file_path) or os.path.getsize(file_path) < CACHE_HEADER.size:
+            return False
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, count = CACHE_HEADER.unpack_from(data, 0)
+            if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                self.logger.error(f'ignore cache file {file_path}: unsupported format')
+                return False
+            offset = CACHE_HEADER.size
+            values = []
+            entries = {}
+            size = 0
+            for _ in range(count):
+                value_type, length = CACHE_RECORD.unpack_from(data, offset)
+                offset += CACHE_RECORD.size
+                value = data[offset:offset + length]
+                value = value.decode('utf-8') if value_type == VALUE_STR else value
+                offset += length
+                (depth,) = CACHE_DEPTH.unpack_from(data, offset)
+                offset += CACHE_DEPTH.size
+                values.append(value)
+                entries[value] = [depth, 0, None]
+                size += sys.getsizeof(value) + ENTRY_OVERHEAD
+
+        self.clear()
+        self.skip_list.update(values) # 文件中已有序
+        self.entries = entries
+        self.bytes = size
+        if self._over_budget():
+            self._evict()
+        self._update_bounds()
+        return True
+
+    def stats(self):
+        return {'entries': len(self.skip_list), 'bytes': self.bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def _update_bounds(self):
+        # 更新边界值
+        self.lower = self.skip_list[0] if self.skip_list else None
+        self.upper = self.skip_list[-1] if self.skip_list else None
+
+    def _set_path(self, value, entry, path):
+        if entry[2] is not None and self.paths.get(entry[2]) == value:
+            del self.paths[entry[2]]
+        stale = self.paths.get(path) # 该 path 上原来的值已被移走
+        if stale is not None and stale != value:
+            self.entries[stale][2] = None
+        self.paths[path] = value
+        entry[0] = len(path)
+        entry[2] = path
+
+    def _touch(self, value):
+        entry = self.entries.get(value)
+        if entry is not None:
+            entry[1] = self.tick
+
+    def _remove(self, value):
+        self.skip_list.remove(value)
+        path = self.entries.pop(value)[2]
+        if path is not None:
+            del self.paths[path]
+        self.bytes -= sys.getsizeof(value) + ENTRY_OVERHEAD
+
+    def _over_budget(self):
+        return (self.N is not None and len(self.skip_list) > self.N) or \
+               (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def _evict(self):
+        """
+        淘汰一批值，直到低于预算的 7/8：上层节点优先保留，其余按最近命中时刻从旧到新、同一时刻先淘汰深的节点。
+        被淘汰的值只会使之后的查找区间变宽（交互次数增加），不影响正确性
+        """
+        target = len(self.skip_list) - max(len(self.skip_list) // EVICT_FRACTION, 1)
+        if self.N is not None:
+            target = min(target, self.N - self.N // EVICT_FRACTION)
+        if self.max_bytes is not None:
+            average = self.bytes / len(self.skip_list)
+            target = min(target, int((self.max_bytes - self.max_bytes // EVICT_FRACTION) / average))
+        count = len(self.skip_list) - max(target, 0)
+
+        candidates = ((last_hit, -depth, value) for value, (depth, last_hit, _) in self.entries.items()
+                      if depth >= PROTECTED_DEPTH)
+        victims = heapq.nsmallest(count, candidates)
+        if len(victims) < count: # 预算小于上层节点数时上层节点同样参与淘汰
+            victims = heapq.nsmallest(count, ((last_hit, -depth, value) for value, (depth, last_hit, _) in self.entries.items()))
+        for _, _, value in victims:
+            self._remove(value)
+        self.evictions += len(victims)
+        self.logger.debug(f'cache evicted {len(victims)} entries, {len(self.skip_list)} left')
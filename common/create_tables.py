@@ -1,4 +1,5 @@
 import mysql.connector
+from server.encoding_transformer_utils import OPC_column_type
 
 # 数据库连接配置
 config = {
@@ -28,7 +29,7 @@ try:
             table_structure = (f'CREATE TABLE IF NOT EXISTS {table_name} ('
                                f'id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
                                f'insert_num VARBINARY(130) DEFAULT NULL, '
-                               f'OPC BINARY(4) NOT NULL'
+                               f'OPC {OPC_column_type()} NOT NULL'
                                f');')
 
             create_table_query = table_structure.format(table_name=table_name)
@@ -0,0 +1,43 @@
+from server.db.db_manager import DatabaseManager
+from server.rebalance import OPC_update_statements
+from server.encoding_transformer_utils import OPC_column_type, OPC_VAR_MAX_BYTES, OPC_WIDTH
+from server.encoding_transformer_utils import binary_data_to_path, path_to_binary_data, get_table_name
+
+"""
+将表中已有的 OPC 迁移为 server/encoding_transformer_utils.py 中 OPC_WIDTH 配置的编码：
+python -m common.migrate_opc
+"""
+
+
+def migrate_opc(db_manager, table_name):
+    # 按原有字节数解码出 path，再按新宽度重新编码（树过深无法编码时在修改表结构之前报错）
+    results = db_manager.execute_query(f"SELECT insert_num, OPC FROM {table_name}")
+    opc_updates = {}
+    for insert_num, OPC in results:
+        opc_updates[insert_num] = path_to_binary_data(binary_data_to_path(OPC))
+
+    # 先改为变长列（不改变已有字节），写入新编码后再改为目标列类型；
+    # execute_transaction 失败时回滚并抛出异常，任一步失败即停止，不再执行后续步骤
+    widen_query = f"ALTER TABLE {table_name} MODIFY OPC VARBINARY({OPC_VAR_MAX_BYTES}) NOT NULL"
+    target_query = f"ALTER TABLE {table_name} MODIFY OPC {OPC_column_type()} NOT NULL"
+    steps = [
+        ("改为变长列", [(widen_query, [()])], "表未修改"),
+        ("写入新编码", OPC_update_statements(opc_updates), "OPC 列已为变长列，编码未改动，可重新执行迁移"),
+        ("改为目标列类型", [(target_query, [()])], "编码已写入，OPC 列仍为变长列，可重新执行迁移"),
+    ]
+    for name, statements, state in steps:
+        try:
+            db_manager.execute_transaction(statements)
+        except Exception as err:
+            raise Exception(f"{table_name}: {name}失败（{state}）: {err}") from err
+
+    return len(opc_updates)
+
+
+if __name__ == '__main__':
+    db_manager = DatabaseManager()
+    try:
+        count = migrate_opc(db_manager, get_table_name())
+        print(f"{get_table_name()}: {count} 个编码已迁移为 OPC_WIDTH={OPC_WIDTH}（{OPC_column_type()}）")
+    finally:
+        db_manager.close()
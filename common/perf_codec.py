@@ -0,0 +1,66 @@
+import unittest
+import time
+import os
+import pickle
+from common import protocol
+
+
+def timeit(f):
+    def timed(*args, **kw):
+        ts = time.time()
+        result = f(*args, **kw)
+        te = time.time()
+        print(f'func: {f.__name__} took: {te - ts:.4f} seconds.')
+        return result
+    return timed
+
+class TestCodecPerformance(unittest.TestCase):
+    def setUp(self):
+        """ 构造一次插入遍历中的典型消息：move_left/move_right 请求与响应，以及最后的 insert """
+        self.runs = 20_000
+        ciphertext = os.urandom(16)
+        new_ciphertext = os.urandom(16)
+
+        move = protocol.ClientMessage()
+        move.move_left(ciphertext)
+        insert = protocol.ClientMessage()
+        insert.insert(ciphertext, new_ciphertext, 'left', '0110101')
+        self.requests = [move, insert]
+        self.responses = [protocol.ServerMessage(ciphertext=new_ciphertext, client_message=message) for message in self.requests]
+
+
+    def round_trip(self, codec):
+        size = 0
+        for _ in range(self.runs):
+            for message in self.requests + self.responses:
+                payload = codec.encode(message)
+                codec.decode(payload)
+                size += len(payload)
+        print(f'{codec.name}: {size / (self.runs * 4):.1f} bytes/message')
+
+
+    @timeit
+    def test_pickle_codec(self):
+        self.round_trip(protocol.PICKLE_CODEC)
+
+
+    @timeit
+    def test_binary_codec(self):
+        self.round_trip(protocol.BINARY_CODEC)
+
+
+    def test_binary_codec_fields(self):
+        """ 二进制编码只保留协议字段 """
+        for message in self.requests + self.responses:
+            decoded = protocol.BINARY_CODEC.decode(protocol.BINARY_CODEC.encode(message))
+            self.assertEqual(decoded.message_type.type(), message.message_type.type())
+            self.assertEqual(decoded.ciphertext, message.ciphertext)
+        results = [{'id': 1, 'insert_num': os.urandom(16), 'OPC': b'\x80\x00\x00\x00'}]
+        response = protocol.ServerMessage(ciphertext=None, client_message=None, query_results=results, message_type="range_query")
+        decoded = protocol.BINARY_CODEC.decode(protocol.BINARY_CODEC.encode(response))
+        self.assertEqual(decoded.query_results, results)
+        self.assertIsNone(decoded.client_message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import time
+import os
+import tempfile
+from multiprocessing import Process, Event
+from common import protocol, transport
+
+"""
+各传输方式的单次往返延迟：子进程中运行回显服务器，客户端按一次插入遍历中的典型消息（move_left 请求/响应）
+逐条发送并等待响应，与交互式插入一样每次往返都是串行的。
+python -m unittest common.perf_transport
+"""
+
+
+def echo_server(address, ready):
+    with transport.listen(address) as server_socket:
+        ready.set() # 通知父进程已在监听
+        conn, _ = server_socket.accept()
+        with conn:
+            reader = protocol.FrameReader(conn)
+            while True:
+                payload = reader.read_frame()
+                if payload is None:
+                    break
+                protocol.send_frame(conn, payload)
+
+
+def start_echo_server(address):
+    ready = Event()
+    server = Process(target=echo_server, args=(address, ready))
+    server.start()
+    ready.wait()
+    return server
+
+
+class TestTransportPerformance(unittest.TestCase):
+    def setUp(self):
+        self.runs = 20_000
+        message = protocol.ClientMessage()
+        message.move_left(os.urandom(16))
+        self.payload = protocol.BINARY_CODEC.encode(message)
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def round_trip(self, address):
+        server = start_echo_server(address)
+
+        conn = transport.connect(address)
+        reader = protocol.FrameReader(conn)
+        for _ in range(1000): # 预热
+            protocol.send_frame(conn, self.payload)
+            reader.read_frame()
+
+        start = time.perf_counter()
+        for _ in range(self.runs):
+            protocol.send_frame(conn, self.payload)
+            self.assertEqual(len(reader.read_frame()), len(self.payload))
+        elapsed = time.perf_counter() - start
+
+        conn.close()
+        server.join()
+        print(f'{address.split(":")[0]}: {elapsed / self.runs * 1e6:.1f} us/round trip')
+        return elapsed
+
+
+    def test_tcp(self):
+        self.round_trip("tcp:127.0.0.1:65431")
+
+
+    def test_unix(self):
+        self.round_trip(f"unix:{os.path.join(self.tmpdir, 'ope.sock')}")
+
+
+    def test_shm(self):
+        self.round_trip(f"shm:{os.path.join(self.tmpdir, 'ope_shm.sock')}")
+
+
+    def test_shm_large_message(self):
+        """ 超过环形缓冲区容量的消息（如大范围查询结果）分段写入，对端边读边腾出空间 """
+        address = f"shm:{os.path.join(self.tmpdir, 'ope_large.sock')}"
+        server = start_echo_server(address)
+
+        conn = transport.connect(address)
+        payload = os.urandom(3 * transport.RING_CAPACITY + 7)
+        protocol.send_frame(conn, payload)
+        self.assertEqual(bytes(protocol.FrameReader(conn).read_frame()), payload)
+        conn.close()
+        server.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
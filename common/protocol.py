@@ -1,4 +1,7 @@
 import uuid
+import asyncio
+import struct
+import pickle
 
 
 class MessageProtocol:
@@ -17,6 +20,10 @@ class ServerMessage(MessageProtocol):
         self.find_node_path = find_node_path
         self.message_type = MessageType(message_type) # 设置消息类型，默认为 "insert"
         self.query_results = query_results if query_results is not None else []
+        self.epoch = None # 树的 epoch（每次 rebalance 重排加一），由服务器在发送前填入
+        self.retry = False # 插入所依据的树结构已变化，客户端需重新规划后重试；insert 的重试响应带回重新规划的起点（密文及其 path）
+        self.request_id = None # 对应请求的 request_id，由服务器在发送前填入
+        self.invalidated = None # 自上一个响应以来被重排的子树根 path（字符串），客户端据此使缓存的 path 失效
 
     def dict_to_message(self, dict):
         message = ServerMessage()
@@ -43,6 +50,11 @@ class ClientMessage(MessageProtocol):
         self.path = "" # [path]
         self.min_ciphertext = None
         self.max_ciphertext = None
+        self.depth = None # get_subtree 返回的层数
+        self.items = None # batch_insert：[(锚点密文, 新密文, 方向)]
+        self.epoch = None # insert/batch_insert 规划所依据的树 epoch
+        self.bounds = None # insert：新值两侧最近的已比较节点密文 [下界, 上界]（None 表示该侧无界）；batch_insert：与 items 对应的列表
+        self.request_id = None # 流水线请求编号：非空时服务器可并发处理并乱序响应，响应中原样带回
 
     def move_left(self, ciphertext):
         self.message_type = MessageType("move_left")
@@ -64,6 +76,10 @@ class ClientMessage(MessageProtocol):
         self._check_insert_direction()
         self.path = path
 
+    def batch_insert(self, items):
+        self.message_type = MessageType("batch_insert")
+        self.items = items
+
     def query(self, ciphertext):
         self.message_type = MessageType("query")
         self.ciphertext = ciphertext
@@ -76,6 +92,12 @@ class ClientMessage(MessageProtocol):
         self.message_type = MessageType("get_common_node")
         self.ciphertext = cipher_bound
 
+    def get_subtree(self, ciphertext, depth):
+        # ciphertext 为 None 时从根节点开始
+        self.message_type = MessageType("get_subtree")
+        self.ciphertext = ciphertext
+        self.depth = depth
+
     def range_query(self, min_ciphertext, max_ciphertext):
         self.message_type = MessageType("range_query")
         self.min_ciphertext = min_ciphertext
@@ -104,10 +126,26 @@ class ClientMessage(MessageProtocol):
 
 
 class MessageType:
+    """
+    消息类型：每种类型只有一个共享实例（MessageType("insert") 总是返回同一对象），
+    code 为其整数编号，收发两端按 code 查处理函数表分发，不再逐个比较字符串
+    """
+    _instances = {} # {message_type: MessageType}
+
+    def __new__(cls, message_type):
+        instance = cls._instances.get(message_type)
+        if instance is None:
+            if message_type not in MESSAGE_TYPE_CODES:
+                raise Exception("'%s' is not a valid message type" % message_type)
+            instance = super().__new__(cls)
+            instance._message_type = message_type
+            instance.code = MESSAGE_TYPE_CODES[message_type]
+            cls._instances[message_type] = instance
+        return instance
 
-    def __init__(self, message_type):
-        self._message_type = message_type
-        self._check_valid_message_type()
+    def __reduce__(self):
+        # pickle 反序列化时同样取共享实例
+        return (MessageType, (self._message_type, ))
 
     def type(self):
         return self._message_type  # 添加 return 语句
@@ -115,12 +153,329 @@ class MessageType:
     def __repr__(self):
         return f"MessageType('{self._message_type}')"  # 提供更详细的表示
 
-
-    def _check_valid_message_type(self):
-        if self._message_type not in ["move_left", "move_right", "get_root", "get_node", "insert", "query", "get_common_node", "find_node_path", "range_query"]:
-            raise Exception("'%s' is not a valid message type" % self._message_type)
-
     def to_dict(self):
         return {
             'message_type': self._message_type  # 将属性添加到字典中
-        }
\ No newline at end of file
+        }
+
+
+MAX_SUBTREE_DEPTH = 12 # get_subtree 单次最多返回的层数（至多 4095 个节点），服务器按此截断，客户端按此判断边缘
+
+MESSAGE_TYPE_NAMES = ["move_left", "move_right", "get_root", "get_node", "insert", "query", "get_common_node", "find_node_path", "range_query", "get_subtree", "batch_insert"]
+MESSAGE_TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPE_NAMES)}
+MESSAGE_TYPES = tuple(MessageType(name) for name in MESSAGE_TYPE_NAMES) # 按 code 下标
+
+INSERT = MessageType("insert")
+BATCH_INSERT = MessageType("batch_insert")
+
+
+def handler(table, message_type):
+    """装饰器：将函数注册为 table 中 message_type 类型消息的处理函数 {code: 函数}"""
+    def register(fn):
+        table[MessageType(message_type).code] = fn
+        return fn
+    return register
+
+
+"""
+消息分帧：每帧为 4 字节大端长度头 + 负载。长度头最高位为续帧标志，置位表示该消息还有后续帧；
+超过 MAX_FRAME_SIZE 的消息拆成多帧依次发送，接收端读满每一帧后再拼接，不再受单次 recv 大小限制。
+"""
+FRAME_HEADER = struct.Struct('!I')
+MORE_FRAMES = 0x80000000 # 续帧标志
+MAX_FRAME_SIZE = 1 << 20 # 单帧负载上限 1MB
+SMALL_FRAME_SIZE = 64 * 1024 # 小于该长度时长度头与负载合并为一次 sendall
+
+
+def frames(payload):
+    """将一条消息拆分为帧，依次返回待发送的数据块"""
+    view = memoryview(payload)
+    total = len(view)
+    start = 0
+    while True:
+        chunk = view[start:start + MAX_FRAME_SIZE]
+        start += len(chunk)
+        more = start < total
+        header = FRAME_HEADER.pack(len(chunk) | (MORE_FRAMES if more else 0))
+        if len(chunk) < SMALL_FRAME_SIZE:
+            yield header + chunk
+        else:
+            yield header
+            yield chunk
+        if not more:
+            break
+
+
+def send_frame(sock, payload):
+    """按帧发送一条完整消息"""
+    for data in frames(payload):
+        sock.sendall(data)
+
+
+async def read_frame_async(reader):
+    """从 asyncio.StreamReader 读取一条完整消息的负载；对端在帧边界关闭连接时返回 None"""
+    message = None
+    while True:
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as err:
+            if message is None and not err.partial:
+                return None
+            raise EOFError("connection closed inside a frame") from err
+        (length,) = FRAME_HEADER.unpack(header)
+        payload = await reader.readexactly(length & ~MORE_FRAMES)
+        if not length & MORE_FRAMES and message is None:
+            return payload
+        if message is None:
+            message = bytearray()
+        message += payload
+        if not length & MORE_FRAMES:
+            return message
+
+
+class FrameReader:
+    """从 socket 按帧读取消息，单帧消息直接读入可复用的接收缓冲区，避免每条消息重新分配内存"""
+    def __init__(self, sock, buffer_size=64 * 1024):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.header = bytearray(FRAME_HEADER.size)
+
+    def _recv_exactly(self, buffer, n, allow_eof=False):
+        # 循环 recv_into 直到读满 n 字节；allow_eof 时帧边界上的连接关闭返回 False
+        view = memoryview(buffer)
+        received = 0
+        while received < n:
+            count = self.sock.recv_into(view[received:n])
+            if count == 0:
+                if allow_eof and received == 0:
+                    return False
+                raise EOFError(f"connection closed after {received} of {n} bytes")
+            received += count
+        return True
+
+    def _read_frame(self, allow_eof):
+        # 读取一帧，返回 (负载视图, 是否有续帧)；连接在帧边界关闭时返回 (None, False)
+        if not self._recv_exactly(self.header, FRAME_HEADER.size, allow_eof):
+            return None, False
+        (length,) = FRAME_HEADER.unpack(self.header)
+        more = bool(length & MORE_FRAMES)
+        length &= ~MORE_FRAMES
+        if length > len(self.buffer):
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        self._recv_exactly(self.buffer, length)
+        return memoryview(self.buffer)[:length], more
+
+    def read_frame(self):
+        """
+        读取一条完整消息的负载；对端正常关闭连接时返回 None。
+        单帧消息返回接收缓冲区上的视图，仅在下一次读取之前有效
+        """
+        payload, more = self._read_frame(allow_eof=True)
+        if payload is None or not more:
+            return payload
+
+        message = bytearray(payload)
+        while more:
+            payload, more = self._read_frame(allow_eof=False)
+            message += payload
+        return message
+
+    def recv_message(self, codec=None):
+        payload = self.read_frame()
+        if payload is None:
+            return None
+        return (codec or PICKLE_CODEC).decode(payload)
+
+
+def send_message(sock, message, codec=None):
+    send_frame(sock, (codec or PICKLE_CODEC).encode(message))
+
+
+"""
+消息编码：
+    pickle：完整序列化消息对象（含 uuid、MessageType 对象以及响应中回显的 client_message）
+    binary：定长头部 + 可选字段，只传输协议需要的字段，不含 uuid 与回显的请求
+        头部：消息种类 B（0 客户端 / 1 服务器）| 消息类型编号 B | 字段存在位图 H
+        字段：按 CLIENT_FIELDS / SERVER_FIELDS 的顺序，仅写出位图中置位的字段，每个字段为带类型标签的值
+        值：标签 B + 内容，bytes/str 为 4 字节长度前缀 + 数据，int 为 8 字节有符号整数，list/dict 为元素个数 + 元素
+客户端连接后先发送一帧握手 HANDSHAKE_PREFIX + 编码名称选择编码；未发送握手的旧客户端按 pickle 处理
+"""
+HANDSHAKE_PREFIX = b'OPE-CODEC:'
+
+CLIENT_KIND = 0
+SERVER_KIND = 1
+CLIENT_FIELDS = ('ciphertext', 'new_ciphertext', 'insert_direction', 'path', 'min_ciphertext', 'max_ciphertext', 'depth', 'items', 'epoch', 'request_id', 'bounds')
+SERVER_FIELDS = ('ciphertext', 'find_node_path', 'query_results', 'epoch', 'retry', 'request_id', 'invalidated')
+CLIENT_DEFAULTS = {'path': ""}
+SERVER_DEFAULTS = {'query_results': [], 'retry': False}
+
+MESSAGE_HEADER = struct.Struct('!BBH')
+TAG = struct.Struct('!B')
+LENGTH = struct.Struct('!I')
+INT = struct.Struct('!q')
+
+TAG_NONE = 0
+TAG_BYTES = 1
+TAG_STR = 2
+TAG_INT = 3
+TAG_LIST = 4
+TAG_DICT = 5
+TAG_BOOL = 6
+TAG_PICKLE = 7 # 其余类型（如数据库返回的日期、Decimal）退化为 pickle
+
+
+def _encode_value(out, value):
+    if value is None:
+        out += TAG.pack(TAG_NONE)
+    elif isinstance(value, (bytes, bytearray)):
+        out += TAG.pack(TAG_BYTES)
+        out += LENGTH.pack(len(value))
+        out += value
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out += TAG.pack(TAG_STR)
+        out += LENGTH.pack(len(data))
+        out += data
+    elif isinstance(value, bool):
+        out += TAG.pack(TAG_BOOL)
+        out += TAG.pack(value)
+    elif isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+        out += TAG.pack(TAG_INT)
+        out += INT.pack(value)
+    elif isinstance(value, (list, tuple)):
+        out += TAG.pack(TAG_LIST)
+        out += LENGTH.pack(len(value))
+        for item in value:
+            _encode_value(out, item)
+    elif isinstance(value, dict):
+        out += TAG.pack(TAG_DICT)
+        out += LENGTH.pack(len(value))
+        for key, item in value.items():
+            _encode_value(out, key)
+            _encode_value(out, item)
+    else:
+        data = pickle.dumps(value)
+        out += TAG.pack(TAG_PICKLE)
+        out += LENGTH.pack(len(data))
+        out += data
+
+
+def _decode_value(data, offset):
+    # 返回 (值, 新偏移)
+    tag = data[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_BYTES or tag == TAG_STR or tag == TAG_PICKLE:
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        value = bytes(data[offset:offset + length])
+        offset += length
+        if tag == TAG_STR:
+            value = value.decode('utf-8')
+        elif tag == TAG_PICKLE:
+            value = pickle.loads(value)
+        return value, offset
+    if tag == TAG_INT:
+        return INT.unpack_from(data, offset)[0], offset + INT.size
+    if tag == TAG_BOOL:
+        return bool(data[offset]), offset + 1
+    if tag == TAG_LIST:
+        (count,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == TAG_DICT:
+        (count,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        items = {}
+        for _ in range(count):
+            key, offset = _decode_value(data, offset)
+            items[key], offset = _decode_value(data, offset)
+        return items, offset
+    raise ValueError(f"unknown value tag {tag}")
+
+
+class PickleCodec:
+    name = 'pickle'
+
+    def encode(self, message):
+        return pickle.dumps(message)
+
+    def decode(self, payload):
+        return pickle.loads(payload)
+
+
+class BinaryCodec:
+    name = 'binary'
+
+    def encode(self, message):
+        if isinstance(message, ClientMessage):
+            kind, fields, defaults = CLIENT_KIND, CLIENT_FIELDS, CLIENT_DEFAULTS
+        else:
+            kind, fields, defaults = SERVER_KIND, SERVER_FIELDS, SERVER_DEFAULTS
+
+        bitmap = 0
+        body = bytearray()
+        for i, field in enumerate(fields):
+            value = getattr(message, field)
+            if value is None or value == defaults.get(field):
+                continue
+            bitmap |= 1 << i
+            _encode_value(body, value)
+
+        return MESSAGE_HEADER.pack(kind, message.message_type.code, bitmap) + body
+
+    def decode(self, payload):
+        kind, type_code, bitmap = MESSAGE_HEADER.unpack_from(payload, 0)
+        if kind == CLIENT_KIND:
+            message = ClientMessage.__new__(ClientMessage)
+            fields, defaults = CLIENT_FIELDS, CLIENT_DEFAULTS
+        else:
+            message = ServerMessage.__new__(ServerMessage)
+            message.client_message = None # 响应中不再回显请求
+            fields, defaults = SERVER_FIELDS, SERVER_DEFAULTS
+
+        message.uuid = None
+        message.message_type = MESSAGE_TYPES[type_code]
+        offset = MESSAGE_HEADER.size
+        for i, field in enumerate(fields):
+            if bitmap & (1 << i):
+                value, offset = _decode_value(payload, offset)
+            else:
+                value = defaults.get(field)
+                if isinstance(value, list):
+                    value = []
+            setattr(message, field, value)
+        return message
+
+
+PICKLE_CODEC = PickleCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS = {codec.name: codec for codec in (PICKLE_CODEC, BINARY_CODEC)}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError(f"Unsupported codec '{name}'. Use one of {list(CODECS)}.")
+    return CODECS[name]
+
+
+def handshake(codec):
+    """客户端连接后发送的第一帧，选择本连接使用的编码"""
+    return HANDSHAKE_PREFIX + codec.name.encode('ascii')
+
+
+def send_handshake(sock, codec):
+    send_frame(sock, handshake(codec))
+
+
+def parse_handshake(payload):
+    """服务器读取第一帧：为握手则返回选定的编码，否则返回 None（旧客户端，第一帧即为 pickle 消息）"""
+    payload = bytes(payload)
+    if not payload.startswith(HANDSHAKE_PREFIX):
+        return None
+    return get_codec(payload[len(HANDSHAKE_PREFIX):].decode('ascii'))
@@ -0,0 +1,254 @@
+import os
+import select
+import socket
+import mmap
+import tempfile
+
+"""
+客户端与服务器之间的传输层，地址格式：
+    tcp:<host>:<port>    TCP（默认，跨主机）
+    unix:<path>          Unix 域套接字（同机，省去 TCP/IP 协议栈）
+    shm:<path>           共享内存环形缓冲区（同机，最低延迟）：<path> 为握手用的 Unix 域套接字，
+                         连接建立后请求/响应帧通过两块共享内存环形缓冲区传递，握手套接字只用于检测对端断开（仅限 Unix）
+connect()/listen() 返回的连接对象都提供 sendall/recv_into/close，可直接交给 FrameReader 与 send_message。
+"""
+
+DEFAULT_ADDRESS = "tcp:localhost:65432"
+
+RING_HEADER = 64 # 写位置、读位置、关闭标志、读/写端等待标志，各占一个 8 字节槽，余下留空以与数据区分开缓存行
+RING_CAPACITY = 1 << 20 # 数据区大小，必须为 2 的幂
+SPIN_COUNT = 2000 if (os.cpu_count() or 1) > 1 else 0 # 等待对端时先忙等的轮数；单核时忙等只会占住对端需要的 CPU
+MAX_SLEEP = 0.001 # 阻塞等待唤醒的超时
+READER_WAITING = 3 # 环形缓冲区头部中等待标志的槽位
+WRITER_WAITING = 4
+
+
+def parse_address(address):
+    """将地址字符串解析为 (scheme, 参数)；tcp 返回 (host, port)，unix/shm 返回套接字文件路径"""
+    scheme, sep, rest = address.partition(':')
+    if not sep or not rest:
+        raise ValueError(f"Invalid address '{address}'. Use tcp:<host>:<port>, unix:<path> or shm:<path>.")
+    if scheme == 'tcp':
+        host, sep, port = rest.rpartition(':')
+        if not sep:
+            raise ValueError(f"Invalid tcp address '{address}'. Use tcp:<host>:<port>.")
+        return scheme, (host, int(port))
+    if scheme in ('unix', 'shm'):
+        return scheme, rest
+    raise ValueError(f"Unsupported transport '{scheme}'. Use one of ['tcp', 'unix', 'shm'].")
+
+
+def connect(address):
+    scheme, target = parse_address(address)
+    if scheme == 'tcp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(target)
+        return sock
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(target)
+    if scheme == 'unix':
+        return sock
+    return ShmChannel.connect(sock)
+
+
+def listen(address, backlog=1):
+    scheme, target = parse_address(address)
+    if scheme == 'tcp':
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.bind(target)
+    else:
+        if os.path.exists(target): # 上次运行遗留的套接字文件
+            os.unlink(target)
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server_socket.bind(target)
+    server_socket.listen(backlog)
+    return ShmListener(server_socket) if scheme == 'shm' else server_socket
+
+
+class ShmListener:
+    """shm 传输的监听端：在握手套接字上 accept，再为每个连接创建一对环形缓冲区"""
+    def __init__(self, server_socket):
+        self.server_socket = server_socket
+
+    def accept(self):
+        sock, addr = self.server_socket.accept()
+        return ShmChannel.accept(sock), addr or 'shm'
+
+    def close(self):
+        path = self.server_socket.getsockname()
+        self.server_socket.close()
+        if path and os.path.exists(path):
+            os.unlink(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Ring:
+    """
+    单生产者单消费者的字节环形缓冲区，位于一块进程间共享的匿名内存中（memfd，文件描述符经 Unix 域套接字传给对端，
+    不占用任何名字，进程退出后自动回收）。
+    读写位置为只增不减的 64 位计数，生产者先写数据再推进写位置，消费者先读数据再推进读位置
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.map = mmap.mmap(fd, RING_HEADER + RING_CAPACITY)
+        buf = memoryview(self.map)
+        self.positions = buf[:RING_HEADER].cast('Q') # [写位置, 读位置, 关闭标志, 读端等待中, 写端等待中]
+        self.data = buf[RING_HEADER:]
+        buf.release()
+        self.mask = RING_CAPACITY - 1
+
+    @classmethod
+    def create(cls):
+        if hasattr(os, 'memfd_create'):
+            fd = os.memfd_create("ope_ring")
+        else: # 无 memfd 的平台使用已删除的临时文件
+            with tempfile.TemporaryFile() as f:
+                fd = os.dup(f.fileno())
+        os.ftruncate(fd, RING_HEADER + RING_CAPACITY)
+        return cls(fd)
+
+    def writable(self):
+        return RING_CAPACITY - (self.positions[0] - self.positions[1])
+
+    def readable(self):
+        return self.positions[0] - self.positions[1]
+
+    def closed(self):
+        return self.positions[2] != 0
+
+    def write(self, data):
+        """写入尽可能多的数据，返回写入的字节数"""
+        write_pos = self.positions[0]
+        n = min(len(data), RING_CAPACITY - (write_pos - self.positions[1]))
+        start = write_pos & self.mask
+        first = min(n, RING_CAPACITY - start)
+        self.data[start:start + first] = data[:first]
+        if n > first: # 回绕到数据区开头
+            self.data[:n - first] = data[first:n]
+        self.positions[0] = write_pos + n
+        return n
+
+    def read_into(self, view):
+        """读取尽可能多的数据到 view，返回读取的字节数"""
+        read_pos = self.positions[1]
+        n = min(len(view), self.positions[0] - read_pos)
+        start = read_pos & self.mask
+        first = min(n, RING_CAPACITY - start)
+        view[:first] = self.data[start:start + first]
+        if n > first:
+            view[first:n] = self.data[:n - first]
+        self.positions[1] = read_pos + n
+        return n
+
+    def close(self):
+        self.positions[2] = 1
+
+    def release(self):
+        self.positions.release()
+        self.data.release()
+        self.map.close()
+        os.close(self.fd)
+
+
+class ShmChannel:
+    """
+    基于两块共享内存环形缓冲区的双向连接，接口与 socket 的 sendall/recv_into/close 一致。
+    等待对端时先忙等 SPIN_COUNT 轮（交互式遍历中响应通常在几微秒内到达），之后阻塞在握手套接字上等待对端唤醒，
+    握手套接字 EOF 即表示对端进程已退出
+    """
+    def __init__(self, sock, send_ring, recv_ring):
+        self.sock = sock
+        self.send_ring = send_ring
+        self.recv_ring = recv_ring
+
+    @classmethod
+    def accept(cls, sock):
+        # 服务器端创建两块缓冲区（客户端->服务器、服务器->客户端），文件描述符随握手消息发给客户端
+        request_ring, response_ring = Ring.create(), Ring.create()
+        try:
+            socket.send_fds(sock, [b'\x01'], [request_ring.fd, response_ring.fd])
+        except OSError:
+            request_ring.release()
+            response_ring.release()
+            raise
+        return cls(sock, response_ring, request_ring)
+
+    @classmethod
+    def connect(cls, sock):
+        message, fds, _, _ = socket.recv_fds(sock, 1, 2)
+        if message != b'\x01' or len(fds) != 2:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionResetError("shm handshake failed")
+        return cls(sock, Ring(fds[0]), Ring(fds[1]))
+
+    def _wait(self, ready, ring, waiting_slot):
+        # ready() 为真时返回 True；对端关闭且条件仍不满足时返回 False。
+        # 先忙等；之后在 ring 的 waiting_slot 上登记等待并阻塞在握手套接字上，由对端写入/读出后发送一个字节唤醒，
+        # 登记与对端检查之间的竞争最多使本次等待推迟 MAX_SLEEP
+        for _ in range(SPIN_COUNT):
+            if ready():
+                return True
+        while True:
+            ring.positions[waiting_slot] = 1
+            if ready():
+                ring.positions[waiting_slot] = 0
+                return True
+            if self.recv_ring.closed() or self.send_ring.closed():
+                ring.positions[waiting_slot] = 0
+                return ready()
+            readable, _, _ = select.select([self.sock], [], [], MAX_SLEEP)
+            ring.positions[waiting_slot] = 0
+            if readable and not self.sock.recv(4096): # 对端进程退出，握手套接字 EOF
+                self.recv_ring.close()
+                return ready()
+            if ready():
+                return True
+
+    def _wake(self, ring, waiting_slot):
+        if ring.positions[waiting_slot]:
+            try:
+                self.sock.send(b'\x00')
+            except OSError: # 对端已关闭，由其关闭标志处理
+                pass
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        sent = 0
+        while sent < len(view):
+            if not self._wait(self.send_ring.writable, self.send_ring, WRITER_WAITING) or self.send_ring.closed():
+                raise BrokenPipeError("shm peer closed the connection")
+            sent += self.send_ring.write(view[sent:])
+            self._wake(self.send_ring, READER_WAITING)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        if nbytes:
+            view = view[:nbytes]
+        if not self._wait(self.recv_ring.readable, self.recv_ring, READER_WAITING):
+            return 0 # 对端关闭且数据已读完
+        n = self.recv_ring.read_into(view)
+        self._wake(self.recv_ring, WRITER_WAITING)
+        return n
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.send_ring.close()
+        self.recv_ring.close()
+        self.sock.close()
+        self.sock = None
+        self.send_ring.release()
+        self.recv_ring.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
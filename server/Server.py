@@ -1,113 +1,66 @@
 import time, queue
 import socket, logging
-import pickle
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
 from logging.handlers import RotatingFileHandler
-from server.db.db_manager import DatabaseManager
-from common import protocol
-from server.rebalance import rebalance, height, AVL_Node
-from server.encoding_transformer_utils import path_to_OPC, OPC_to_path
-from server.encoding_transformer_utils import string_to_binary_data, binary_data_to_string
-from server.encoding_transformer_utils import get_table_name
+from common import protocol, transport
+from server.engine import TreeEngine
+from server.encoding_transformer_utils import path_to_binary_data, ROOT_PATH, get_table_name
+from server.encoding_transformer_utils import path_from_string, path_to_string
 
 
 class Server:
-    def __init__(self, conn, logger):
+    """单个客户端连接的会话：只保存连接和本连接的交互统计，树状态由共享的 TreeEngine 维护"""
+    HANDLERS = {} # {消息类型code: 处理函数}，由 @protocol.handler 注册，新增操作只需注册新的处理函数
+    def __init__(self, conn, logger, engine):
         self.conn = conn # socket连接
         self.logger = logger
-        self.db_manager = DatabaseManager()
-
-        self.root = None
-        self.N = 5 # AVL-N
+        self.engine = engine
+        self.reader = protocol.FrameReader(conn) # 按帧读取，接收缓冲区在本连接内复用
+        self.codec = protocol.PICKLE_CODEC # 由客户端握手选择
 
         self.cnt = 0 # 单次插入交互次数
         self.total_cnt = 0 # 截至目前总交互次数
         self.counter = 0 # 插入数据数量
-        self.rebalance_time = 0
-
-        self.ope_table = {} # {ciphertext: AVL_Node}：全局数据结构，包括此前数据库中已存在的和新插入的
-        self.path_to_node = {} # {path: AVL_Node}：辅助结构，从数据库中恢复树
-
-        self.id_num = self.restore_tree_from_db()
+        self.client_epoch = None # 上一个发给本连接的响应所带的 epoch
 
 
-    def restore_tree_from_db(self):
-        id_num = 0
-        """从数据库中还原树结构"""
-        query = f"SELECT insert_num, OPC FROM {get_table_name()}"
-        results = self.db_manager.execute_query(query) # 元组列表
-
-        """
-        两遍插入
-            第一遍：创建根节点。先创建所有节点对象并存储到一个字典 path_to_node 中，不进行实际的树连接。
-            第二遍：构建树结构。遍历 path_to_node，根据 path 逐步连接父节点与子节点。
-        """
-        # 创建所有节点并存储到path_to_node、ope_table中
-        for insert_num, OPC in results:
-            # print(f'{insert_num}: {OPC}')
-
-            id_num += 1 # 同样明文的id
-            # 获取节点路径
-            OPC_str = binary_data_to_string(OPC)
-            path = OPC_to_path(OPC_str)
-
-            # 避免重复节点
-            if path in self.path_to_node:
-                self.path_to_node[path].ids.append(id_num)
-                self.logger.debug(f"跳过重复节点：insert_num={insert_num}")
-                continue
+    def close(self):
+        """连接结束时写出快照（快照之后没有新插入时跳过），树与数据库连接保留给后续连接"""
+        if self.engine.snapshot_clean and self.engine.id_num == self.engine.snapshot_id_num:
+            return
+        self.engine.save_snapshot()
 
-            # 创建新节点，存储路径和节点
-            new_node = AVL_Node(insert_num)
-            new_node.path = path
-            self.path_to_node[path] = new_node
-            self.ope_table[insert_num] = new_node
-
-        # print(f'path_to_node:{self.path_to_node}')
-
-        # 按照path构建树结构
-        for path, new_node in self.path_to_node.items():
-            # root node
-            if path == "":
-                self.root = new_node
-            else:
-                # 找到父节点路径(父节点一定存在)
-                parent_path = path[:-1]
-                parent_node = self.path_to_node[parent_path]
-
-                # 确定插入位置
-                if path[-1] == "0":
-                    parent_node.left = new_node
-                else:
-                    parent_node.right = new_node
 
-                new_node.parent = parent_node
+    def handshake(self):
+        """读取第一帧选择编码；旧客户端不发送握手，其第一帧即为 pickle 消息，返回该消息待处理"""
+        return self.accept_handshake(self.reader.read_frame())
 
-        print(f"树结构已还原，树高{height(self.root)}")
-        logger.info(self.ope_table)
 
-        return id_num
+    def accept_handshake(self, payload):
+        if payload is None:
+            return None
+        codec = protocol.parse_handshake(payload)
+        if codec is None:
+            return self.codec.decode(payload)
+        self.codec = codec
+        self.logger.info(f"codec={codec.name}")
+        return None
 
 
     def run(self):
+        pending_message = self.handshake()
         while True:
             try:
-                byte_data = self.conn.recv(4096)
-                request_message = pickle.loads(byte_data)
+                request_message = pending_message or self.reader.recv_message(self.codec)
+                pending_message = None
+                if request_message is None: # 客户端关闭连接
+                    break
                 self.logger.debug(f'Received from client : {request_message}')
 
-                if request_message.message_type.__repr__() != protocol.MessageType("insert").__repr__():
-                    self.cnt += 1
-                else:
-                    self.logger.debug(f'insert_operation_interactions_count({request_message.new_ciphertext}): {self.cnt}')
-                    self.counter += 1
-                    self.total_cnt += self.cnt
-                    self.cnt = 0
-                    # if self.counter in [500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000]:
-                    if self.counter in [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]:
-                        self.logger.info(f'rebalance_taken: {self.rebalance_time}')
-                        self.logger.info(f'inserted: {self.counter}, insert_operation_average_interactions_count: {self.total_cnt / self.counter :2f}')
-
+                self.count_interaction(request_message)
                 self.receive(request_message)  # 处理消息
 
             except queue.Empty:
@@ -115,235 +68,398 @@ class Server:
                 time.sleep(1)
 
 
-    def find_node(self, ciphertext):
-        if ciphertext in self.ope_table:
-            return self.ope_table[ciphertext]
+    def count_interaction(self, request_message):
+        if request_message.message_type is protocol.BATCH_INSERT:
+            self.logger.debug(f'batch_insert_interactions_count({len(request_message.items)}): {self.cnt}')
+            self.counter += len(request_message.items)
+            self.total_cnt += self.cnt
+            self.cnt = 0
+        elif request_message.message_type is not protocol.INSERT:
+            self.cnt += 1
         else:
+            self.logger.debug(f'insert_operation_interactions_count({request_message.new_ciphertext}): {self.cnt}')
+            self.counter += 1
+            self.total_cnt += self.cnt
+            self.cnt = 0
+            # if self.counter in [500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000]:
+            if self.counter in [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]:
+                self.logger.info(f'rebalance_taken: {self.engine.rebalance_time}')
+                self.logger.info(f"rebalance_OPC_rewritten: {self.engine.rebalance_stats['rewritten']}, skipped: {self.engine.rebalance_stats['skipped']}")
+                self.logger.info(f'inserted: {self.counter}, insert_operation_average_interactions_count: {self.total_cnt / self.counter :2f}')
+
+
+    def handle(self, client_message):
+        """按消息类型分发，返回待发送的响应（None 表示不回复）"""
+        handler = self.HANDLERS.get(client_message.message_type.code)
+        if handler is None:
+            raise Exception(f"No handler registered for {client_message.message_type}")
+        server_message = handler(self, client_message)
+        if server_message is not None:
+            server_message.epoch = self.engine.epoch
+            server_message.request_id = getattr(client_message, 'request_id', None)
+            server_message.invalidated = self.invalidated_prefixes()
+        return server_message
+
+
+    def invalidated_prefixes(self):
+        """
+        自上一个响应以来被重排的子树根 path：客户端缓存的 path 以其中任一为前缀的均已失效。
+        每次重排只随本连接的下一个响应发送一次；日志不完整时返回 ['']，即全部失效
+        """
+        epoch, self.client_epoch = self.client_epoch, self.engine.epoch
+        if epoch is None or epoch == self.engine.epoch:
             return None
+        rebalanced = self.engine.rebalanced_since(epoch)
+        if rebalanced is None:
+            return ['']
+        return [path_to_string(path) for path in rebalanced]
 
 
-    def path_to_find_node(self, path):
-        cur_node = self.root
-        for ch in path:
-            if ch == '0':
-                cur_node = cur_node.left
-            else:
-                cur_node = cur_node.right
-        return cur_node
+    def receive(self, client_message):
+        server_message = self.handle(client_message)
+        if server_message is None:
+            return None
 
+        self.logger.debug(f'Sending to Client: {server_message}')
+        protocol.send_message(self.conn, server_message, self.codec)
+        return server_message
 
-    def get_common_prefix(self, s1, s2):
-        min_len = min(len(s1), len(s2))
-        for i in range(min_len):
-            if s1[i] != s2[i]:
-                return s1[:i]
-        return s1[:min_len]
 
+    @protocol.handler(HANDLERS, "move_left")
+    def on_move_left(self, client_message):
+        current = self.engine.find_node(client_message.ciphertext)
+        left_child = current.left
+        if left_child:
+            server_message = protocol.ServerMessage(ciphertext=left_child.value, client_message=client_message)
+        else:
+            server_message = protocol.ServerMessage(ciphertext=None, client_message=client_message)
+        return server_message
 
-    def get_public_ancestor_node(self, path):
-        common_path = self.get_common_prefix(path[0], path[1])
-        return self.path_to_find_node(common_path)
 
+    @protocol.handler(HANDLERS, "move_right")
+    def on_move_right(self, client_message):
+        current = self.engine.find_node(client_message.ciphertext)
+        right_child = current.right
+        if right_child:
+            server_message = protocol.ServerMessage(ciphertext=right_child.value, client_message=client_message)
+        else:
+            server_message = protocol.ServerMessage(ciphertext=None, client_message=client_message)
+        return server_message
 
-    def receive(self, client_message):
 
-        if (client_message.message_type.__repr__() == protocol.MessageType("move_left").__repr__()):
-            current = self.find_node(client_message.ciphertext)
-            left_child = current.left
-            if left_child:
-                server_message = protocol.ServerMessage(ciphertext=left_child.value, client_message=client_message)
-            else:
-                server_message = protocol.ServerMessage(ciphertext=None, client_message=client_message)
-
-        elif (client_message.message_type.__repr__() == protocol.MessageType("move_right").__repr__()):
-            current = self.find_node(client_message.ciphertext)
-            right_child = current.right
-            if right_child:
-                server_message = protocol.ServerMessage(ciphertext=right_child.value, client_message=client_message)
-            else:
-                server_message = protocol.ServerMessage(ciphertext=None, client_message=client_message)
-
-        elif (client_message.message_type.__repr__() == protocol.MessageType("get_root").__repr__()):
-            if not self.root:
-                server_message = protocol.ServerMessage(ciphertext=None, client_message=client_message)
-            else:
-                server_message = protocol.ServerMessage(ciphertext=self.root.value, client_message=client_message)
-
-        elif (client_message.message_type.__repr__() == protocol.MessageType("find_node_path").__repr__()):
-            ciphertext = client_message.ciphertext # []
-            path = []
-            for ct in ciphertext:
-                path.append(self.find_node(ct).path)
-            server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
-                                                    client_message=client_message,
-                                                    find_node_path=path,
-                                                    message_type="find_node_path")
+    @protocol.handler(HANDLERS, "get_root")
+    def on_get_root(self, client_message):
+        if not self.engine.root:
+            server_message = protocol.ServerMessage(ciphertext=None, client_message=client_message)
+        else:
+            server_message = protocol.ServerMessage(ciphertext=self.engine.root.value, client_message=client_message)
+        return server_message
 
-        elif (client_message.message_type.__repr__() == protocol.MessageType("get_common_node").__repr__()):
-            ciphertext = client_message.ciphertext # []
-            path = []
-            for ct in ciphertext:
-                path.append(self.find_node(ct).path)
 
-            public_ancestor_node = self.get_public_ancestor_node(path)
+    @protocol.handler(HANDLERS, "find_node_path")
+    def on_find_node_path(self, client_message):
+        ciphertext = client_message.ciphertext # []
+        path = []
+        for ct in ciphertext:
+            node = self.engine.find_node(ct)
+            path.append(path_to_string(node.path) if node else None) # 树中不存在的值返回 None
+        server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
+                                                client_message=client_message,
+                                                find_node_path=path,
+                                                message_type="find_node_path")
+        return server_message
 
-            server_message = protocol.ServerMessage(ciphertext=public_ancestor_node.value,
-                                                    client_message=client_message,
-                                                    find_node_path=public_ancestor_node.path,
-                                                    message_type="get_common_node")
-
-        elif (client_message.message_type.__repr__() == protocol.MessageType("get_node").__repr__()):
-            node_path = client_message.path
-
-            if node_path == '':
-                server_message = protocol.ServerMessage(ciphertext=self.root.value if self.root!=None else None,
-                                                        client_message=client_message)
-            else:
-                cur_node = self.root
-                for ch in node_path:
-                    if ch == '0':
-                        cur_node = cur_node.left
-                    else:
-                        cur_node = cur_node.right
-                server_message = protocol.ServerMessage(ciphertext=cur_node.value,
-                                                        client_message=client_message)
-
-        elif (client_message.message_type.__repr__() == protocol.MessageType("insert").__repr__()):
-            self.id_num += 1
-
-            # 数据库更新：将client传来的ciphertext、path存到MySQL
-            OPC = path_to_OPC(client_message.path)
-            update_query = f"INSERT INTO {get_table_name()}(insert_num, OPC) VALUES(%s, %s)"
-            update_params = [(client_message.new_ciphertext, string_to_binary_data(OPC))]
-            self.db_manager.execute_update(update_query, update_params)  # 数据插入到数据库中
-
-            # 树节点的更新
-            if client_message.new_ciphertext == client_message.ciphertext: # 树中已有节点
-                node = self.find_node(client_message.ciphertext)
-                node.ids.append(self.id_num)
-
-            else: # 新插入节点
-                new_node = AVL_Node(client_message.new_ciphertext)
-                new_node.path = client_message.path
-                new_node.ids.append(self.id_num)
-
-                # root case
-                if client_message.ciphertext == None:
-                    self.root = new_node
-                    self.ope_table[client_message.new_ciphertext] = self.root
-                else:
-                    node = self.find_node(client_message.ciphertext)
-                    new_node.parent = node
 
-                    if (client_message.insert_direction == "left"):
-                        node.left = new_node
-                    elif (client_message.insert_direction == "right"):
-                        node.right = new_node
-                    self.ope_table[client_message.new_ciphertext] = new_node
+    @protocol.handler(HANDLERS, "get_common_node")
+    def on_get_common_node(self, client_message):
+        ciphertext = client_message.ciphertext # []
+        path = []
+        for ct in ciphertext:
+            path.append(self.engine.find_node(ct).path)
 
-                    start_time = time.perf_counter()
+        public_ancestor_node = self.engine.get_public_ancestor_node(path)
 
-                    # AVL-N rebalance：server维护树的平衡以及编码的更新
-                    while node and node.parent:
-                        node = rebalance(node.parent, self.db_manager, self.logger, self.N)
-                        node = node.parent
+        server_message = protocol.ServerMessage(ciphertext=public_ancestor_node.value,
+                                                client_message=client_message,
+                                                find_node_path=path_to_string(public_ancestor_node.path),
+                                                message_type="get_common_node")
+        return server_message
 
-                    end_time = time.perf_counter()
-                    self.rebalance_time += end_time - start_time
 
-                    self.update_root()
+    @protocol.handler(HANDLERS, "get_node")
+    def on_get_node(self, client_message):
+        node_path = path_from_string(client_message.path)
 
-            server_message = protocol.ServerMessage(ciphertext=client_message.new_ciphertext, client_message=client_message)
+        if node_path == ROOT_PATH:
+            server_message = protocol.ServerMessage(ciphertext=self.engine.root.value if self.engine.root!=None else None,
+                                                    client_message=client_message)
+        else:
+            cur_node = self.engine.path_to_find_node(node_path)
+            server_message = protocol.ServerMessage(ciphertext=cur_node.value,
+                                                    client_message=client_message)
+        return server_message
 
-        # FIXME: Corresponding logic needs fixing. See README and client/Client.py
-        # for details on query_message() and range_query_message().
-        elif (client_message.message_type.__repr__() == protocol.MessageType("query").__repr__()):
-            # 此处默认确定性查询
-            query = f"SELECT * FROM {get_table_name()} WHERE insert_num = %s"
-            params = (client_message.ciphertext, )
-            results = self.db_manager.execute_query(query, params)  # 数据库查询操作
 
-            # 动态获取列名
-            column_names = [desc[0] for desc in self.db_manager.cursor.description]
+    @protocol.handler(HANDLERS, "get_subtree")
+    def on_get_subtree(self, client_message):
+        # 一次返回起始节点以下 depth 层的密文及其相对path，客户端在本地比较，只在边缘处再次请求
+        depth = min(client_message.depth or 1, protocol.MAX_SUBTREE_DEPTH)
+        if client_message.ciphertext is None:
+            start = self.engine.root
+        else:
+            start = self.engine.find_node(client_message.ciphertext)
+        nodes = self.engine.subtree(start, depth)
+        server_message = protocol.ServerMessage(ciphertext=[value for value, _ in nodes],
+                                                client_message=client_message,
+                                                find_node_path=[path for _, path in nodes],
+                                                message_type="get_subtree")
+        return server_message
 
-            # 查询结果封装为字典列表
-            query_results = [dict(zip(column_names, row)) for row in results]
 
-            server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
+    @protocol.handler(HANDLERS, "insert")
+    def on_insert(self, client_message):
+        # 乐观并发：规划所依据的插入位已失效时不插入，提示客户端重新遍历
+        ciphertext, direction = client_message.ciphertext, client_message.insert_direction
+        bounds = getattr(client_message, 'bounds', None)
+        start = None # 重新规划的起点，None 表示从根开始
+        if client_message.new_ciphertext == ciphertext: # 重复值：该值必须已在树中
+            valid = self.engine.find_node(ciphertext) is not None
+        elif bounds is not None: # 按新值两侧的节点校验间隙，插入位由服务器按当前的树确定
+            slot = self.engine.gap_slot(*bounds)
+            valid = slot is not None
+            if valid:
+                parent, direction = slot
+                ciphertext = parent.value if parent is not None else None
+            else: # 间隙已被其他插入占用：新位置仍在两侧节点之间，从二者的公共祖先重新规划
+                start = self.engine.replan_start(*bounds)
+        else:
+            valid = self.engine.slot_is_valid(getattr(client_message, 'epoch', None), ciphertext, direction)
+        if not valid:
+            server_message = protocol.ServerMessage(ciphertext=start.value if start is not None else None,
                                                     client_message=client_message,
-                                                    query_results=query_results,
-                                                    message_type="query")
+                                                    find_node_path=path_to_string(start.path) if start is not None else None)
+            server_message.retry = True
+            return server_message
 
-        # FIXME: Corresponding logic needs fixing. See README and client/Client.py
-        # for details on query_message() and range_query_message().
-        elif (client_message.message_type.__repr__() == protocol.MessageType("range_query").__repr__()):
-            # 判断是否存在 min_path 和 max_path
-            min_node = self.find_node(client_message.min_ciphertext) if client_message.min_ciphertext else None
-            min_path = min_node.path if min_node else ""  # 若找不到节点，赋值为空字符串
-            min_OPC = path_to_OPC(min_path)
+        node = self.engine.insert(ciphertext, client_message.new_ciphertext, direction)
 
-            max_node = self.find_node(client_message.max_ciphertext) if client_message.max_ciphertext else None
-            max_path = max_node.path if max_node else ""  # 若找不到节点，赋值为空字符串
-            max_OPC = path_to_OPC(max_path)
+        # 附带插入（及 rebalance）之后该值的path，客户端缓存后再次插入相同/相邻的值时无需查询
+        server_message = protocol.ServerMessage(ciphertext=client_message.new_ciphertext, client_message=client_message,
+                                                find_node_path=path_to_string(node.path))
+        return server_message
 
-            self.logger.debug(f"min_OPC={min_OPC}, max_OPC={max_OPC}")
-            self.logger.debug(f"param[0]={string_to_binary_data(min_OPC)}, param[1]={string_to_binary_data(max_OPC)}")
 
-            # 根据 min_path和 max_path的存在情况构建查询条件
-            query = f"SELECT * FROM {get_table_name()} "
-            params = ()
+    @protocol.handler(HANDLERS, "batch_insert")
+    def on_batch_insert(self, client_message):
+        server_message = protocol.ServerMessage(ciphertext=None, client_message=client_message, message_type="batch_insert")
+        if not self.engine.batch_is_valid(client_message.epoch, client_message.items, getattr(client_message, 'bounds', None)):
+            server_message.retry = True # 整批不插入，客户端重新规划
+            return server_message
 
-            if min_node and max_node:
-                query += "WHERE OPC BETWEEN %s AND %s"
-                params = (string_to_binary_data(min_OPC), string_to_binary_data(max_OPC))
-            elif min_node:
-                query += "WHERE OPC >= %s"
-                params = (string_to_binary_data(min_OPC), )
-            elif max_node:
-                query += "WHERE OPC <= %s"
-                params = (string_to_binary_data(max_OPC), )
+        self.engine.insert_batch(client_message.items)
+        return server_message
 
 
-            self.logger.debug(f"Executing query: {query}, params: {params}")
+    # FIXME: Corresponding logic needs fixing. See README and client/Client.py
+    # for details on query_message() and range_query_message().
+    @protocol.handler(HANDLERS, "query")
+    def on_query(self, client_message):
+        # 此处默认确定性查询
+        query = f"SELECT * FROM {get_table_name()} WHERE insert_num = %s"
+        params = (client_message.ciphertext, )
+        results = self.engine.db_manager.execute_query(query, params)  # 数据库查询操作
 
-            # 执行数据库查询操作
-            try:
-                results = self.db_manager.execute_query(query, params)
-                self.logger.info(results)
-            except Exception as e:
-                self.logger.error(f"Query failed: {e}, query: {query}, params: {params}")
-                return "Query execution failed."
+        # 动态获取列名
+        column_names = [desc[0] for desc in self.engine.db_manager.cursor.description]
 
-            # 检查查询结果是否为空
-            if not results:
-                self.logger.info("Query returned no results.")
-                server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
-                                                        client_message=client_message,
-                                                        query_results=None,
-                                                        message_type="range_query")
+        # 查询结果封装为字典列表
+        query_results = [dict(zip(column_names, row)) for row in results]
 
-            else:
-                # 动态获取列名
-                column_names = [desc[0] for desc in self.db_manager.cursor.description]
+        server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
+                                                client_message=client_message,
+                                                query_results=query_results,
+                                                message_type="query")
+        return server_message
 
-                # 查询结果封装为字典列表
-                query_results = [dict(zip(column_names, row)) for row in results]
 
-                server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
-                                                        client_message=client_message,
-                                                        query_results=query_results,
-                                                        message_type="range_query")
+    # FIXME: Corresponding logic needs fixing. See README and client/Client.py
+    # for details on query_message() and range_query_message().
+    @protocol.handler(HANDLERS, "range_query")
+    def on_range_query(self, client_message):
+        # 判断是否存在 min_path 和 max_path
+        min_node = self.engine.find_node(client_message.min_ciphertext) if client_message.min_ciphertext else None
+        min_path = min_node.path if min_node else ROOT_PATH  # 若找不到节点，赋值为根节点的path
+        min_OPC = path_to_binary_data(min_path)
+
+        max_node = self.engine.find_node(client_message.max_ciphertext) if client_message.max_ciphertext else None
+        max_path = max_node.path if max_node else ROOT_PATH  # 若找不到节点，赋值为根节点的path
+        max_OPC = path_to_binary_data(max_path)
+
+        self.logger.debug(f"min_OPC={min_OPC}, max_OPC={max_OPC}")
+
+        # 根据 min_path和 max_path的存在情况构建查询条件
+        query = f"SELECT * FROM {get_table_name()} "
+        params = ()
+
+        if min_node and max_node:
+            query += "WHERE OPC BETWEEN %s AND %s"
+            params = (min_OPC, max_OPC)
+        elif min_node:
+            query += "WHERE OPC >= %s"
+            params = (min_OPC, )
+        elif max_node:
+            query += "WHERE OPC <= %s"
+            params = (max_OPC, )
+
+
+        self.logger.debug(f"Executing query: {query}, params: {params}")
+
+        # 执行数据库查询操作
+        try:
+            results = self.engine.db_manager.execute_query(query, params)
+            self.logger.info(results)
+        except Exception as e:
+            self.logger.error(f"Query failed: {e}, query: {query}, params: {params}")
+            return None # 查询失败时不回复
+
+        # 检查查询结果是否为空
+        if not results:
+            self.logger.info("Query returned no results.")
+            server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
+                                                    client_message=client_message,
+                                                    query_results=None,
+                                                    message_type="range_query")
 
+        else:
+            # 动态获取列名
+            column_names = [desc[0] for desc in self.engine.db_manager.cursor.description]
 
-        self.logger.debug(f'Sending to Client: {server_message}')
-        self.conn.sendall(pickle.dumps(server_message))
+            # 查询结果封装为字典列表
+            query_results = [dict(zip(column_names, row)) for row in results]
+
+            server_message = protocol.ServerMessage(ciphertext=client_message.ciphertext,
+                                                    client_message=client_message,
+                                                    query_results=query_results,
+                                                    message_type="range_query")
         return server_message
 
-    def update_root(self):
-        while (self.root.parent != None):
-            self.root = self.root.parent
 
 
+READ_ONLY_MESSAGES = {protocol.MessageType(name).code for name in
+                      ["get_root", "move_left", "move_right", "get_node", "find_node_path", "get_common_node", "get_subtree"]}
+DB_QUERY_MESSAGES = {protocol.MessageType(name).code for name in ["query", "range_query"]}
+
+
+class AsyncServer:
+    """
+    asyncio 多连接服务器：所有连接共享同一个 TreeEngine。
+        只读遍历消息直接在事件循环中处理，可在多个连接间并发；
+        插入在 write_lock 下串行执行，树的修改（含 rebalance）在事件循环中完成，其事务交由单线程的数据库线程写入；
+        数据库查询同样持锁在数据库线程中执行（与写入共用一个数据库连接）
+    """
+    def __init__(self, engine, logger):
+        self.engine = engine
+        self.logger = logger
+        self.engine.pending_writes = []
+        self.write_lock = asyncio.Lock()
+        self.db_executor = ThreadPoolExecutor(max_workers=1) # 数据库连接不是线程安全的，只用一个线程
+
+    async def on_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        self.logger.info(f"Connected by {addr}")
+        session = AsyncSession(self, writer)
+        try:
+            await session.run(reader)
+        except (ConnectionResetError, EOFError):
+            self.logger.error(f'{addr}异常断开连接')
+        except Exception as e: # 插入写入数据库失败等：关闭连接，不向客户端报告成功
+            self.logger.error(f'{addr}请求处理失败，连接已关闭: {e!r}')
+        finally:
+            writer.close()
+            self.logger.info(f"{addr}断开连接")
+
+    async def run_in_db_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, fn, *args)
+
+    async def handle(self, session, client_message):
+        code = client_message.message_type.code
+        if code in READ_ONLY_MESSAGES:
+            return session.handle(client_message)
+
+        async with self.write_lock:
+            if code in DB_QUERY_MESSAGES:
+                return await self.run_in_db_thread(session.handle, client_message)
+
+            server_message = session.handle(client_message) # 修改树，事务暂存在 engine.pending_writes
+            try:
+                for statements, opc_updates in self.engine.take_pending_writes():
+                    await self.run_in_db_thread(self.engine.write, statements, opc_updates)
+            except Exception:
+                self.engine.reload_tree() # 在事件循环中重建，避免只读请求看到重建到一半的树
+                raise
+            return server_message
+
+    def close(self):
+        self.db_executor.shutdown()
+        self.engine.pending_writes = None
+
+
+class AsyncSession(Server):
+    """
+    AsyncServer 中单个连接的会话，复用 Server 的处理函数与交互统计。
+    带 request_id 的请求（流水线客户端）各自在独立的任务中处理，响应按完成顺序发送；插入仍在 write_lock 下按到达顺序串行。
+    不带 request_id 的请求逐条处理、按序响应
+    """
+    MAX_IN_FLIGHT = 64 # 单个连接同时处理的流水线请求数上限，达到上限后暂停读取
+
+    def __init__(self, async_server, writer):
+        Server.__init__(self, None, async_server.logger, async_server.engine)
+        self.async_server = async_server
+        self.writer = writer
+        self.in_flight = asyncio.Semaphore(self.MAX_IN_FLIGHT)
+        self.tasks = set()
+
+    async def run(self, reader):
+        pending_message = self.accept_handshake(await protocol.read_frame_async(reader))
+        try:
+            while True:
+                if pending_message is not None:
+                    request_message, pending_message = pending_message, None
+                else:
+                    payload = await protocol.read_frame_async(reader)
+                    if payload is None: # 客户端关闭连接
+                        break
+                    request_message = self.codec.decode(payload)
+                self.logger.debug(f'Received from client : {request_message}')
+
+                self.count_interaction(request_message)
+                if getattr(request_message, 'request_id', None) is None:
+                    await self.respond(request_message)
+                    continue
+
+                await self.in_flight.acquire()
+                task = asyncio.create_task(self.respond(request_message))
+                self.tasks.add(task)
+                task.add_done_callback(self.on_task_done)
+        finally:
+            if self.tasks: # 等待已接收的请求处理完毕
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def respond(self, request_message):
+        server_message = await self.async_server.handle(self, request_message)
+        if server_message is None:
+            return
+        self.logger.debug(f'Sending to Client: {server_message}')
+        self.writer.writelines(protocol.frames(self.codec.encode(server_message))) # 一条消息的各帧一次写入，不与其他响应交错
+        await self.writer.drain()
+
+    def on_task_done(self, task):
+        self.tasks.discard(task)
+        self.in_flight.release()
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error(f'pipelined request failed: {task.exception()!r}')
+            self.writer.close()
+
 def setup_logger():
     logger = logging.getLogger('server_logger')
     logger.setLevel(logging.INFO)
@@ -359,32 +475,79 @@ def setup_logger():
     return logger
 
 
-def start_server(logger, host='localhost', port=65432):
-    """ 若端口被占用，netstat -ano | findstr :65432 --> taskkill /PID ** /F """
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.bind((host, port))
-        server_socket.listen(1)
-        logger.info('Server is listening...')
+def start_server(logger, host='localhost', port=65432, node_store='object', address=None):
+    """ 若端口被占用，netstat -ano | findstr :65432 --> taskkill /PID ** /F
+    address 为 transport 地址（tcp:/unix:/shm:），缺省时按 host/port 使用 TCP """
+    address = address or f"tcp:{host}:{port}"
+    engine = TreeEngine(logger, node_store) # 树只在启动时还原一次，所有连接共享
+    logger.info(f"N={engine.N}")
+
+    with transport.listen(address) as server_socket:
+        logger.info(f'Server is listening on {address}...')
 
         while True:
             try:
                 conn, addr = server_socket.accept()
                 with conn:
                     logger.info(f"Connected by {addr}")
-                    while True:
-                        server = Server(conn, logger)
-                        logger.info(f"N={server.N}")
+                    server = Server(conn, logger, engine)
+                    try:
                         server.run()
+                    finally:
+                        server.close()
+                    logger.info(f"{addr}断开连接")
 
             except ConnectionResetError:
                 logger.error(f'{addr}异常断开连接')
                 continue
+            except Exception as e: # 插入写入数据库失败等：关闭该连接，不向客户端报告成功，继续服务其他连接
+                logger.error(f'{addr}请求处理失败，连接已关闭: {e!r}')
+                continue
             except KeyboardInterrupt:
                 logger.info('服务器关闭')
                 break
-        server_socket.close()
+    engine.close()
+
+
+
+def start_async_server(logger, host='localhost', port=65432, node_store='object', address=None):
+    """asyncio 模式：同时服务多个客户端连接，支持 tcp 与 unix 传输"""
+    scheme, target = transport.parse_address(address or f"tcp:{host}:{port}")
+    if scheme == 'shm':
+        raise ValueError("asyncio mode does not support the shm transport, use tcp or unix")
+    engine = TreeEngine(logger, node_store)
+    logger.info(f"N={engine.N}")
+    async_server = AsyncServer(engine, logger)
+
+    async def serve():
+        if scheme == 'unix':
+            if os.path.exists(target):
+                os.unlink(target)
+            server = await asyncio.start_unix_server(async_server.on_connection, target)
+        else:
+            server = await asyncio.start_server(async_server.on_connection, *target)
+        logger.info('Async server is listening...')
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        logger.info('服务器关闭')
+    finally:
+        async_server.close()
+        engine.close()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--async", dest="use_async", action="store_true", help="asyncio 模式，同时服务多个客户端")
+    parser.add_argument("--node-store", default="object", choices=["object", "array"])
+    parser.add_argument("--address", default=transport.DEFAULT_ADDRESS, help="tcp:<host>:<port>、unix:<path> 或 shm:<path>")
+    args = parser.parse_args()
+
     logger = setup_logger()
-    start_server(logger)
\ No newline at end of file
+    if args.use_async:
+        start_async_server(logger, node_store=args.node_store, address=args.address)
+    else:
+        start_server(logger, node_store=args.node_store, address=args.address)
@@ -62,3 +62,23 @@ class DatabaseManager:
             print(f"插入失败: {err}")
         # finally:
         #     self.close()  # 完成后关闭连接
+
+    def execute_transaction(self, statements):
+        """在同一事务中执行多条数据更新语句，只提交一次；任一语句失败则整体回滚并抛出异常，由调用方处理"""
+        if self.connection == None or self.cursor == None:
+            self.connect()  # 确保连接数据库
+
+        try:
+            for query, params in statements: # statements为[(query, params)]，params为参数元组列表
+                if not params:
+                    continue
+                if len(params) == 1:
+                    self.cursor.execute(query, params[0])
+                else:
+                    self.cursor.executemany(query, params)
+            self.connection.commit()  # 一次提交
+
+        except mysql.connector.Error as err:
+            self.connection.rollback()
+            print(f"事务执行失败，已回滚: {err}")
+            raise
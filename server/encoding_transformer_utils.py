@@ -1,33 +1,99 @@
 selected_table = "dataset" # 默认表名
 
+"""
+OPC编码宽度：32 / 64 为定长编码（BINARY(4) / BINARY(8)），'var' 为变长编码（VARBINARY）。
+path 长度（树深度）必须小于编码位数；修改后需运行 python -m common.migrate_opc 迁移已有数据。
+"""
+OPC_WIDTH = 32
+OPC_VAR_MAX_BYTES = 32 # 变长编码的最大字节数
+
+
+"""
+path 以整数表示：最高位为哨兵'1'，其后依次为从根出发每一层的走向（0左1右），
+即 path 同时携带了 (bits, length) 两部分信息。根节点为 ROOT_PATH(=1)，
+左孩子为 path << 1，右孩子为 (path << 1) | 1，父节点为 path >> 1。
+"""
+ROOT_PATH = 1
+
+
+def path_length(path):
+    return path.bit_length() - 1
+
+
+def path_from_string(path_string):
+    # '0'/'1'字符串 --> 整数path（仅用于与客户端交互的边界）
+    return int('1' + path_string, 2)
+
+
+def path_to_string(path):
+    # 整数path --> '0'/'1'字符串（仅用于与客户端交互的边界）
+    return bin(path)[3:]
+
+
+def common_path(path1, path2):
+    # 两个path的最长公共前缀，即公共祖先的path
+    diff = path_length(path1) - path_length(path2)
+    if diff > 0:
+        path1 >>= diff
+    else:
+        path2 >>= -diff
+    while path1 != path2:
+        path1 >>= 1
+        path2 >>= 1
+    return path1
+
+
+def path_is_prefix(prefix, path):
+    # prefix 是否为 path 的前缀，即 prefix 对应的节点是否为 path 的祖先（或其本身）
+    diff = path_length(path) - path_length(prefix)
+    return diff >= 0 and path >> diff == prefix
+
+
+def OPC_width(path):
+    """path 对应 OPC 的位数：定长编码为 OPC_WIDTH；变长编码为能容纳 path + '1' 的最少整字节"""
+    if OPC_WIDTH == 'var':
+        return (path_length(path) // 8 + 1) * 8
+    return OPC_WIDTH
+
+
+def OPC_column_type():
+    """OPC 列的 MySQL 类型"""
+    if OPC_WIDTH == 'var':
+        return f'VARBINARY({OPC_VAR_MAX_BYTES})'
+    return f'BINARY({OPC_WIDTH // 8})'
+
 
 # path-->OPC
 def path_to_OPC(path):
-    # 在 path 后添加‘1’，然后填充‘0’直到长度为32位
-    OPC = path + '1' + '0' * (32 - len(path) - 1)
-    return OPC
+    # 在 path 后添加‘1’，然后填充‘0’直到长度为 OPC_width 位
+    length = path_length(path)
+    width = OPC_width(path)
+    if length >= min(width, OPC_VAR_MAX_BYTES * 8):
+        raise ValueError(f"path length {length} exceeds {OPC_WIDTH} OPC encoding, increase OPC_WIDTH")
+    return (((path << 1) | 1) ^ (1 << (length + 1))) << (width - length - 1)
 
 # OPC-->path
-def OPC_to_path(OPC):
-    # 找到最后一个‘1’的位置，返回其之前的子字符串
-    last_one_index = OPC.rfind("1")
-    path = OPC[:last_one_index]
-    return path
+def OPC_to_path(OPC, width):
+    # 找到最后一个‘1’的位置，其之前的部分即为path
+    trailing_zeros = (OPC & -OPC).bit_length() - 1
+    length = width - trailing_zeros - 1
+    return (1 << length) | (OPC >> (trailing_zeros + 1))
 
 
-# 将 32 位二进制字符串转换为 4 字节数据（用于插入到数据库）
-def string_to_binary_data(binary_string):
-    # 将二进制字符串转换为整数，然后转换为4字节的二进制数据
-    binary_data = int(binary_string, 2).to_bytes(4, byteorder='big')
-    return binary_data
+"""
+二进制编码按字节大端存放，path + '1' 左对齐、低位补0。MySQL 对 BINARY/VARBINARY 逐字节比较，
+变长编码最后一个字节必含结尾的'1'，因此较短编码是较长编码的前缀时，其顺序与补0后的定长编码一致，
+范围查询依赖的中序顺序不受编码宽度影响。同理，定长编码去掉末尾的 0x00 字节即为变长编码。
+"""
+# 将 path 编码为 OPC 的二进制数据（用于插入到数据库）
+def path_to_binary_data(path):
+    return path_to_OPC(path).to_bytes(OPC_width(path) // 8, byteorder='big')
 
 
-# 将 4 字节数据转换为 32 位二进制字符串（用于从数据库读取后）
-def binary_data_to_string(binary_data):
-    # 将4字节的二进制数据转换为整数，然后转换为32位的二进制字符串
-    binary_string = format(int.from_bytes(binary_data, byteorder='big'), '032b')
-    return binary_string
+# 将数据库中的 OPC 二进制数据还原为 path，按实际字节数解码，兼容任意编码宽度
+def binary_data_to_path(binary_data):
+    return OPC_to_path(int.from_bytes(binary_data, byteorder='big'), len(binary_data) * 8)
 
 
 def get_table_name():
-    return selected_table
\ No newline at end of file
+    return selected_table
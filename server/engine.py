@@ -0,0 +1,533 @@
+import time
+from collections import deque
+from server.db.db_manager import DatabaseManager
+from server.rebalance import rebalance, height, update_metrics, refresh_metrics, balance_factor
+from server.rebalance import OPC_update_statements
+from server.node_store import create_node_store
+from server.snapshot import load_snapshot, save_snapshot, mark_snapshot_dirty, mark_snapshot_clean, snapshot_path
+from server.snapshot import append_rewrites, load_rewrites
+from server.encoding_transformer_utils import path_to_binary_data, binary_data_to_path, ROOT_PATH
+from server.encoding_transformer_utils import path_length, common_path, path_is_prefix
+from server.encoding_transformer_utils import get_table_name
+
+REBALANCE_LOG_SIZE = 4096 # 保留最近多少次 rebalance 的位置，用于校验按旧 epoch 规划的插入
+
+
+class TreeEngine:
+    """
+    进程级的树状态：AVL-N树、节点存储、数据库连接与快照，服务器启动时只构建一次，
+    由所有客户端连接（Server会话）共享，避免每个连接重复还原整棵树
+    """
+    def __init__(self, logger, node_store='object'):
+        self.logger = logger
+        self.db_manager = DatabaseManager()
+
+        self.root = None
+        self.N = 5 # AVL-N
+
+        self.rebalance_time = 0
+        self.rebalance_stats = {'rewritten': 0, 'skipped': 0} # rebalance改写/跳过的编码数（写放大统计）
+
+        # 乐观并发：插入携带客户端比较过的、新值两侧最近的节点，二者仍在中序中相邻即可插入（见 gap_slot），与 rebalance 无关；
+        # 未携带的旧客户端按 epoch 校验：每次 rebalance 重排 epoch 加一，并记录被重排子树根的 path，
+        # 插入位所在的子树在规划所依据的 epoch 之后被重排过则需要重试
+        self.epoch = 0
+        self.rebalance_log = deque(maxlen=REBALANCE_LOG_SIZE) # [(epoch, path)]
+
+        # {ciphertext: node}：全局数据结构，包括此前数据库中已存在的和新插入的
+        # 'object'为每个值一个AVL_Node对象；'array'为紧凑的数组化存储，适用于千万级数据
+        self.node_store = node_store
+        self.tree = create_node_store(node_store)
+        self.path_to_node = {} # {path: AVL_Node}：辅助结构，从数据库中恢复树
+
+        self.snapshot_file = snapshot_path(get_table_name()) # 树快照文件
+        self.snapshot_interval = 1000 # 每插入多少条数据写一次快照
+        self.snapshot_clean = False # 快照是否仍与数据库一致
+        self.snapshot_id_num = 0 # 最近一次快照时的 id_num
+
+        # 为 None 时插入立即写入数据库；异步服务器将其置为列表，插入只修改树并暂存事务，由数据库线程写入
+        self.pending_writes = None
+
+        self.id_num = self.restore_tree()
+        if not self.snapshot_clean:
+            self.save_snapshot()
+        else:
+            self.snapshot_id_num = self.id_num
+
+
+    def restore_tree(self):
+        """优先从本地快照还原树，只补读快照之后新插入的行并应用改写日志；快照不可用时从数据库全量还原"""
+        snapshot = load_snapshot(self.snapshot_file, get_table_name(), self.tree)
+        if snapshot is not None:
+            root, id_num, watermark = snapshot
+            if watermark <= self.get_max_id(): # 表被清空或重建后快照作废
+                self.root = root
+                id_num = self.replay_rows_since(watermark, id_num, load_rewrites(self.snapshot_file))
+                self.snapshot_clean = True
+                print(f"树结构已从快照还原，树高{height(self.root)}")
+                self.logger.info(f"节点数{len(self.tree)}，快照水位线id={watermark}")
+                return id_num
+            self.tree = create_node_store(self.node_store)
+
+        return self.restore_tree_from_db()
+
+
+    def replay_rows_since(self, watermark, id_num, rewrites):
+        """
+        将快照水位线之后插入的行挂到树上，rewrites = {insert_num: OPC} 为快照之后已有行的编码改写。
+        批量插入的新行以 rebalance 之后的最终编码写入，按 id 顺序时父节点可能排在孩子之后，
+        因此先按插入顺序创建节点（重复值的 id 保持插入顺序），再按 path 从浅到深挂入
+        """
+        query = f"SELECT insert_num, OPC FROM {get_table_name()} WHERE id > %s ORDER BY id"
+        results = self.db_manager.execute_query(query, (watermark, )) or []
+
+        if rewrites: # 已有节点的 path 改变后原有连接失效：按最终 path 重新连接整棵树（只读本地文件与增量行）
+            nodes = self.subtree_nodes(self.root)
+            for value, OPC in rewrites.items():
+                node = self.find_node(value) # 快照之后新插入的行不在树中，其最终编码即数据库中的 OPC
+                if node is not None:
+                    node.path = binary_data_to_path(OPC)
+
+        new_nodes = []
+        for insert_num, OPC in results:
+            id_num += 1
+            node = self.find_node(insert_num)
+            if node is not None: # 重复节点
+                node.ids.append(id_num)
+                continue
+            new_nodes.append(self.tree.new_node(insert_num, binary_data_to_path(OPC)))
+
+        if rewrites:
+            for node in nodes:
+                node.left = node.right = node.parent = None
+            self.link_by_path({node.path: node for node in nodes + new_nodes})
+            return id_num
+
+        new_nodes.sort(key=lambda node: node.path) # path 越短整数越小，父节点一定在孩子之前
+        for new_node in new_nodes:
+            path = new_node.path
+            if path == ROOT_PATH:
+                self.root = new_node
+                continue
+
+            parent_node = self.path_to_find_node(path >> 1)
+            if path & 1 == 0:
+                parent_node.left = new_node
+            else:
+                parent_node.right = new_node
+            new_node.parent = parent_node
+
+            while parent_node:
+                update_metrics(parent_node)
+                parent_node = parent_node.parent
+
+        return id_num
+
+
+    def get_max_id(self):
+        results = self.db_manager.execute_query(f"SELECT MAX(id) FROM {get_table_name()}")
+        if not results or results[0][0] is None:
+            return 0
+        return results[0][0]
+
+
+    def save_snapshot(self):
+        save_snapshot(self.snapshot_file, get_table_name(), self.tree, self.root, self.id_num, self.get_max_id())
+        self.snapshot_clean = True
+        self.snapshot_id_num = self.id_num
+
+
+    def close(self):
+        """服务器关闭时写出快照并断开数据库"""
+        self.save_snapshot()
+        self.db_manager.close()
+
+
+    def restore_tree_from_db(self):
+        id_num = 0
+        """从数据库中还原树结构"""
+        query = f"SELECT insert_num, OPC FROM {get_table_name()}"
+        results = self.db_manager.execute_query(query) # 元组列表
+
+        """
+        两遍插入
+            第一遍：创建根节点。先创建所有节点对象并存储到一个字典 path_to_node 中，不进行实际的树连接。
+            第二遍：构建树结构。遍历 path_to_node，根据 path 逐步连接父节点与子节点。
+        """
+        # 创建所有节点并存储到path_to_node、tree中
+        for insert_num, OPC in results:
+            # print(f'{insert_num}: {OPC}')
+
+            id_num += 1 # 同样明文的id
+            # 获取节点路径
+            path = binary_data_to_path(OPC)
+
+            # 避免重复节点
+            if path in self.path_to_node:
+                self.path_to_node[path].ids.append(id_num)
+                self.logger.debug(f"跳过重复节点：insert_num={insert_num}")
+                continue
+
+            # 创建新节点，存储路径和节点
+            new_node = self.tree.new_node(insert_num, path)
+            self.path_to_node[path] = new_node
+
+        # print(f'path_to_node:{self.path_to_node}')
+
+        # 按照path构建树结构
+        self.link_by_path(self.path_to_node)
+
+        print(f"树结构已还原，树高{height(self.root)}")
+        self.logger.info(f"节点数{len(self.tree)}")
+
+        return id_num
+
+
+    def link_by_path(self, path_to_node):
+        """按 path 连接 {path: 节点} 中的节点并设置根节点，再刷新缓存的高度和规模"""
+        for path, new_node in path_to_node.items():
+            # root node
+            if path == ROOT_PATH:
+                self.root = new_node
+            else:
+                # 找到父节点路径(父节点一定存在)
+                parent_path = path >> 1
+                parent_node = path_to_node[parent_path]
+
+                # 确定插入位置
+                if path & 1 == 0:
+                    parent_node.left = new_node
+                else:
+                    parent_node.right = new_node
+
+                new_node.parent = parent_node
+
+        refresh_metrics(self.root)
+
+
+    def subtree_nodes(self, node):
+        """以 node 为根的子树中的所有节点"""
+        nodes = []
+        stack = [node] if node else []
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right:
+                stack.append(node.right)
+            if node.left:
+                stack.append(node.left)
+        return nodes
+
+
+    def find_node(self, ciphertext):
+        return self.tree.find(ciphertext)
+
+
+    def path_to_find_node(self, path):
+        cur_node = self.root
+        for i in range(path_length(path) - 1, -1, -1):
+            if (path >> i) & 1 == 0:
+                cur_node = cur_node.left
+            else:
+                cur_node = cur_node.right
+        return cur_node
+
+
+    def get_public_ancestor_node(self, path):
+        return self.path_to_find_node(common_path(path[0], path[1]))
+
+
+    def subtree(self, node, depth):
+        """以 node 为根的前 depth 层节点，先序返回 [(密文, 相对path字符串)]"""
+        nodes = []
+        stack = [(node, '')] if node else []
+        while stack:
+            node, path = stack.pop()
+            nodes.append((node.value, path))
+            if len(path) + 1 < depth:
+                if node.right:
+                    stack.append((node.right, path + '1'))
+                if node.left:
+                    stack.append((node.left, path + '0'))
+        return nodes
+
+
+    def insert(self, ciphertext, new_ciphertext, insert_direction):
+        """将 new_ciphertext 作为 ciphertext 的 insert_direction 孩子插入（二者相同表示重复值），新节点的path由父节点确定；返回该值所在节点"""
+        self.id_num += 1
+        opc_updates = {} # {insert_num: OPC}
+
+        # 树节点的更新
+        if new_ciphertext == ciphertext: # 树中已有节点
+            node = self.find_node(ciphertext)
+            node.ids.append(self.id_num)
+            path = node.path
+
+        else: # 新插入节点（与从数据库还原时一致，ids 只记录重复值的 id）
+            new_node = self.tree.new_node(new_ciphertext)
+
+            # root case
+            if ciphertext == None:
+                path = ROOT_PATH
+                self.root = new_node
+            else:
+                node = self.find_node(ciphertext)
+                new_node.parent = node
+
+                if (insert_direction == "left"):
+                    node.left = new_node
+                    path = node.path << 1
+                elif (insert_direction == "right"):
+                    node.right = new_node
+                    path = (node.path << 1) | 1
+
+            new_node.path = path
+            if ciphertext != None:
+                self.rebalance_from(node, opc_updates)
+
+        # 数据库更新：新行与rebalance引起的编码改写在同一事务中写入MySQL（新行的编码取 rebalance 之前的 path，
+        # 若其随后被改写，opc_updates 中的改写在同一事务中覆盖）
+        update_params = [(new_ciphertext, path_to_binary_data(path))]
+        self.commit(update_params, opc_updates)
+        return self.find_node(new_ciphertext)
+
+
+    def neighbor(self, node, direction):
+        """node 的中序前驱(left)/后继(right)；node 为 None（无界一侧）时返回树中最大/最小的节点"""
+        near, far = ("left", "right") if direction == "left" else ("right", "left")
+        if node is None:
+            node = self.root
+        elif getattr(node, near) is not None: # near 子树中最靠近 node 的节点
+            node = getattr(node, near)
+        else: # 向上找到第一个 node 位于其 far 子树中的祖先
+            while node.parent is not None and getattr(node.parent, near) == node:
+                node = node.parent
+            return node.parent
+        while node is not None and getattr(node, far) is not None:
+            node = getattr(node, far)
+        return node
+
+
+    def gap_slot(self, lower_ciphertext, upper_ciphertext):
+        """
+        客户端比较得出新值位于 lower 与 upper 之间（None 表示该侧无界）。二者现在仍在中序中相邻时，
+        二者之间的间隙即新值的位置，返回其空位 (父节点, 方向)，空树返回 (None, None)；
+        二者之间已插入了其他值（或节点不存在）时返回 None。只取决于间隙本身，期间的 rebalance 不影响结果
+        """
+        lower = self.find_node(lower_ciphertext) if lower_ciphertext is not None else None
+        upper = self.find_node(upper_ciphertext) if upper_ciphertext is not None else None
+        if (lower is None) != (lower_ciphertext is None) or (upper is None) != (upper_ciphertext is None):
+            return None
+        if self.neighbor(lower, "right") != upper:
+            return None
+        if lower is None and upper is None: # 空树
+            return None, None
+        if lower is not None and lower.right is None:
+            return lower, "right"
+        return upper, "left" # 相邻时 lower 有右子树则 upper 为其中最小的节点，左孩子为空
+
+
+    def replan_start(self, lower_ciphertext, upper_ciphertext):
+        """间隙已被占用时客户端重新规划的起点：lower 与 upper 的最近公共祖先，其子树包含二者之间的所有节点；一侧无界时为根"""
+        lower = self.find_node(lower_ciphertext) if lower_ciphertext is not None else None
+        upper = self.find_node(upper_ciphertext) if upper_ciphertext is not None else None
+        if lower is None or upper is None:
+            return self.root
+        return self.get_public_ancestor_node([lower.path, upper.path])
+
+
+    def slot_is_valid(self, epoch, parent_ciphertext, direction):
+        """
+        未携带 bounds 的客户端按 epoch 时的树规划的插入位（parent 的 direction 孩子）现在是否仍然有效：
+        该空位未被占用，且此后没有发生包含该位置的 rebalance（被重排子树根的 path 为父节点 path 的前缀）
+        """
+        if parent_ciphertext is None: # 空树的根
+            return self.root is None
+        parent = self.find_node(parent_ciphertext)
+        if parent is None:
+            return False
+        if (parent.left if direction == "left" else parent.right) is not None: # 空位已被其他插入占用
+            return False
+        if epoch is None or epoch == self.epoch: # 未携带 epoch 的旧客户端只校验空位
+            return True
+        rebalanced = self.rebalanced_since(epoch)
+        if rebalanced is None:
+            return False
+        return not any(path_is_prefix(path, parent.path) for path in rebalanced)
+
+
+    def rebalanced_since(self, epoch):
+        """epoch 之后被重排的子树根 path（去重）；日志中已没有完整记录时返回 None"""
+        if epoch >= self.epoch:
+            return []
+        if not self.rebalance_log or epoch + 1 < self.rebalance_log[0][0]:
+            return None
+        paths = set()
+        for log_epoch, path in reversed(self.rebalance_log):
+            if log_epoch <= epoch:
+                break
+            paths.add(path)
+        return list(paths)
+
+
+    def batch_is_valid(self, epoch, items, bounds=None):
+        """
+        批量插入中以已有节点为锚点的插入位均需有效；以本批次节点为锚点的随之有效。
+        bounds 与 items 一一对应时按间隙校验：锚点为间隙靠近新值的一端（right 为下界，left 为上界），且两端仍相邻
+        """
+        new_values = set()
+        for i, (anchor_ciphertext, new_ciphertext, direction) in enumerate(items):
+            if new_ciphertext == anchor_ciphertext:
+                if anchor_ciphertext not in new_values and self.find_node(anchor_ciphertext) is None:
+                    return False
+                continue
+            if anchor_ciphertext not in new_values:
+                if bounds is not None and bounds[i] is not None:
+                    lower_ciphertext, upper_ciphertext = bounds[i]
+                    if anchor_ciphertext != (lower_ciphertext if direction == "right" else upper_ciphertext):
+                        return False
+                    if self.gap_slot(lower_ciphertext, upper_ciphertext) is None:
+                        return False
+                elif not self.slot_is_valid(epoch, anchor_ciphertext, direction):
+                    return False
+            new_values.add(new_ciphertext)
+        return True
+
+
+    def insert_batch(self, items):
+        """
+        批量插入 items = [(锚点密文, 新密文, 方向)]，按明文升序排列。方向为 left/right 表示新节点是锚点的中序前驱/后继，
+        锚点可以是本批次中更早插入的节点；锚点与新密文相同表示重复值，锚点为 None 表示空树的根。
+        AVL-N 的重排假设一次只有一个节点失衡，因此仍逐条挂入并沿祖先 rebalance，
+        但所有新行及编码改写只在最后写入一次：新行直接写入最终的 OPC，同一行的多次改写合并为一次
+        """
+        opc_updates = {} # {insert_num: OPC}
+        inserted = [] # 按插入顺序的节点（重复值为已有节点）
+        new_values = set()
+
+        for anchor_ciphertext, new_ciphertext, direction in items:
+            self.id_num += 1
+            if new_ciphertext == anchor_ciphertext: # 重复值
+                node = self.find_node(new_ciphertext)
+                node.ids.append(self.id_num)
+                inserted.append(node)
+                continue
+
+            new_node = self.tree.new_node(new_ciphertext)
+            inserted.append(new_node)
+            new_values.add(new_ciphertext)
+
+            if anchor_ciphertext is None: # 空树
+                new_node.path = ROOT_PATH
+                self.root = new_node
+                continue
+
+            parent = self.place(self.find_node(anchor_ciphertext), new_node, direction)
+            self.rebalance_from(parent, opc_updates)
+
+        # 新行尚不存在于数据库中，直接以最终编码写入，无需再改写
+        for value in new_values:
+            opc_updates.pop(value, None)
+        update_params = [(node.value, path_to_binary_data(node.path)) for node in inserted]
+        self.commit(update_params, opc_updates)
+
+
+    def place(self, anchor, new_node, direction):
+        """将 new_node 挂为 anchor 的中序前驱(left)/后继(right)，由树结构确定位置并设置其path，返回父节点"""
+        if direction == "left":
+            parent = anchor.left
+            if parent is None:
+                parent = anchor
+                parent.left = new_node
+            else:
+                while parent.right:
+                    parent = parent.right
+                parent.right = new_node
+        else:
+            parent = anchor.right
+            if parent is None:
+                parent = anchor
+                parent.right = new_node
+            else:
+                while parent.left:
+                    parent = parent.left
+                parent.left = new_node
+
+        new_node.parent = parent
+        new_node.path = (parent.path << 1) | (1 if parent.right == new_node else 0)
+        return parent
+
+
+    def rebalance_from(self, node, opc_updates):
+        start_time = time.perf_counter()
+
+        # AVL-N rebalance：server维护树的平衡以及编码的更新
+        # 沿插入路径自底向上逐个祖先刷新缓存的高度和规模（O(1)），再检查是否失衡。
+        # 不在高度不再变化处提前结束：重排可能使某些节点仍超出 N（见 server_test.TestRebalance），
+        # 之后经过它们的插入即使下层高度不变也需要在此处重排
+        while node:
+            update_metrics(node)
+            if abs(balance_factor(node)) > self.N:
+                self.epoch += 1
+                self.rebalance_log.append((self.epoch, node.path))
+            node = rebalance(node, opc_updates, self.logger, self.N, self.rebalance_stats)
+            node = node.parent
+
+        end_time = time.perf_counter()
+        self.rebalance_time += end_time - start_time
+
+        self.update_root()
+
+
+    def commit(self, update_params, opc_updates):
+        """新行 update_params = [(insert_num, OPC)] 与已有行的编码改写在同一事务中写入MySQL"""
+        update_query = f"INSERT INTO {get_table_name()}(insert_num, OPC) VALUES(%s, %s)"
+        statements = [(update_query, update_params)] + OPC_update_statements(opc_updates)
+        if self.pending_writes is not None: # 异步服务器：事务交由数据库线程写入
+            self.pending_writes.append((statements, opc_updates))
+            return
+        try:
+            self.write(statements, opc_updates)
+        except Exception:
+            self.reload_tree()
+            raise
+
+
+    def write(self, statements, opc_updates):
+        # 改写已有行的编码：提交前令快照失效，提交后将改写追加到改写日志，快照重新有效；
+        # 事务失败或期间中断时快照保持失效，直到下一次写出快照
+        if opc_updates and self.snapshot_clean:
+            mark_snapshot_dirty(self.snapshot_file)
+            self.snapshot_clean = False
+            self.db_manager.execute_transaction(statements)
+            append_rewrites(self.snapshot_file, opc_updates)
+            mark_snapshot_clean(self.snapshot_file)
+            self.snapshot_clean = True
+        else:
+            self.db_manager.execute_transaction(statements)
+
+        if self.id_num - self.snapshot_id_num >= self.snapshot_interval:
+            self.save_snapshot()
+
+
+    def reload_tree(self):
+        """
+        事务写入失败（已回滚）后丢弃树中未写入数据库的修改：从数据库全量重建树，
+        并记录一次以根为前缀的重排，使按旧树规划的插入与客户端缓存的 path 全部失效
+        """
+        self.root = None
+        self.tree = create_node_store(self.node_store)
+        self.path_to_node = {}
+        self.id_num = self.restore_tree_from_db()
+        self.epoch += 1
+        self.rebalance_log.append((self.epoch, ROOT_PATH))
+
+
+    def take_pending_writes(self):
+        pending_writes, self.pending_writes = self.pending_writes, []
+        return pending_writes
+
+
+    def update_root(self):
+        while (self.root.parent != None):
+            self.root = self.root.parent
@@ -0,0 +1,175 @@
+from array import array
+
+from server.rebalance import AVL_Node
+
+NIL = -1 # 数组中表示空指针的下标
+PATH_LIMIT = 1 << 64 # path 数组的表示范围（含哨兵位，即不超过 63 层）
+
+
+class ObjectNodeStore:
+    '''每个值对应一个 AVL_Node 对象（默认实现）'''
+    def __init__(self):
+        self.ope_table = {} # {ciphertext: AVL_Node}
+
+    def new_node(self, value, path=None):
+        node = AVL_Node(value, path)
+        self.ope_table[value] = node
+        return node
+
+    def find(self, value):
+        return self.ope_table.get(value)
+
+    def ids_of(self, node):
+        return node.ids
+
+    def __len__(self):
+        return len(self.ope_table)
+
+
+class ArrayNodeStore:
+    '''
+    紧凑的数组化节点存储：孩子/父节点下标、高度、规模、path 分别存放在并行的定长数组中，
+    密文单独存放在 values 表中（每个密文只保存一份），duplicate_ids 只记录存在重复值的节点。
+    对外通过 ArrayNode 视图提供与 AVL_Node 相同的属性，rebalance 无需区分两种实现。
+    '''
+    def __init__(self):
+        self.values = [] # 下标 -> 密文
+        self.index = {} # 密文 -> 下标
+        self.left = array('i')
+        self.right = array('i')
+        self.parent = array('i')
+        self.height = array('B')
+        self.size = array('I')
+        self.path = array('Q') # 整数path，0 表示尚未设置或存放在 long_paths 中
+        self.long_paths = {} # {下标: path}：超过 63 层（变长 OPC 允许）的 path，只有极少数最深的节点
+        self.duplicate_ids = {} # {下标: [id]}，节点的第一个 id 不记录
+
+    def _append(self, value):
+        idx = len(self.values)
+        self.values.append(value)
+        self.left.append(NIL)
+        self.right.append(NIL)
+        self.parent.append(NIL)
+        self.height.append(1)
+        self.size.append(1)
+        self.path.append(0)
+        return idx
+
+    def new_node(self, value, path=None):
+        idx = self._append(value)
+        self.index[value] = idx
+        node = ArrayNode(self, idx)
+        node.path = path
+        return node
+
+    def find(self, value):
+        idx = self.index.get(value)
+        return ArrayNode(self, idx) if idx is not None else None
+
+    def ids_of(self, node):
+        # 只读访问，不为没有重复值的节点创建空列表
+        return self.duplicate_ids.get(node.idx, ())
+
+    def node(self, idx):
+        return ArrayNode(self, idx) if idx != NIL else None
+
+    def __len__(self):
+        return len(self.index)
+
+
+class ArrayNode:
+    '''ArrayNodeStore 中某个下标的轻量视图，按下标判等'''
+    __slots__ = ('store', 'idx')
+
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    def __eq__(self, other):
+        return isinstance(other, ArrayNode) and self.idx == other.idx and self.store is other.store
+
+    def __hash__(self):
+        return self.idx
+
+    @property
+    def value(self):
+        return self.store.values[self.idx]
+
+    @property
+    def left(self):
+        return self.store.node(self.store.left[self.idx])
+
+    @left.setter
+    def left(self, node):
+        self.store.left[self.idx] = node.idx if node is not None else NIL
+
+    @property
+    def right(self):
+        return self.store.node(self.store.right[self.idx])
+
+    @right.setter
+    def right(self, node):
+        self.store.right[self.idx] = node.idx if node is not None else NIL
+
+    @property
+    def parent(self):
+        return self.store.node(self.store.parent[self.idx])
+
+    @parent.setter
+    def parent(self, node):
+        self.store.parent[self.idx] = node.idx if node is not None else NIL
+
+    @property
+    def path(self):
+        return self.store.path[self.idx] or self.store.long_paths.get(self.idx)
+
+    @path.setter
+    def path(self, path):
+        if path is not None and path >= PATH_LIMIT:
+            self.store.path[self.idx] = 0
+            self.store.long_paths[self.idx] = path
+            return
+        self.store.path[self.idx] = path if path is not None else 0
+        if self.store.long_paths:
+            self.store.long_paths.pop(self.idx, None)
+
+    @property
+    def height(self):
+        return self.store.height[self.idx]
+
+    @height.setter
+    def height(self, height):
+        self.store.height[self.idx] = height
+
+    @property
+    def size(self):
+        return self.store.size[self.idx]
+
+    @size.setter
+    def size(self, size):
+        self.store.size[self.idx] = size
+
+    @property
+    def ids(self):
+        return self.store.duplicate_ids.setdefault(self.idx, [])
+
+    def __repr__(self):
+        left_value = self.left.value if self.left else None
+        right_value = self.right.value if self.right else None
+        parent_value = self.parent.value if self.parent else None
+
+        return f"ArrayNode(value={self.value}, " \
+               f"left={left_value}, right={right_value}, " \
+               f"parent={parent_value}, path={self.path})"
+
+
+NODE_STORES = {
+    'object': ObjectNodeStore,
+    'array': ArrayNodeStore,
+}
+
+
+def create_node_store(node_store):
+    if node_store not in NODE_STORES:
+        raise ValueError(f"Unsupported node store '{node_store}'. Use one of {list(NODE_STORES)}.")
+    return NODE_STORES[node_store]()
@@ -1,14 +1,11 @@
-from server.encoding_transformer_utils import path_to_OPC, string_to_binary_data
+from server.encoding_transformer_utils import path_to_binary_data
 from server.encoding_transformer_utils import get_table_name
-
-class CBT_node: # complete binary tree
-    def __init__(self, value):
-        self.value = value
-        self.left = None
-        self.right = None
+from functools import lru_cache
 
 
 class AVL_Node:
+    __slots__ = ('value', 'left', 'right', 'parent', 'path', 'ids', 'height', 'size')
+
     def __init__(self, v, path=None):
         self.value = v
         self.left = None
@@ -16,6 +13,8 @@ class AVL_Node:
         self.parent = None
         self.path = path
         self.ids = []  # 存储数据库中具有相同值的不同 ID
+        self.height = 1  # 缓存：以该节点为根的子树高度
+        self.size = 1  # 缓存：以该节点为根的子树节点数
 
     # __repr__ 用于调试打印
     def __repr__(self):
@@ -26,20 +25,13 @@ class AVL_Node:
 
         return f"AVL_Node(value={self.value}, " \
                f"left={left_value}, right={right_value}, " \
-               f"parent={parent_value}, path={self.path})" \
+               f"parent={parent_value}, path={self.path})"
 
 
 def subtree_size(node):
     if node is None:
         return 0
-    if node.left is None and node.right is None:
-        return 1
-    elif node.left is None:
-        return 1 + subtree_size(node.right)
-    elif node.right is None:
-        return 1 + subtree_size(node.left)
-    else:
-        return 1 + subtree_size(node.left) + subtree_size(node.right)
+    return node.size
 
 def counter(fn):
     def wrapper(*args, **kwargs):
@@ -54,58 +46,90 @@ def counter(fn):
 def height(node):
     if node is None:
         return 0
-    if node.left is None and node.right is None:
-        return 1
-    elif node.left is None:
-        return 1 + height(node.right)
-    elif node.right is None:
-        return 1 + height(node.left)
-    else:
-        return 1 + max(height(node.left), height(node.right))
+    return node.height
+
+
+def update_metrics(node):
+    '''由左右孩子的缓存值重新计算node的高度和子树规模，O(1)'''
+    node.height = 1 + max(height(node.left), height(node.right))
+    node.size = 1 + subtree_size(node.left) + subtree_size(node.right)
+
+
+def refresh_metrics(root):
+    '''自底向上重新计算整棵树的缓存高度和子树规模（用于从数据库还原树之后）'''
+    stack = [root] if root else []
+    order = []
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if node.left:
+            stack.append(node.left)
+        if node.right:
+            stack.append(node.right)
+
+    # 孩子一定排在父节点之后，逆序处理即可保证先孩子后父节点
+    for node in reversed(order):
+        update_metrics(node)
 
 
 def balance_factor(node):
     return height(node.left) - height(node.right)
 
 
-def update_paths(node, path, db_manager, logger): # 更新以node为根的子树的path
+def update_paths(node, path, opc_updates, logger, restructured, stats): # 更新以node为根的子树的path
+    '''
+    只记录 path 实际发生变化的节点。restructured 为本次重排涉及的主干节点集合，
+    其余节点所在子树的内部结构未变：若子树根的 path 不变，则整棵子树都无需改写
+    '''
     if node is None:
         return
 
-    if node.path != path:
+    if node.path == path:
+        if node not in restructured:
+            stats['skipped'] += node.size
+            return
+        stats['skipped'] += 1
+    else:
         node.path = path
 
-    # 同步调整数据库中的编码值
-    OPC = path_to_OPC(path)
-    update_query = f"UPDATE {get_table_name()} SET OPC = %s WHERE insert_num = %s"
-    update_params = [(string_to_binary_data(OPC), node.value)]
-    db_manager.execute_update(update_query, update_params)  # 数据插入到数据库中
+        # 记录待同步到数据库的编码值 {insert_num: OPC}，由调用方在同一事务中批量写入
+        opc_updates[node.value] = path_to_binary_data(path)
+        stats['rewritten'] += 1
 
     if node.left:
-        update_paths(node.left, path + "0", db_manager, logger)
+        update_paths(node.left, path << 1, opc_updates, logger, restructured, stats)
     if node.right:
-        update_paths(node.right, path + "1", db_manager, logger)
+        update_paths(node.right, (path << 1) | 1, opc_updates, logger, restructured, stats)
 
 
-def _create_complete_binary_tree(N):
-    if N < 1:
-        return None
-    node_num = 2 * N + 5
-    nodes = [CBT_node(i) for i in range(1, node_num + 1)]
+OPC_UPDATE_CHUNK = 500 # 单条 UPDATE 语句最多改写的行数，避免超出 max_allowed_packet
 
-    for i in range(node_num):
-        left_child_index = 2 * i + 1
-        right_child_index = 2 * i + 2
-        if left_child_index < node_num:
-            nodes[i].left = nodes[left_child_index]
-        if right_child_index < node_num:
-            nodes[i].right = nodes[right_child_index]
+def OPC_update_statements(opc_updates):
+    '''将 {insert_num: OPC} 合并为 UPDATE ... CASE 语句，每 OPC_UPDATE_CHUNK 行一条，返回 [(query, params)]'''
+    statements = []
+    items = list(opc_updates.items())
+    for start in range(0, len(items), OPC_UPDATE_CHUNK):
+        chunk = items[start:start + OPC_UPDATE_CHUNK]
+        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+        placeholders = ", ".join(["%s"] * len(chunk))
+        query = f"UPDATE {get_table_name()} SET OPC = CASE insert_num {cases} END WHERE insert_num IN ({placeholders})"
+        params = [item for pair in chunk for item in pair] + [insert_num for insert_num, _ in chunk]
+        statements.append((query, [tuple(params)]))
+    return statements
+
+
+EMPTY = None # 失衡节点数组中表示空从属子树的标记
 
-    return nodes
 
 def collect_unbalanced_nodes(node, logger, N):
-    '''收集失衡节点，返回节点数组list'''
-    list = [None] * (2*N+6)
+    '''
+    收集失衡节点，返回 (节点数组list, 主干方向数组main_left)：
+    list[1..N+2] 为主干节点，list[N+3..2N+5] 为从属子树的根，空子树记为 EMPTY；
+    main_left[i] 表示主干节点 list[i] 的下一个主干节点是否为其左孩子。
+    只读取现有的树，不向树中挂入任何虚拟节点
+    '''
+    list = [EMPTY] * (2*N+6)
+    main_left = [False] * (N+2)
     list[1] = node
     cur_node = node
 
@@ -114,16 +138,8 @@ def collect_unbalanced_nodes(node, logger, N):
         left_height = height(cur_node.left)
         right_height = height(cur_node.right)
 
-        if left_height == 0:
-            left_node = AVL_Node(list.index(cur_node)+N+3, cur_node.path + '0')
-            cur_node.left = left_node
-            left_node.parent = cur_node
-        elif right_height == 0:
-            right_node = AVL_Node(list.index(cur_node)+N+3, cur_node.path + '1')
-            cur_node.right = right_node
-            right_node.parent = cur_node
-
         if left_height > right_height:
+            main_left[i] = True
             list[i+1] = cur_node.left
             list[i+N+3] = cur_node.right
             cur_node = cur_node.left
@@ -132,43 +148,44 @@ def collect_unbalanced_nodes(node, logger, N):
             list[i+N+3] = cur_node.left
             cur_node = cur_node.right
 
-    if list[N+2].left == None:
-        left_node = AVL_Node(N+3, list[N + 2].path + '0')
-        list[N + 2].left = left_node
-        left_node.parent = list[N+2]
-    if list[N+2].right == None:
-        right_node = AVL_Node(2*N+5, list[N + 2].path + '1')
-        list[N + 2].right = right_node
-        right_node.parent = list[N+2]
-
     list[N+3] = list[N+2].left
     list[2*N+5] = list[N+2].right
 
-    return list
+    return list, main_left
 
 
-def LDR(cur_node, list, arr, logger):
-    '''中序遍历失衡子树，生成中序遍历节点编号数组arr'''
-    if cur_node is None:
-        return
+def LDR(main_left, N):
+    '''按主干方向得到失衡子树的中序遍历节点编号数组arr（从属子树视为一个整体，空子树同样占一个编号）'''
+    # 最底层主干节点 N+2 的左右从属子树编号分别为 N+3、2N+5
+    left_part = [N+3]
+    right_part = [2*N+5]
+    middle = N+2
 
-    LDR(cur_node.left, list, arr, logger)
-    logger.debug(f"cur_node={cur_node}")
-    if cur_node in list:
-        arr.append(list.index(cur_node))
-    else:
-        return
-    LDR(cur_node.right, list, arr, logger)
+    # 自底向上：主干在左时，当前主干节点及其从属子树依次接在已得序列右侧，反之接在左侧
+    for i in range(N+1, 0, -1):
+        part = right_part if main_left[i] else left_part
+        part.append(i)
+        part.append(i+N+3)
+
+    # left_part 由内向外收集，需反转后才是中序
+    return left_part[::-1] + [middle] + right_part
 
 
-def ordered_complete_binary_tree(N, logger):
-    '''构建有序完全二叉树，数组arr2'''
-    nodes = _create_complete_binary_tree(N)
-    nodes.insert(0, CBT_node(0))
-    root_node = nodes[1]
+@lru_cache(maxsize=None)
+def ordered_complete_binary_tree(N):
+    '''构建有序完全二叉树（2N+5个节点，编号i的孩子为2i、2i+1），返回其中序遍历编号数组arr2；只与N有关，按N缓存'''
+    node_num = 2 * N + 5
     arr2 = []
-    LDR(root_node, nodes, arr2, logger)
-    return arr2
+
+    def LDR_CBT(i):
+        if i > node_num:
+            return
+        LDR_CBT(2 * i)
+        arr2.append(i)
+        LDR_CBT(2 * i + 1)
+
+    LDR_CBT(1)
+    return tuple(arr2)
 
 
 def reordering_complete_binary_tree(N, arr1, arr2, list, logger):
@@ -191,17 +208,21 @@ def reordering_complete_binary_tree(N, arr1, arr2, list, logger):
 
         cur_node = list[index[i]]
 
-        if left_child_index < node_num and list[index[left_child_index]].value not in range(2*N+6): # 左孩子存在且非虚拟节点
+        if left_child_index < node_num: # 左孩子位置存在，空从属子树(EMPTY)即无孩子
             cur_node.left = list[index[left_child_index]]
-            list[index[left_child_index]].parent = cur_node
-        elif left_child_index < node_num and list[index[left_child_index]].value in range(2*N+6):
-            cur_node.left = None
+            if cur_node.left is not EMPTY:
+                cur_node.left.parent = cur_node
 
-        if right_child_index < node_num and list[index[right_child_index]].value not in range(2*N+6): # 右孩子存在且非虚拟节点
+        if right_child_index < node_num:
             cur_node.right = list[index[right_child_index]]
-            list[index[right_child_index]].parent = cur_node
-        elif right_child_index < node_num and list[index[right_child_index]].value in range(2*N+6):
-            cur_node.right = None
+            if cur_node.right is not EMPTY:
+                cur_node.right.parent = cur_node
+
+    # 叶子位置上的子树结构不变，自底向上只需按完全二叉树的下标逆序刷新缓存的高度和规模
+    for i in range(node_num - 1, -1, -1):
+        cur_node = list[index[i]]
+        if cur_node is not EMPTY:
+            update_metrics(cur_node)
 
     return root_node
 
@@ -215,27 +236,32 @@ def print_tree(root, logger):
 
 
 @counter
-def rebalance(node, db_manager, logger, N):
+def rebalance(node, opc_updates, logger, N, stats=None):
+    '''stats 非空时累加本次重排改写/跳过的编码数 {'rewritten': , 'skipped': }'''
     if abs(balance_factor(node)) > N:
         path = node.path
         parent = node.parent
 
-        unbalanced_nodes_list = collect_unbalanced_nodes(node, logger, N)
-
-        arr1 = []
+        unbalanced_nodes_list, main_left = collect_unbalanced_nodes(node, logger, N)
 
-        LDR(node, unbalanced_nodes_list, arr1, logger)
+        arr1 = LDR(main_left, N)
 
-        arr2 = ordered_complete_binary_tree(N, logger)
+        arr2 = ordered_complete_binary_tree(N)
 
         # arr1和arr2都是大小为2N+5的数组
         new_root_node = reordering_complete_binary_tree(N, arr1, arr2, unbalanced_nodes_list, logger)
 
-        update_paths(new_root_node, path, db_manager, logger)
+        restructured = set(unbalanced_nodes_list[1:N+3]) # 主干节点
+        rebalance_stats = {'rewritten': 0, 'skipped': 0}
+        update_paths(new_root_node, path, opc_updates, logger, restructured, rebalance_stats)
+        logger.debug(f"rebalance at path={path}: rewritten={rebalance_stats['rewritten']}, skipped={rebalance_stats['skipped']}")
+        if stats is not None:
+            stats['rewritten'] += rebalance_stats['rewritten']
+            stats['skipped'] += rebalance_stats['skipped']
 
         if parent is not None:
             new_root_node.parent = parent
-            if path[-1] == '0':
+            if path & 1 == 0:
                 parent.left = new_root_node
             else:
                 parent.right = new_root_node
@@ -0,0 +1,425 @@
+import unittest
+import os
+import random
+import asyncio
+import sqlite3
+import logging
+import tempfile
+from unittest import mock
+
+from common import protocol
+from server.encoding_transformer_utils import get_table_name, binary_data_to_path, path_to_string, ROOT_PATH
+from server.node_store import ArrayNodeStore
+from server.rebalance import balance_factor
+from server.snapshot import load_rewrites
+
+try: # server.db.db_manager 依赖 mysql-connector-python
+    from server import engine as engine_module
+    from server.Server import Server, AsyncServer
+    from server.engine import TreeEngine
+except ImportError:
+    engine_module = None
+
+try: # 客户端加密依赖 pycryptodome、gmssl
+    from client.Client import AsyncClient
+except ImportError:
+    AsyncClient = None
+
+"""
+服务器回归测试：TreeEngine 与会话处理函数运行在内存 SQLite 上（接口与 DatabaseManager 一致），快照写入临时目录。
+python -m unittest server.server_test
+"""
+
+
+class SqliteDatabaseManager:
+    """与 DatabaseManager 相同的接口，SQL 中的 %s 占位符替换为 SQLite 的 ?"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def execute_query(self, query, params=None):
+        self.cursor.execute(query.replace('%s', '?'), params or ())
+        return self.cursor.fetchall()
+
+    def execute_transaction(self, statements):
+        try:
+            for query, params in statements:
+                if params:
+                    self.cursor.executemany(query.replace('%s', '?'), params)
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+            raise
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(engine_module is None, "mysql-connector-python is not installed")
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger(__name__)
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False) # AsyncServer 在数据库线程中写入
+        self.connection.execute(f'CREATE TABLE {get_table_name()} ('
+                                f'id INTEGER PRIMARY KEY AUTOINCREMENT, insert_num BLOB, OPC BLOB NOT NULL)')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        snapshot_file = os.path.join(self.tmpdir.name, 'dataset.snapshot')
+        patches = [mock.patch.object(engine_module, 'DatabaseManager', lambda: SqliteDatabaseManager(self.connection)),
+                   mock.patch.object(engine_module, 'snapshot_path', lambda table_name: snapshot_file)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def new_engine(self, node_store='object'):
+        return TreeEngine(self.logger, node_store)
+
+    def insert_value(self, engine, value):
+        """模拟客户端遍历：找到空位后插入"""
+        node = engine.root
+        if node is None:
+            return engine.insert(None, value, None)
+        while True:
+            if value == node.value:
+                return engine.insert(value, value, 'left')
+            direction = 'left' if value < node.value else 'right'
+            child = node.left if direction == 'left' else node.right
+            if child is None:
+                return engine.insert(node.value, value, direction)
+            node = child
+
+    def assert_consistent(self, engine, key=None):
+        """树的中序（按 key 比较，如解密后的明文）与各节点的 path、高度、规模正确，数据库中的 OPC 与树中的 path 一致"""
+        def walk(node, path, parent):
+            if node is None:
+                return 0, 0
+            self.assertEqual(node.path, path)
+            self.assertEqual(node.parent, parent)
+            left_height, left_size = walk(node.left, path << 1, node)
+            values.append(key(node.value) if key else node.value)
+            right_height, right_size = walk(node.right, (path << 1) | 1, node)
+            self.assertEqual(node.height, 1 + max(left_height, right_height))
+            self.assertEqual(node.size, 1 + left_size + right_size)
+            return node.height, node.size
+
+        values = []
+        walk(engine.root, 1, None)
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(values), len(engine.tree))
+
+        rows = engine.db_manager.execute_query(f"SELECT insert_num, OPC FROM {get_table_name()}")
+        for value, OPC in rows:
+            self.assertEqual(binary_data_to_path(OPC), engine.find_node(value).path)
+
+
+class TestQueryHandlers(EngineTestCase):
+    def test_query_and_range_query(self):
+        engine = self.new_engine()
+        values = ['%06d' % i for i in range(0, 200, 7)]
+        for value in values:
+            self.insert_value(engine, value)
+        session = Server(None, self.logger, engine)
+
+        message = protocol.ClientMessage()
+        message.query(values[3])
+        response = session.handle(message)
+        self.assertEqual([row['insert_num'] for row in response.query_results], [values[3]])
+
+        message = protocol.ClientMessage()
+        message.range_query(None, None)
+        response = session.handle(message)
+        self.assertEqual(sorted(row['insert_num'] for row in response.query_results), values)
+
+
+class TestSessionClose(EngineTestCase):
+    def test_close_writes_snapshot_only_after_changes(self):
+        engine = self.new_engine()
+        with mock.patch.object(engine, 'save_snapshot', wraps=engine.save_snapshot) as save:
+            Server(None, self.logger, engine).close() # 只读连接
+            save.assert_not_called()
+
+            session = Server(None, self.logger, engine)
+            self.insert_value(engine, '0001')
+            session.close()
+            save.assert_called_once()
+
+            Server(None, self.logger, engine).close()
+            save.assert_called_once()
+
+
+class TestWriteFailure(EngineTestCase):
+    def test_failed_transaction_discards_tree_changes(self):
+        engine = self.new_engine()
+        for value in ['%04d' % i for i in range(20)]:
+            self.insert_value(engine, value)
+        self.connection.execute(f"CREATE TRIGGER reject BEFORE INSERT ON {get_table_name()} "
+                                f"WHEN NEW.insert_num = '0020' BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+
+        # 0020 挂在最右侧，插入时会重排并改写已有行的编码；事务回滚后树应与数据库一致
+        epoch, rewritten = engine.epoch, engine.rebalance_stats['rewritten']
+        with self.assertRaises(sqlite3.Error):
+            self.insert_value(engine, '0020')
+        self.assertGreater(engine.rebalance_stats['rewritten'], rewritten)
+        self.assertIsNone(engine.find_node('0020'))
+        self.assertEqual(engine.id_num, 20)
+        self.assertIn(ROOT_PATH, engine.rebalanced_since(epoch)) # 所有按旧树规划的插入都需重试
+        self.assert_consistent(engine)
+
+        self.insert_value(engine, '0021')
+        self.assert_consistent(engine)
+
+
+class TestRestart(EngineTestCase):
+    def batch_chain(self, anchor, values, direction='right'):
+        """升序链：每个值都是前一个值的中序后继，第一个值挂在 anchor 的 direction 侧"""
+        items = [(anchor, values[0], direction if anchor is not None else None)]
+        items += [(values[i - 1], values[i], 'right') for i in range(1, len(values))]
+        return items
+
+    def restart_after_batch_into_empty_tree(self, node_store):
+        # 整批插入空树：所有 rebalance 只移动本批次的新行，快照保持 clean，重启时由水位线之后的行还原
+        engine = self.new_engine(node_store)
+        values = ['%04d' % i for i in range(100)]
+        engine.insert_batch(self.batch_chain(None, values))
+        self.assertGreater(engine.epoch, 0)
+        self.assertTrue(engine.snapshot_clean)
+
+        restarted = self.new_engine(node_store)
+        self.assert_consistent(restarted)
+        self.assertEqual(len(restarted.tree), len(values))
+        self.assertEqual(restarted.root.value, engine.root.value)
+
+    def test_restart_after_batch_into_empty_tree(self):
+        self.restart_after_batch_into_empty_tree('object')
+
+    def test_restart_after_batch_into_empty_tree_array_store(self):
+        self.restart_after_batch_into_empty_tree('array')
+
+    def test_restart_after_batch_into_one_slot(self):
+        engine = self.new_engine()
+        for value in ['%04d' % i for i in range(0, 1000, 100)]:
+            self.insert_value(engine, value)
+        engine.save_snapshot()
+
+        epoch = engine.epoch
+        engine.insert_batch(self.batch_chain('0500', ['%04d' % i for i in range(501, 560)]))
+        self.assertGreater(engine.epoch, epoch)
+
+        restarted = self.new_engine()
+        self.assert_consistent(restarted)
+        self.assertEqual(len(restarted.tree), 10 + 59)
+
+
+    def tree_layout(self, engine):
+        return sorted((node.value, node.path, node.height, node.size, tuple(engine.tree.ids_of(node)))
+                      for node in engine.subtree_nodes(engine.root))
+
+    def crash_restart_after_rebalances(self, node_store):
+        # 快照之后的插入多次改写已有行的编码，进程未调用 close() 即退出：重启时由快照、改写日志与增量行还原，不读全表
+        engine = self.new_engine(node_store)
+        engine.snapshot_interval = 150
+        values = ['%04d' % ((i * 7919) % 1000) for i in range(400)] + ['0007', '0014']
+        for value in values[:150]:
+            self.insert_value(engine, value)
+        self.assertEqual(engine.snapshot_id_num, 150)
+
+        epoch, rewritten = engine.epoch, engine.rebalance_stats['rewritten']
+        for value in values[150:]:
+            self.insert_value(engine, value)
+        self.assertEqual(engine.snapshot_id_num, 300)
+        self.assertGreater(engine.epoch, epoch)
+        self.assertGreater(engine.rebalance_stats['rewritten'], rewritten)
+        self.assertTrue(engine.snapshot_clean)
+        self.assertTrue(load_rewrites(engine.snapshot_file)) # 最近一次快照之后仍有改写
+
+        with mock.patch.object(TreeEngine, 'restore_tree_from_db', side_effect=AssertionError('full rebuild')):
+            restarted = self.new_engine(node_store)
+        self.assert_consistent(restarted)
+        self.assertEqual(restarted.id_num, len(values))
+        self.assertEqual(self.tree_layout(restarted), self.tree_layout(engine))
+
+    def test_crash_restart_after_rebalances(self):
+        self.crash_restart_after_rebalances('object')
+
+    def test_crash_restart_after_rebalances_array_store(self):
+        self.crash_restart_after_rebalances('array')
+
+    def test_interrupted_rewrite_falls_back_to_database(self):
+        # 改写事务期间中断（事务已提交、改写日志未写入）：快照保持失效，重启时从数据库全量还原
+        engine = self.new_engine()
+        for value in ['%04d' % i for i in range(20)]:
+            self.insert_value(engine, value)
+        with mock.patch.object(engine_module, 'append_rewrites', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.insert_value(engine, '0020')
+
+        with mock.patch.object(TreeEngine, 'restore_tree_from_db', autospec=True,
+                               side_effect=TreeEngine.restore_tree_from_db) as restore:
+            restarted = self.new_engine()
+        restore.assert_called_once()
+        self.assert_consistent(restarted)
+        self.assertEqual(len(restarted.tree), 21)
+
+
+class TestRebalance(EngineTestCase):
+    # 第 31 个值（537）触发的重排使 715 的平衡因子为 -6（N=5）
+    VALUES = [79, 948, 218, 148, 310, 715, 921, 243, 508, 24, 737, 39, 102, 332, 521, 338,
+              863, 58, 535, 707, 967, 902, 480, 379, 615, 0, 555, 773, 800, 129, 537]
+
+    def unbalanced(self, engine):
+        nodes, stack = [], [engine.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if abs(balance_factor(node)) > engine.N:
+                nodes.append((node.value, balance_factor(node)))
+            stack += [node.left, node.right]
+        return nodes
+
+    def test_unbalanced_node_fixed_by_full_ancestor_walk(self):
+        engine = self.new_engine()
+        for value in self.VALUES:
+            self.insert_value(engine, '%03d' % value)
+        self.assertEqual(self.unbalanced(engine), [('715', -6)])
+        path = engine.find_node('715').path
+
+        # 716 落在 715 的右子树中且不使其变高：只有继续检查到 715 才会在那里重排，在高度不变处停止则 715 保持失衡
+        epoch = engine.epoch
+        self.insert_value(engine, '716')
+        self.assertEqual(engine.rebalanced_since(epoch), [path])
+        self.assertEqual(self.unbalanced(engine), [])
+        self.assert_consistent(engine)
+
+
+class TestGapValidation(EngineTestCase):
+    def plan(self, engine, value):
+        """客户端规划：(父节点密文, 方向, [下界, 上界])"""
+        node, bounds = engine.root, [None, None]
+        while True:
+            direction = 'left' if value < node.value else 'right'
+            bounds[1 if direction == 'left' else 0] = node.value
+            child = node.left if direction == 'left' else node.right
+            if child is None:
+                return node.value, direction, bounds
+            node = child
+
+    def insert_message(self, session, parent, value, direction, epoch, bounds):
+        message = protocol.ClientMessage()
+        message.insert(parent, value, direction, '')
+        message.epoch = epoch
+        message.bounds = bounds
+        return session.handle(message)
+
+    def test_rebalance_elsewhere_does_not_invalidate_plan(self):
+        engine = self.new_engine()
+        for value in ['%04d' % i for i in range(0, 200, 10)]:
+            self.insert_value(engine, value)
+        session = Server(None, self.logger, engine)
+        epoch = engine.epoch
+        parent, direction, bounds = self.plan(engine, '0055')
+        self.assertEqual(bounds, ['0050', '0060'])
+
+        # 在其他位置插入，期间发生包含该插入位的重排（按 epoch 校验时需要重试）
+        for value in ['%04d' % i for i in range(1000, 1060)]:
+            self.insert_value(engine, value)
+        self.assertFalse(engine.slot_is_valid(epoch, parent, direction))
+
+        response = self.insert_message(session, parent, '0055', direction, epoch, bounds)
+        self.assertFalse(response.retry)
+        self.assertEqual(engine.neighbor(engine.find_node('0055'), 'left').value, '0050')
+        self.assert_consistent(engine)
+
+    def test_occupied_gap_returns_replan_start(self):
+        engine = self.new_engine()
+        for value in ['%04d' % i for i in range(0, 200, 10)]:
+            self.insert_value(engine, value)
+        session = Server(None, self.logger, engine)
+        parent, direction, bounds = self.plan(engine, '0055')
+        self.insert_value(engine, '0052')
+
+        response = self.insert_message(session, parent, '0055', direction, engine.epoch, bounds)
+        self.assertTrue(response.retry)
+        self.assertIsNone(engine.find_node('0055'))
+        start = engine.find_node(response.ciphertext)
+        self.assertEqual(response.find_node_path, path_to_string(start.path))
+        self.assertIn('0052', [value for value, _ in engine.subtree(start, 64)])
+
+        # 从提示的起点重新规划，保留已知的界
+        node, new_bounds = start, list(bounds)
+        while node is not None:
+            if '0055' < node.value:
+                new_bounds[1] = min(new_bounds[1], node.value)
+                node = node.left
+            else:
+                new_bounds[0] = max(new_bounds[0], node.value)
+                node = node.right
+        self.assertEqual(new_bounds, ['0052', '0060'])
+        response = self.insert_message(session, None, '0055', None, None, new_bounds)
+        self.assertFalse(response.retry)
+        self.assert_consistent(engine)
+
+    def test_empty_tree_and_open_bounds(self):
+        engine = self.new_engine()
+        self.assertEqual(engine.gap_slot(None, None), (None, None))
+        self.insert_value(engine, '0010')
+        self.assertIsNone(engine.gap_slot(None, None))
+        self.assertEqual(engine.gap_slot('0010', None), (engine.find_node('0010'), 'right'))
+        self.assertEqual(engine.gap_slot(None, '0010'), (engine.find_node('0010'), 'left'))
+        self.assertIsNone(engine.gap_slot('0010', '0099')) # 不存在的节点
+
+
+@unittest.skipIf(AsyncClient is None, "client dependencies are not installed")
+class TestPipelinedClient(EngineTestCase):
+    def test_single_client_retries_stay_bounded(self):
+        # 单个流水线客户端的插入只与自己同时在途的插入冲突，insert_messages 限制其数量
+        engine = self.new_engine()
+        async_server = AsyncServer(engine, self.logger)
+        rnd = random.Random(1)
+        values = ['%08d' % rnd.randrange(10 ** 7) for _ in range(500)]
+
+        async def run():
+            server = await asyncio.start_server(async_server.on_connection, '127.0.0.1', 0)
+            client = await AsyncClient.connect(f"tcp:127.0.0.1:{server.sockets[0].getsockname()[1]}", self.logger)
+            await client.insert_messages(values)
+            await client.close()
+            server.close()
+            await server.wait_closed()
+            return client
+
+        client = asyncio.run(run())
+        async_server.close()
+        self.assertLess(client.retries, len(values) // 10) # 同时在途的值不受限制时重试数千次
+        self.assertEqual(len(engine.tree), len(set(values)))
+        self.assert_consistent(engine, key=client.encryption_scheme.decrypt)
+
+
+class TestArrayNodeStore(EngineTestCase):
+    def test_duplicate_ids_only_for_duplicates(self):
+        engine = self.new_engine('array')
+        values = ['%04d' % i for i in range(0, 300, 3)]
+        for value in values:
+            self.insert_value(engine, value)
+        engine.insert_batch([(values[0], values[0], 'left'), (values[1], '0002', 'right')])
+        self.insert_value(engine, values[5])
+        self.assertEqual(len(engine.tree.duplicate_ids), 2)
+
+        restarted = self.new_engine('array')
+        self.assertEqual(restarted.tree.duplicate_ids, engine.tree.duplicate_ids)
+
+
+class TestArrayNodePath(unittest.TestCase):
+    def test_paths_deeper_than_63_levels(self):
+        store = ArrayNodeStore()
+        deep_path = (1 << 80) | 12345
+        node = store.new_node('a', deep_path)
+        self.assertEqual(node.path, deep_path)
+        node.path = 5
+        self.assertEqual(node.path, 5)
+        self.assertEqual(store.long_paths, {})
+        node.path = deep_path << 1
+        self.assertEqual(store.find('a').path, deep_path << 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
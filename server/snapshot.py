@@ -0,0 +1,195 @@
+import mmap
+import os
+import struct
+
+"""
+服务器树快照：启动时直接从本地文件还原树，只需从数据库补读快照之后新插入的行。
+
+文件格式（小端）：
+    头部：魔数 b'OPES' | 版本 H | clean B | 表名长度 B | 节点数 Q | id_num Q | 水位线 Q | 表名
+    记录（按先序排列，父节点一定在孩子之前）：
+        path 字节数 B | path(大端) | 高度 B | 规模 I | 值类型 B | 值长度 I | 值 | 重复id数 I | id Q * n
+
+改写日志（快照文件名 + '.rewrites'，随快照一起作废）：快照之后 rebalance 对已有行 OPC 的改写，按提交顺序追加
+    记录：值类型 B | 值长度 I | OPC 长度 I | 值 | OPC
+
+增量 = 水位线（快照时数据库中的最大 id）之后的行 + 改写日志。clean 标志：改写事务提交前将该字节置 0，
+提交并追加到改写日志后再置 1；期间中断（事务是否提交未知）时快照保持失效，下次启动回退为从数据库全量还原。
+"""
+
+MAGIC = b'OPES'
+VERSION = 1
+HEADER = struct.Struct('<4sHBBQQQ')
+CLEAN_OFFSET = 6 # clean 标志在文件中的偏移
+
+REWRITE_META = struct.Struct('<BII') # 值类型、值长度、OPC 长度
+PATH_LEN = struct.Struct('<B')
+NODE_META = struct.Struct('<BIBI') # 高度、规模、值类型、值长度
+IDS_LEN = struct.Struct('<I')
+ID = struct.Struct('<Q')
+
+VALUE_STR = 0
+VALUE_BYTES = 1
+
+
+def snapshot_path(table_name):
+    """表对应的快照文件（位于 server 目录下）"""
+    return os.path.join(os.path.dirname(__file__), f"{table_name}.snapshot")
+
+
+def rewrite_log_path(file_path):
+    return file_path + '.rewrites'
+
+
+def _encode_value(value):
+    if isinstance(value, str):
+        return VALUE_STR, value.encode('utf-8')
+    return VALUE_BYTES, bytes(value)
+
+
+def _decode_value(value_type, value):
+    return value.decode('utf-8') if value_type == VALUE_STR else value
+
+
+def _preorder(root):
+    stack = [root] if root else []
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.right:
+            stack.append(node.right)
+        if node.left:
+            stack.append(node.left)
+
+
+def tree_records(tree, root):
+    '''树 --> 快照记录 (path, value, ids, height, size)，先序'''
+    for node in _preorder(root):
+        yield node.path, node.value, tree.ids_of(node), node.height, node.size
+
+
+def write_snapshot(file_path, table_name, records, node_count, id_num, watermark):
+    '''写出快照：先写临时文件再原子替换，写到一半中断不会破坏已有快照'''
+    table = table_name.encode('utf-8')
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 1, len(table), node_count, id_num, watermark))
+        f.write(table)
+        for path, value, ids, height, size in records:
+            path_bytes = path.to_bytes((path.bit_length() + 7) // 8, byteorder='big')
+            value_type, value = _encode_value(value)
+            f.write(PATH_LEN.pack(len(path_bytes)))
+            f.write(path_bytes)
+            f.write(NODE_META.pack(height, size, value_type, len(value)))
+            f.write(value)
+            f.write(IDS_LEN.pack(len(ids)))
+            for node_id in ids:
+                f.write(ID.pack(node_id))
+
+    # 旧快照先失效再删除其改写日志，替换之前中断不会让旧快照丢失改写
+    mark_snapshot_dirty(file_path)
+    if os.path.exists(rewrite_log_path(file_path)):
+        os.remove(rewrite_log_path(file_path))
+    os.replace(tmp_path, file_path)
+
+
+def save_snapshot(file_path, table_name, tree, root, id_num, watermark):
+    write_snapshot(file_path, table_name, tree_records(tree, root), len(tree), id_num, watermark)
+
+
+def _mark_snapshot(file_path, flag):
+    if os.path.exists(file_path):
+        with open(file_path, 'r+b') as f:
+            f.seek(CLEAN_OFFSET)
+            f.write(flag)
+
+
+def mark_snapshot_dirty(file_path):
+    _mark_snapshot(file_path, b'\x00')
+
+
+def mark_snapshot_clean(file_path):
+    _mark_snapshot(file_path, b'\x01')
+
+
+def append_rewrites(file_path, opc_updates):
+    '''已提交的编码改写 {insert_num: OPC} 追加到快照的改写日志'''
+    with open(rewrite_log_path(file_path), 'ab') as f:
+        for value, OPC in opc_updates.items():
+            value_type, value = _encode_value(value)
+            f.write(REWRITE_META.pack(value_type, len(value), len(OPC)))
+            f.write(value)
+            f.write(OPC)
+
+
+def load_rewrites(file_path):
+    '''读取快照的改写日志，返回 {insert_num: OPC}，同一行以最后一次改写为准'''
+    log_path = rewrite_log_path(file_path)
+    if not os.path.exists(log_path):
+        return {}
+    with open(log_path, 'rb') as f:
+        buf = f.read()
+
+    rewrites = {}
+    offset = 0
+    while offset + REWRITE_META.size <= len(buf):
+        value_type, value_len, opc_len = REWRITE_META.unpack_from(buf, offset)
+        offset += REWRITE_META.size
+        value = _decode_value(value_type, buf[offset:offset + value_len])
+        offset += value_len
+        rewrites[value] = buf[offset:offset + opc_len]
+        offset += opc_len
+    return rewrites
+
+
+def load_snapshot(file_path, table_name, tree):
+    '''
+    通过内存映射读取快照，在 tree 中重建节点并连接，返回 (root, id_num, watermark)；
+    快照不存在、已失效或不属于该表时返回 None
+    '''
+    if not os.path.exists(file_path) or os.path.getsize(file_path) < HEADER.size:
+        return None
+
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        magic, version, clean, table_len, node_count, id_num, watermark = HEADER.unpack_from(buf, 0)
+        offset = HEADER.size
+        table = bytes(buf[offset:offset + table_len]).decode('utf-8')
+        offset += table_len
+        if magic != MAGIC or version != VERSION or not clean or table != table_name:
+            return None
+
+        root = None
+        ancestors = [] # 当前节点的祖先栈（先序保证父节点已经出现）
+        for _ in range(node_count):
+            (path_len,) = PATH_LEN.unpack_from(buf, offset)
+            offset += PATH_LEN.size
+            path = int.from_bytes(buf[offset:offset + path_len], byteorder='big')
+            offset += path_len
+            height, size, value_type, value_len = NODE_META.unpack_from(buf, offset)
+            offset += NODE_META.size
+            value = _decode_value(value_type, bytes(buf[offset:offset + value_len]))
+            offset += value_len
+            (ids_len,) = IDS_LEN.unpack_from(buf, offset)
+            offset += IDS_LEN.size
+
+            node = tree.new_node(value, path)
+            node.height = height
+            node.size = size
+            if ids_len:
+                node.ids.extend(ID.unpack_from(buf, offset + i * ID.size)[0] for i in range(ids_len))
+                offset += ids_len * ID.size
+
+            while ancestors and ancestors[-1].path != path >> 1:
+                ancestors.pop()
+            if ancestors:
+                parent = ancestors[-1]
+                node.parent = parent
+                if path & 1 == 0:
+                    parent.left = node
+                else:
+                    parent.right = node
+            else:
+                root = node
+            ancestors.append(node)
+
+    return root, id_num, watermark